@@ -12,7 +12,7 @@ import argparse
 from flask import Flask
 from brother_ql.models import ALL_MODELS
 
-from . import fonts
+from . import fonts, fontwatcher, warmup
 from config import Config
 
 FONTS = None
@@ -41,6 +41,8 @@ def create_app(config_class=Config) -> Flask:
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
 
+    init_warmup(app)
+
     return app
 
 
@@ -48,14 +50,30 @@ def init_fonts(app: Flask):
     FONTS = fonts.Fonts(app.logger,
                         app.config.get('LABEL_DEFAULT_FONT_FAMILY'),
                         app.config.get('LABEL_DEFAULT_FONT_STYLE'),
-                        app.config.get('FONT_FOLDER'))
+                        app.config.get('FONT_FOLDER'),
+                        app.config.get('FONT_INDEX_FILE'),
+                        app.config.get('FONT_SCAN_WORKERS', 0))
     if not FONTS.fonts_available():
         app.logger.error("No fonts found on your system. Please install some.")
         sys.exit(2)
 
+    if app.config.get('FONT_WATCH'):
+        watcher = fontwatcher.FontWatcher(FONTS, app.config.get('FONT_WATCH_INTERVAL', 10))
+        watcher.start()
+        app.extensions['font_watcher'] = watcher
+
     return FONTS
 
 
+def init_warmup(app: Flask):
+    state = warmup.Warmup(FONTS, app.config.get('WARMUP_FONT_SIZES', ()))
+    app.extensions['warmup'] = state
+    if app.config.get('WARMUP'):
+        state.start(background=app.config.get('WARMUP_BACKGROUND', True))
+    else:
+        state.ready.set()
+
+
 def parse_args(app):
     models = [model.identifier for model in ALL_MODELS]
     parser = argparse.ArgumentParser(description=__doc__)
@@ -0,0 +1,125 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """
+    Thread-safe, bounded least recently used cache.
+    Counts hits, misses and evictions so the cache can be monitored.
+
+    Besides the number of entries, the total weight of all entries can be
+    limited, e.g. to cap memory usage. ``weigher`` returns the weight of a
+    value, values heavier than ``max_weight`` are not cached at all.
+    """
+
+    def __init__(self, capacity: int, max_weight: Optional[int] = None,
+                 weigher: Optional[Callable[[Any], int]] = None):
+        if capacity < 0:
+            raise ValueError(f"Cache capacity must not be negative: {capacity}")
+        if max_weight is not None and weigher is None:
+            raise ValueError("A weigher is required to limit the cache weight")
+        self._capacity = capacity
+        self._max_weight = max_weight
+        self._weigher = weigher
+        self._weights: Dict[Hashable, int] = {}
+        self._weight = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value for ``key`` and mark it as recently used."""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        """Insert or replace ``key``, evicting the least recently used entries
+        if the cache is full. Nothing is stored if the capacity is 0."""
+        weight = self._weigher(value) if self._weigher is not None else 0
+        with self._lock:
+            if self._capacity == 0 or (self._max_weight is not None and weight > self._max_weight):
+                self._discard(key)
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._weight += weight - self._weights.get(key, 0)
+            self._weights[key] = weight
+            self._evict()
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Return the cached value for ``key`` or create, cache and return it.
+        ``factory`` runs outside the lock, so concurrent misses may create the
+        value more than once."""
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def resize(self, capacity: int, max_weight: Optional[int] = None):
+        """Change the capacity and the weight limit (None for no limit),
+        evicting entries if they shrink."""
+        if capacity < 0:
+            raise ValueError(f"Cache capacity must not be negative: {capacity}")
+        if max_weight is not None and self._weigher is None:
+            raise ValueError("A weigher is required to limit the cache weight")
+        with self._lock:
+            self._capacity = capacity
+            self._max_weight = max_weight
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weights.clear()
+            self._weight = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                'size': len(self._data),
+                'capacity': self._capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+            if self._weigher is not None:
+                stats['weight'] = self._weight
+                stats['max_weight'] = self._max_weight
+            return stats
+
+    def _discard(self, key: Hashable):
+        if key in self._data:
+            del self._data[key]
+            self._weight -= self._weights.pop(key, 0)
+
+    def _evict(self):
+        while len(self._data) > self._capacity or \
+                (self._max_weight is not None and self._weight > self._max_weight):
+            key, _ = self._data.popitem(last=False)
+            self._weight -= self._weights.pop(key, 0)
+            self.evictions += 1
@@ -1,8 +1,135 @@
 import os
+import json
 import random
 import logging
+import heapq
+import threading
+import multiprocessing
+from bisect import bisect_right
 from fontTools.ttLib import TTFont
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+FONT_EXTENSIONS = ('.ttf', '.otf')
+
+# Bump whenever the layout of an index entry changes so stale index files are
+# discarded instead of being misinterpreted
+FONT_INDEX_VERSION = 2
+
+# Fewer font files than this are parsed in this process, starting worker
+# processes would take longer than parsing them
+PARALLEL_SCAN_MIN_FILES = 32
+
+
+def read_font_info(font_path: str):
+    """Return ``(family, style, coverage)`` of a font file.
+
+    Family and style are taken from the name table, either value is ``None``
+    if the font cannot be parsed or does not provide the name record.
+    ``coverage`` lists the codepoints mapped in the ``cmap`` table as flat,
+    sorted range pairs ``[start0, end0, start1, end1, ...]`` (inclusive). It
+    is empty for fonts without scalable outlines (e.g. color bitmap fonts)
+    as they cannot be rendered at arbitrary sizes.
+    """
+    family = None
+    style = None
+    coverage = []
+    try:
+        font = TTFont(font_path)
+        # Get family and style from name table
+        for record in font['name'].names:
+            if record.nameID == 1 and not family:
+                family = record.toStr()
+            if record.nameID == 2 and not style:
+                style = record.toStr()
+            if family and style:
+                break
+        if any(table in font for table in ('glyf', 'CFF ', 'CFF2')):
+            coverage = codepoint_ranges(font.getBestCmap() or {})
+    except Exception:
+        return (None, None, [])
+    return (family, style, coverage)
+
+
+def codepoint_ranges(codepoints):
+    """Compress codepoints into flat, sorted inclusive range pairs."""
+    ranges = []
+    for codepoint in sorted(codepoints):
+        if ranges and ranges[-1] == codepoint - 1:
+            ranges[-1] = codepoint
+        else:
+            ranges.extend((codepoint, codepoint))
+    return ranges
+
+
+def consolidate_families(fonts: dict):
+    """Consolidate fonts in place: Search for fonts that have children, e.g.
+    "DejaVu Sans" and "DejaVu Sans Condensed" and move children under the
+    parent font, adding them as a style instead.
+
+    ``fonts`` has to be a ``defaultdict(dict)`` sorted by family name. A family
+    is a parent of every family containing its name, candidates are looked up
+    in a :class:`FamilyIndex` instead of comparing all pairs of families.
+    """
+    index = FamilyIndex(fonts.keys())
+    for family in list(fonts.keys()):
+        for other_family in index.containing(family):
+            # A family that has already been merged into its own parent is
+            # created again when it still has children left
+            if family not in fonts:
+                index.add(family)
+            extra_style = other_family.replace(family + ' ', '')
+            for style in fonts[other_family].keys():
+                new_style = extra_style + ((' / ' + style) if style != 'Regular' else '')
+                fonts[family][new_style] = fonts[other_family][style]
+
+            # Remove the child
+            del fonts[other_family]
+            index.remove(other_family)
+
+
+class FamilyIndex:
+    """Trigram index over font family names.
+
+    Finds all families containing a given name as a substring by only testing
+    the families sharing its rarest trigram. Results keep the order in which
+    the families were added.
+    """
+    NGRAM = 3
+
+    def __init__(self, families=()):
+        self._order = {}
+        self._postings = defaultdict(set)
+        self._counter = 0
+        for family in families:
+            self.add(family)
+
+    @classmethod
+    def _ngrams(cls, name: str):
+        return {name[i:i + cls.NGRAM] for i in range(len(name) - cls.NGRAM + 1)}
+
+    def add(self, family: str):
+        self._order[family] = self._counter
+        self._counter += 1
+        for ngram in self._ngrams(family):
+            self._postings[ngram].add(family)
+
+    def remove(self, family: str):
+        del self._order[family]
+        for ngram in self._ngrams(family):
+            self._postings[ngram].discard(family)
+
+    def containing(self, name: str):
+        """Return all other families containing ``name`` in insertion order."""
+        ngrams = self._ngrams(name)
+        if ngrams:
+            candidates = min((self._postings.get(ngram, ()) for ngram in ngrams), key=len)
+        else:
+            # Names shorter than a trigram can be contained in any family
+            candidates = self._order.keys()
+        matches = [family for family in candidates if family != name and name in family]
+        return sorted(matches, key=self._order.__getitem__)
 
 
 class Fonts:
@@ -10,64 +137,43 @@ class Fonts:
                  logger: logging.Logger,
                  default_family: str = 'DejaVu Serif',
                  default_style: str = 'Book',
-                 additional_path: str = ''):
+                 additional_path: str = '',
+                 index_file: str = '',
+                 workers: int = 1,
+                 parallel_min_files: int = PARALLEL_SCAN_MIN_FILES):
+        self.logger = logger
         self.fonts = defaultdict(dict)
         self.default_family = default_family
         self.default_style = default_style
         self.additional_path = additional_path
+        self.index_file = index_file
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.parallel_min_files = parallel_min_files
+        # Incremented whenever the available fonts change after startup
+        self.generation = 0
+        # Called after the fonts changed
+        self._listeners = []
+        self._lock = threading.Lock()
 
         # Scan for TTF/OTF fonts using pure Python (fontTools).
         # :param additional_path: Directory to search in addition to
         #     common system font paths.
-        search_paths = [
+        self.search_paths = [
             '/usr/share/fonts', '/usr/local/share/fonts', os.path.expanduser('~/.fonts'),
             os.path.expanduser('~/.local/share/fonts'), '/Library/Fonts', '/System/Library/Fonts',
             'C:\\Windows\\Fonts'
         ]
-        if len(additional_path) > 0:
-            search_paths.extend(additional_path)
+        if additional_path:
+            self.search_paths.append(additional_path)
 
-        font_exts = ('.ttf', '.otf')
-        for base_path in search_paths:
-            if not os.path.isdir(base_path):
-                continue
-            for root, _, files in os.walk(base_path):
-                for file in files:
-                    if file.lower().endswith(font_exts):
-                        font_path = os.path.join(root, file)
-                        try:
-                            font = TTFont(font_path)
-                            # Get family and style from name table
-                            family = None
-                            style = None
-                            for record in font['name'].names:
-                                if record.nameID == 1 and not family:
-                                    family = record.toStr()
-                                if record.nameID == 2 and not style:
-                                    style = record.toStr()
-                                if family and style:
-                                    break
-                            if family and style:
-                                self.fonts[family][style] = font_path
-                        except Exception:
-                            continue
+        # Only fonts that are new or changed since the index was written need
+        # to be opened, everything else is taken from the index
+        index = self._load_index()
+        self._entries = self._scan(index)
+        if self._entries != index:
+            self._save_index()
 
-        # Sort fonts alphabetically by family name
-        self.fonts = defaultdict(dict, {k: self.fonts[k] for k in sorted(self.fonts.keys(), key=str.lower)})
-
-        # Consolidate fonts: Search for fonts that have children, e.g.
-        # "DejaVu Sans" and "DejaVu Sans Condensed" and move children
-        # under the parent font, adding them as a style instead
-        for family, styles in list(self.fonts.items()):
-            for other_family in list(self.fonts.keys()):
-                if family != other_family and family in other_family:
-                    extra_style = other_family.replace(family + ' ', '')
-                    for style in self.fonts[other_family].keys():
-                        new_style = extra_style + ((' / ' + style) if style != 'Regular' else '')
-                        self.fonts[family][new_style] = self.fonts[other_family][style]
-
-                    # Remove the child
-                    del self.fonts[other_family]
+        self._build()
 
         # Check if the default family/style is available, if not, pick an
         # available random one
@@ -79,6 +185,270 @@ class Fonts:
             style = random.choice(list(self.fonts[family].keys()))
             logger.warning(f'The default font is now set to: {family} ({style})')
 
+    def _load_index(self):
+        """Load the persistent font index, returns an empty index if there is
+        none or it cannot be used."""
+        if not self.index_file or not os.path.isfile(self.index_file):
+            return {}
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as fh:
+                data = json.load(fh)
+            if data.get('version') != FONT_INDEX_VERSION:
+                self.logger.info('Font index %s has an outdated format, rebuilding it', self.index_file)
+                return {}
+            return data.get('fonts', {})
+        except Exception:
+            self.logger.warning('Failed to read font index %s, rebuilding it', self.index_file, exc_info=True)
+            return {}
+
+    def _save_index(self):
+        """Write the font index atomically so concurrently starting workers
+        never see a partially written file."""
+        if not self.index_file:
+            return
+        tmp_file = f'{self.index_file}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+            with open(tmp_file, 'w', encoding='utf-8') as fh:
+                json.dump({'version': FONT_INDEX_VERSION, 'fonts': self._entries}, fh, ensure_ascii=False)
+            os.replace(tmp_file, self.index_file)
+        except OSError:
+            self.logger.warning('Failed to write font index %s', self.index_file, exc_info=True)
+
+    def _font_files(self, paths=None):
+        """Yield ``(path, stat)`` for all font files in ``paths`` (files or
+        directories), defaults to the search paths."""
+        for base_path in (self.search_paths if paths is None else paths):
+            if os.path.isfile(base_path):
+                walk = [(os.path.dirname(base_path), [], [os.path.basename(base_path)])]
+            elif os.path.isdir(base_path):
+                walk = os.walk(base_path)
+            else:
+                continue
+            for root, _, files in walk:
+                for file in files:
+                    if file.lower().endswith(FONT_EXTENSIONS):
+                        font_path = os.path.join(root, file)
+                        try:
+                            yield font_path, os.stat(font_path)
+                        except OSError:
+                            continue
+
+    def _scan(self, index, font_files=None, workers=None):
+        """Return the index entries for ``font_files`` (defaults to all fonts
+        currently on disk), parsing only files that are missing from
+        ``index`` or changed since, with up to ``workers`` processes
+        (defaults to :attr:`workers`)."""
+        if font_files is None:
+            font_files = list(self._font_files())
+        stale = [font_path for font_path, stat in font_files
+                 if font_path not in index
+                 or index[font_path].get('mtime') != stat.st_mtime_ns
+                 or index[font_path].get('size') != stat.st_size]
+        infos = dict(zip(stale, self._read_infos(stale, workers)))
+
+        # Merge in the order the files were found so the resulting mapping
+        # does not depend on the number of workers
+        entries = {}
+        for font_path, stat in font_files:
+            if font_path in infos:
+                family, style, coverage = infos[font_path]
+                # Unparsable fonts are recorded as well so they are not
+                # opened again on every start
+                entries[font_path] = {
+                    'mtime': stat.st_mtime_ns,
+                    'size': stat.st_size,
+                    'family': family,
+                    'style': style,
+                    'coverage': coverage
+                }
+            else:
+                entries[font_path] = index[font_path]
+        self.logger.debug(f"Font scan found {len(entries)} files, parsed {len(stale)} of them")
+        return entries
+
+    def _read_infos(self, font_paths, workers=None):
+        """Parse ``font_paths`` with :func:`read_font_info`, spreading the
+        work across a process pool when more than one worker is configured
+        and there are enough files. Results are returned in the order of
+        ``font_paths``."""
+        workers = min(self.workers if workers is None else workers, len(font_paths))
+        if workers <= 1 or len(font_paths) < self.parallel_min_files:
+            return [read_font_info(font_path) for font_path in font_paths]
+        chunksize = max(1, len(font_paths) // (4 * workers))
+        # Workers are spawned rather than forked, as forking a process with
+        # running threads could copy locks held by them
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                return list(executor.map(read_font_info, font_paths, chunksize=chunksize))
+        except (BrokenProcessPool, RuntimeError, OSError) as e:
+            # E.g. the main module cannot be imported by the workers
+            self.logger.warning(f"Parallel font scan failed ({e!r}), parsing fonts in this process")
+            return [read_font_info(font_path) for font_path in font_paths]
+
+    def _build(self):
+        """Build the family/style mapping from the index entries."""
+        fonts = defaultdict(dict)
+        for font_path, entry in self._entries.items():
+            if entry['family'] and entry['style']:
+                fonts[entry['family']][entry['style']] = font_path
+
+        # Sort fonts alphabetically by family name
+        fonts = defaultdict(dict, {k: fonts[k] for k in sorted(fonts.keys(), key=str.lower)})
+
+        consolidate_families(fonts)
+
+        # Per-font coverage as separate start/end lists for binary search
+        coverage = {}
+        for font_path, entry in self._entries.items():
+            ranges = entry.get('coverage')
+            if ranges:
+                coverage[font_path] = (ranges[0::2], ranges[1::2])
+
+        # Swap in the new mapping at once, requests may read it concurrently
+        self.fonts = fonts
+        self._coverage = coverage
+        self._fallback_table = None
+        self._fontlist = None
+
+    def refresh(self, paths=None) -> bool:
+        """Update the fonts after files were added, changed or removed.
+
+        :param paths: Files or directories that changed, defaults to all
+            search paths. Only new or changed font files are parsed.
+        :returns: True if the available fonts changed.
+
+        Fonts are parsed in this process, as the font watcher calls this
+        while the server is running and only a few files change at a time.
+        """
+        with self._lock:
+            if paths is None:
+                entries = self._scan(self._entries, workers=1)
+            else:
+                font_files = list(self._font_files(paths))
+                found = {font_path for font_path, _ in font_files}
+                prefixes = tuple(os.path.join(path, '') for path in paths)
+                # Drop fonts that vanished from the changed paths
+                entries = {font_path: entry for font_path, entry in self._entries.items()
+                           if font_path in found or not (font_path in paths or font_path.startswith(prefixes))}
+                entries.update(self._scan(self._entries, font_files, workers=1))
+            if entries == self._entries:
+                return False
+
+            added = len(entries.keys() - self._entries.keys())
+            removed = len(self._entries.keys() - entries.keys())
+            self.logger.info(f"Font files changed ({added} added, {removed} removed), updating fonts")
+            self._entries = entries
+            self._save_index()
+            self._build()
+            self.generation += 1
+        for listener in self._listeners:
+            listener()
+        return True
+
+    def on_change(self, listener):
+        """Call ``listener()`` whenever :meth:`refresh` changed the fonts,
+        e.g. to drop caches of fonts loaded from the files."""
+        self._listeners.append(listener)
+
+    def covers(self, font_path: str, codepoint: int) -> bool:
+        """Return True if the font at ``font_path`` has a glyph for
+        ``codepoint``."""
+        ranges = self._coverage.get(font_path)
+        if ranges is None:
+            return False
+        starts, ends = ranges
+        i = bisect_right(starts, codepoint) - 1
+        return i >= 0 and codepoint <= ends[i]
+
+    def _fallback_order(self):
+        """Font paths in the order they are tried as fallback: the default
+        font first, then all families with their regular style first."""
+        order = []
+        default = self.fonts.get(self.default_family, {}).get(self.default_style)
+        if default:
+            order.append(default)
+        for font in self.fontlist():
+            for style in font['styles']:
+                order.append(self.fonts[font['family']][style])
+        return list(dict.fromkeys(path for path in order if path in self._coverage))
+
+    def _build_fallback_table(self):
+        """Merge the coverage of all fonts into one table of disjoint
+        codepoint segments, each mapped to the first font in fallback order
+        covering it."""
+        coverage = self._coverage
+        paths = self._fallback_order()
+        events = []
+        for priority, font_path in enumerate(paths):
+            starts, ends = coverage[font_path]
+            for start, end in zip(starts, ends):
+                events.append((start, 1, priority))
+                events.append((end + 1, -1, priority))
+        events.sort()
+
+        seg_starts, seg_ends, seg_paths = [], [], []
+        active = []
+        ended = defaultdict(int)
+        i = 0
+        while i < len(events):
+            position = events[i][0]
+            while i < len(events) and events[i][0] == position:
+                _, kind, priority = events[i]
+                if kind > 0:
+                    heapq.heappush(active, priority)
+                else:
+                    ended[priority] += 1
+                i += 1
+            # Lazily drop fonts whose range ended
+            while active and ended[active[0]]:
+                ended[active[0]] -= 1
+                heapq.heappop(active)
+            if i < len(events) and active:
+                font_path = paths[active[0]]
+                end = events[i][0] - 1
+                if seg_paths and seg_paths[-1] == font_path and seg_ends[-1] == position - 1:
+                    seg_ends[-1] = end
+                else:
+                    seg_starts.append(position)
+                    seg_ends.append(end)
+                    seg_paths.append(font_path)
+        return (seg_starts, seg_ends, seg_paths)
+
+    def fallback_font(self, codepoint: int):
+        """Return the path of the preferred font covering ``codepoint`` or
+        None if no font does."""
+        table = self._fallback_table
+        if table is None:
+            table = self._fallback_table = self._build_fallback_table()
+        starts, ends, paths = table
+        i = bisect_right(starts, codepoint) - 1
+        if i >= 0 and codepoint <= ends[i]:
+            return paths[i]
+        return None
+
+    def split_runs(self, text: str, font_path: str):
+        """Split ``text`` into runs of ``(text, font_path)`` so that every
+        character is rendered by a font having a glyph for it.
+
+        Characters are kept in ``font_path`` whenever it covers them (or no
+        font does), others use the first fallback font covering them. Each
+        lookup is a binary search, fonts are never opened.
+        """
+        if font_path not in self._coverage:
+            return [(text, font_path)]
+        runs = []
+        for char in text:
+            codepoint = ord(char)
+            path = font_path
+            if not char.isspace() and not self.covers(font_path, codepoint):
+                path = self.fallback_font(codepoint) or font_path
+            if runs and runs[-1][1] == path:
+                runs[-1][0].append(char)
+            else:
+                runs.append(([char], path))
+        return [(''.join(chars), path) for chars, path in runs]
+
     def get_default_font(self):
         """Return the default font family and style."""
         return (self.default_family, self.default_style)
@@ -88,7 +458,16 @@ class Fonts:
         return sorted(self.fonts.keys(), key=str.lower)
 
     def fontlist(self):
-        """Return a sorted list of font styles for each family."""
+        """Return a sorted list of font styles for each family.
+
+        The list is computed once per font update and must not be modified.
+        """
+        fontlist = self._fontlist
+        if fontlist is None:
+            fontlist = self._fontlist = self._sorted_fontlist()
+        return fontlist
+
+    def _sorted_fontlist(self):
         fontlist = []
         for family, variants in self.fonts.items():
             style_keys = list(variants.keys())
@@ -0,0 +1,182 @@
+import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+from .fonts import Fonts
+
+# inotify event flags, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+# Wait this long after the last event before updating the fonts, copying a
+# font collection produces a burst of events
+DEFAULT_SETTLE_TIME = 1.0
+DEFAULT_POLL_INTERVAL = 10.0
+
+logger = logging.getLogger(__name__)
+
+
+class Inotify:
+    """Minimal inotify(7) binding via ctypes (Linux only)."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watches = {}
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = path
+        return wd
+
+    def read_events(self, timeout: float):
+        """Return a list of ``(path, mask)`` tuples, empty on timeout."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            base = self.watches.get(wd)
+            if base is None and not mask & IN_Q_OVERFLOW:
+                continue
+            path = os.path.join(base, os.fsdecode(name)) if base and name else base
+            events.append((path, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FontWatcher(threading.Thread):
+    """Background thread keeping a :class:`Fonts` instance up to date.
+
+    Changes in the font search paths are picked up via inotify where
+    available, otherwise the search paths are polled. In both cases only new
+    or changed font files are parsed.
+    """
+
+    def __init__(self, fonts: Fonts, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 settle_time: float = DEFAULT_SETTLE_TIME, use_inotify: bool = True):
+        super().__init__(name='FontWatcher', daemon=True)
+        self.fonts = fonts
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.use_inotify = use_inotify and sys.platform.startswith('linux')
+        self._stop_event = threading.Event()
+        self._inotify = None
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        if self.use_inotify:
+            try:
+                self._inotify = Inotify()
+            except (OSError, AttributeError):
+                logger.warning('inotify is not available, polling font directories instead', exc_info=True)
+        try:
+            if self._inotify is not None:
+                self._watch()
+            else:
+                self._poll()
+        except Exception:
+            logger.exception('Font watcher stopped unexpectedly')
+        finally:
+            if self._inotify is not None:
+                self._inotify.close()
+
+    def _poll(self):
+        logger.info('Polling font directories every %.1f s', self.poll_interval)
+        while not self._stop_event.wait(self.poll_interval):
+            self.fonts.refresh()
+
+    def _add_watches(self, path: str):
+        """Watch ``path`` and all directories below it."""
+        for root, _, _ in os.walk(path):
+            try:
+                self._inotify.add_watch(root)
+            except OSError as e:
+                logger.warning('Cannot watch font directory %s: %s', root, e)
+
+    def _watch(self):
+        watched_roots = set()
+        logger.info('Watching font directories with inotify')
+        initial = True
+        while not self._stop_event.is_set():
+            # Search paths that do not exist yet (e.g. ~/.local/share/fonts)
+            # are checked again on every timeout
+            new_roots = [path for path in self.fonts.search_paths
+                         if path not in watched_roots and os.path.isdir(path)]
+            for path in new_roots:
+                self._add_watches(path)
+                watched_roots.add(path)
+            if initial:
+                # Pick up changes made between the initial scan and the
+                # watches being in place
+                self.fonts.refresh()
+                initial = False
+            elif new_roots:
+                self.fonts.refresh(new_roots)
+
+            changed = set()
+            overflow = False
+            events = self._inotify.read_events(self.poll_interval)
+            while events:
+                for path, mask in events:
+                    if mask & IN_Q_OVERFLOW:
+                        overflow = True
+                        continue
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        self._add_watches(path)
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF) and path in watched_roots:
+                        watched_roots.discard(path)
+                    changed.add(path)
+                if self._stop_event.is_set():
+                    return
+                events = self._inotify.read_events(self.settle_time)
+
+            if overflow:
+                self.fonts.refresh()
+            elif changed:
+                self.fonts.refresh(sorted(changed))
@@ -1,5 +1,60 @@
+import atexit
+import multiprocessing
+
 from flask import Blueprint
 
 bp = Blueprint('labeldesigner', __name__, template_folder = 'templates')
 
+
+@bp.record_once
+def configure_caches(state):
+    from app import FONTS
+    from .label import (FONT_CACHE, DEFAULT_FONT_CACHE_SIZE, LINE_EXTENTS_CACHE, TEXT_BBOX_CACHE,
+                        DEFAULT_TEXT_BBOX_CACHE_SIZE, RENDER_CACHE, DEFAULT_RENDER_CACHE_SIZE,
+                        DEFAULT_RENDER_CACHE_MAX_BYTES, clear_font_caches)
+    config = state.app.config
+    FONT_CACHE.resize(config.get('FONT_CACHE_SIZE', DEFAULT_FONT_CACHE_SIZE))
+    LINE_EXTENTS_CACHE.resize(config.get('FONT_CACHE_SIZE', DEFAULT_FONT_CACHE_SIZE))
+    TEXT_BBOX_CACHE.resize(config.get('TEXT_BBOX_CACHE_SIZE', DEFAULT_TEXT_BBOX_CACHE_SIZE))
+    RENDER_CACHE.resize(config.get('RENDER_CACHE_SIZE', DEFAULT_RENDER_CACHE_SIZE),
+                        config.get('RENDER_CACHE_MAX_BYTES', DEFAULT_RENDER_CACHE_MAX_BYTES))
+    # Font files may be replaced at the same path while the server runs
+    FONTS.on_change(clear_font_caches)
+
+
+@bp.record_once
+def init_print_jobs(state):
+    from app import FONTS
+    from .jobs import JobManager, DEFAULT_JOB_HISTORY
+    from .journal import PrintJournal, JOURNAL_SUPPORTED
+    from .connections import CONNECTIONS, DEFAULT_CONNECTION_IDLE_TIMEOUT
+    config = state.app.config
+    CONNECTIONS.configure(config.get('PRINT_CONNECTION_IDLE_TIMEOUT', DEFAULT_CONNECTION_IDLE_TIMEOUT))
+    history = config.get('PRINT_JOB_HISTORY', DEFAULT_JOB_HISTORY)
+    journal = None
+    journal_file = config.get('PRINT_JOURNAL_FILE')
+    if journal_file and not JOURNAL_SUPPORTED:
+        state.app.logger.warning('The print journal is not supported on this platform, '
+                                 'interrupted print jobs will not be resumed')
+        journal_file = ''
+    # Pool workers started with the spawn method import the main module
+    # again, an app created by it must not take over the parent's jobs
+    if journal_file and multiprocessing.parent_process() is None:
+        journal = PrintJournal(journal_file, FONTS, history)
+        # Releases the lock file, unfinished jobs are resumed by the next start
+        atexit.register(journal.close)
+    manager = state.app.extensions['print_jobs'] = JobManager(
+        history, journal=journal, lock_dir=config.get('PRINT_LOCK_DIR', ''))
+    manager.resume()
+
+
+@bp.record_once
+def init_printer_status(state):
+    from .status import PrinterStatusMonitor, DEFAULT_STATUS_INTERVAL
+    app = state.app
+    # The printer is not queried while it prints
+    app.extensions['printer_status'] = PrinterStatusMonitor(
+        app.config, app.config.get('PRINTER_STATUS_INTERVAL', DEFAULT_STATUS_INTERVAL),
+        querying=app.extensions['print_jobs'].querying)
+
 from app.labeldesigner import routes
\ No newline at end of file
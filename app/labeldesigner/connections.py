@@ -0,0 +1,215 @@
+"""
+Persistent connections to network printers. brother_ql opens a new socket
+for every ``send()``, a print job with many batches would pay connection
+setup and teardown for each of them. The connection of a printer is kept
+open between batches and jobs instead, and closed once it was idle for a
+while, as network printers usually accept only one connection at a time.
+"""
+
+import time
+import select
+import socket
+import logging
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 9100
+# Seconds an unused connection is kept open, 0 closes it after each batch
+DEFAULT_CONNECTION_IDLE_TIMEOUT = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+WRITE_TIMEOUT = 10
+
+
+def parse_address(device_specifier: str):
+    """Return ``(host, port)`` of a ``tcp://host[:port]`` specifier."""
+    if device_specifier.startswith('tcp://'):
+        device_specifier = device_specifier[len('tcp://'):]
+    host, _, port = device_specifier.partition(':')
+    return host, int(port) if port else DEFAULT_PORT
+
+
+class PrinterConnection:
+    """Socket to a network printer."""
+
+    def __init__(self, device_specifier: str, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT):
+        self.device_specifier = device_specifier
+        self.sock = socket.create_connection(parse_address(device_specifier), timeout=connect_timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.sock.settimeout(WRITE_TIMEOUT)
+        self.last_used = time.monotonic()
+        # Number of times the connection was handed out
+        self.uses = 0
+
+    def is_alive(self) -> bool:
+        """Return False if the printer closed the connection. Printers do
+        not send anything unless asked, so a readable socket is either
+        closed or has unread status data, which is discarded."""
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable:
+                return True
+            self.sock.setblocking(False)
+            try:
+                return self.sock.recv(4096) != b''
+            finally:
+                self.sock.settimeout(WRITE_TIMEOUT)
+        except (OSError, ValueError):
+            return False
+
+    def write(self, data: bytes):
+        self.sock.sendall(data)
+        self.last_used = time.monotonic()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class _Slot:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection: Optional[PrinterConnection] = None
+
+
+class ConnectionManager:
+    """Keeps one connection per network printer. A connection is used by
+    one caller at a time, :meth:`acquire` blocks while it is in use."""
+
+    def __init__(self, idle_timeout: float = DEFAULT_CONNECTION_IDLE_TIMEOUT,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.connects = 0
+        self._slots: Dict[str, _Slot] = {}
+        self._reaper: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def configure(self, idle_timeout: float, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+
+    def _slot(self, device_specifier: str) -> _Slot:
+        with self._lock:
+            slot = self._slots.get(device_specifier)
+            if slot is None:
+                slot = self._slots[device_specifier] = _Slot()
+            return slot
+
+    def acquire(self, device_specifier: str) -> PrinterConnection:
+        """Return the open connection to the printer if it is still alive,
+        or a new one. It must be handed back with :meth:`release`."""
+        slot = self._slot(device_specifier)
+        slot.lock.acquire()
+        try:
+            connection = slot.connection
+            if connection is not None and not connection.is_alive():
+                logger.info('Connection to printer %s was closed, reconnecting', device_specifier)
+                connection.close()
+                connection = slot.connection = None
+            if connection is None:
+                connection = slot.connection = PrinterConnection(device_specifier, self.connect_timeout)
+                with self._lock:
+                    self.connects += 1
+            connection.uses += 1
+            return connection
+        except BaseException:
+            slot.lock.release()
+            raise
+
+    def release(self, connection: PrinterConnection, discard: bool = False):
+        """Hand back a connection, which is closed if ``discard`` is set,
+        e.g. after an error, or if connections are not kept open."""
+        slot = self._slot(connection.device_specifier)
+        try:
+            if discard or self.idle_timeout <= 0:
+                connection.close()
+                slot.connection = None
+            else:
+                connection.last_used = time.monotonic()
+                self._start_reaper()
+        finally:
+            slot.lock.release()
+
+    def send(self, device_specifier: str, data: bytes):
+        """Write ``data`` to the printer. A connection closed by the printer
+        while it was idle is noticed when writing at the latest, the data is
+        then written once more on a new connection."""
+        connection = self.acquire(device_specifier)
+        try:
+            try:
+                connection.write(data)
+            except OSError as e:
+                if connection.uses == 1:
+                    raise
+                logger.info('Writing to idle connection to printer %s failed (%s), reconnecting',
+                            device_specifier, e)
+                connection.close()
+                slot = self._slot(device_specifier)
+                connection = slot.connection = PrinterConnection(device_specifier, self.connect_timeout)
+                connection.uses += 1
+                with self._lock:
+                    self.connects += 1
+                connection.write(data)
+        except BaseException:
+            self.release(connection, discard=True)
+            raise
+        self.release(connection)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            slots = list(self._slots.values())
+        for slot in slots:
+            if slot.lock.acquire(blocking=False):
+                try:
+                    if slot.connection is not None:
+                        slot.connection.close()
+                        slot.connection = None
+                finally:
+                    slot.lock.release()
+
+    def _start_reaper(self):
+        with self._lock:
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap, name='Printer connections', daemon=True)
+                self._reaper.start()
+
+    def _reap(self):
+        """Close connections idle for longer than the idle timeout, exits
+        once no connection is open."""
+        while True:
+            time.sleep(max(min(self.idle_timeout / 2, 1), 0.01))
+            open_connections = 0
+            with self._lock:
+                slots = list(self._slots.values())
+            for slot in slots:
+                if not slot.lock.acquire(blocking=False):
+                    # In use
+                    open_connections += 1
+                    continue
+                try:
+                    connection = slot.connection
+                    if connection is None:
+                        continue
+                    if time.monotonic() - connection.last_used >= self.idle_timeout:
+                        logger.debug('Closing idle connection to printer %s', connection.device_specifier)
+                        connection.close()
+                        slot.connection = None
+                    else:
+                        open_connections += 1
+                finally:
+                    slot.lock.release()
+            with self._lock:
+                # Connections released meanwhile did not start a reaper
+                if not open_connections and all(slot.connection is None for slot in self._slots.values()):
+                    self._reaper = None
+                    return
+
+
+CONNECTIONS = ConnectionManager()
@@ -0,0 +1,385 @@
+"""
+Print jobs. A job runs :meth:`PrinterQueue.process_queue` on the worker
+thread of its printer, so jobs for different printers print in parallel
+while each device is only accessed by one job at a time. Print requests
+either wait for their job or return right away with a job ID whose
+progress can be polled via ``/api/jobs/<id>``. With a
+:class:`PrintJournal` jobs survive a restart and are resumed with the
+labels which were not sent yet.
+"""
+
+import os
+import time
+import uuid
+import queue
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+from urllib.parse import quote
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from .printer import PrinterQueue, BatchSizer
+from .journal import PrintJournal
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB_HISTORY = 100
+# Seconds a printer worker thread waits for new jobs before it exits, it is
+# started again by the next job
+DEFAULT_WORKER_IDLE_TIMEOUT = 60
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+class PrintJob:
+    """State of a print job, updated by the worker thread running it."""
+
+    def __init__(self, printer: PrinterQueue, journal: Optional[PrintJournal] = None,
+                 job_id: Optional[str] = None, labels_sent: int = 0, batches: Optional[List[dict]] = None,
+                 created: Optional[float] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.printer = printer
+        self.journal = journal
+        self.device = printer.device_specifier
+        # A resumed job only has the labels left which were not sent before
+        self.labels = len(printer) + labels_sent
+        self.state = JOB_QUEUED
+        self.message = ''
+        # Exception raised while printing
+        self.error: Optional[Exception] = None
+        self.labels_sent = labels_sent
+        self.batches: List[dict] = list(batches or [])
+        # Batch indices continue after the batches of a resumed job
+        self._batch_offset = len(self.batches)
+        self.created = created or time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.done.wait(timeout)
+
+    def batch_done(self, batch_index: int, labels: int, status: str):
+        """Progress callback of :meth:`PrinterQueue.process_queue`."""
+        with self._lock:
+            self.batches.append({
+                'index': self._batch_offset + batch_index,
+                'labels': labels,
+                'success': not status,
+                'message': status,
+            })
+            if not status:
+                self.labels_sent += labels
+        if self.journal is not None:
+            self.journal.batch_done(self.id, labels, status)
+
+    def _start(self):
+        with self._lock:
+            self.state = JOB_RUNNING
+            self.started = time.time()
+        if self.journal is not None:
+            self.journal.started(self.id, self.started)
+
+    def _finish(self, state: str, message: str = '', error: Optional[Exception] = None):
+        with self._lock:
+            self.state = state
+            self.message = message
+            self.error = error
+            self.finished = time.time()
+        if self.journal is not None:
+            self.journal.finished(self.id, state, message, self.finished)
+
+    def run(self, sizer: Optional[BatchSizer] = None):
+        """Print the job with the batch sizer of its printer, :attr:`done`
+        is set by the worker running it once its statistics are updated."""
+        self._start()
+        try:
+            status = self.printer.process_queue(progress=self.batch_done, sizer=sizer)
+        except Exception as e:
+            logger.exception('Print job %s failed: %s', self.id, e)
+            self._finish(JOB_FAILED, str(e), e)
+        else:
+            self._finish(JOB_FAILED if status else JOB_DONE, status)
+        finally:
+            # The labels are not needed anymore
+            self.printer = None
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'id': self.id,
+                'state': self.state,
+                'success': self.state == JOB_DONE if self.is_finished else None,
+                'message': self.message,
+                'printer': self.device,
+                'labels': self.labels,
+                'labels_sent': self.labels_sent,
+                'batches_sent': sum(1 for batch in self.batches if batch['success']),
+                'batches': list(self.batches),
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+            }
+
+
+def device_key(device_specifier) -> str:
+    """Return the same key for all specifiers of a device, e.g.
+    ``file:///dev/usb/lp0`` and ``/dev/usb/lp0``."""
+    device = str(device_specifier)
+    return device[len('file://'):] if device.startswith('file://') else device
+
+
+class DeviceGate:
+    """Keeps print jobs and printer status queries from using a printer at
+    the same time. Jobs wait for a running query, queries are skipped while
+    the printer prints. Devices are :func:`device_key` keys, a query of
+    ``'?'`` (auto-detection) may reach every printer.
+
+    With a ``lock_dir``, jobs and queries also hold a lock file per device,
+    so processes sharing the directory, e.g. the workers of a WSGI server,
+    use a printer one at a time as well."""
+
+    def __init__(self, lock_dir: str = ''):
+        if lock_dir and fcntl is None:
+            logger.warning('File locks are not supported on this platform, jobs of other '
+                           'processes may print at the same time')
+            lock_dir = ''
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+        self.lock_dir = lock_dir
+        self._printing: Dict[str, int] = {}
+        self._querying: Dict[str, int] = {}
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def _device_lock(self, device: str, blocking: bool = True) -> Iterator[bool]:
+        """Hold the lock file of a device. Yields False if ``blocking`` is
+        not set and another process holds it."""
+        if not self.lock_dir or device in ('simulation', '?'):
+            yield True
+            return
+        with open(os.path.join(self.lock_dir, f"{quote(device, safe='')}.lock"), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _shared(query_device: str, job_device: str) -> bool:
+        if job_device in ('simulation', '?'):
+            return False
+        return query_device == '?' or query_device == job_device
+
+    @contextmanager
+    def printing(self, device: str) -> Iterator[None]:
+        with self._condition:
+            self._condition.wait_for(lambda: not any(
+                count and self._shared(query_device, device) for query_device, count in self._querying.items()))
+            self._printing[device] = self._printing.get(device, 0) + 1
+        try:
+            with self._device_lock(device):
+                yield
+        finally:
+            with self._condition:
+                self._printing[device] -= 1
+                self._condition.notify_all()
+
+    @contextmanager
+    def querying(self, device: str) -> Iterator[bool]:
+        """Yield True if the printer can be queried, jobs for it wait until
+        the block is left. Yields False if it is printing, here or in
+        another process."""
+        with self._condition:
+            idle = not any(count and self._shared(device, job_device) for job_device, count in self._printing.items())
+            if idle:
+                self._querying[device] = self._querying.get(device, 0) + 1
+        if not idle:
+            yield False
+            return
+        try:
+            with self._device_lock(device, blocking=False) as unlocked:
+                yield unlocked
+        finally:
+            with self._condition:
+                self._querying[device] -= 1
+                self._condition.notify_all()
+
+
+class PrinterWorker:
+    """Runs the jobs of one printer one after another on its own thread and
+    keeps statistics about them."""
+
+    def __init__(self, device: str, idle_timeout: float = DEFAULT_WORKER_IDLE_TIMEOUT,
+                 gate: Optional[DeviceGate] = None):
+        self.device = device
+        self.idle_timeout = idle_timeout
+        self.gate = gate or DeviceGate()
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.labels_printed = 0
+        self.busy_time = 0.0
+        # Learns the throughput of the printer across its jobs
+        self.sizer = BatchSizer()
+        self.current: Optional[PrintJob] = None
+        self._queued_labels = 0
+        self._jobs = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, job: PrintJob):
+        with self._lock:
+            self._jobs.put(job)
+            self._queued_labels += job.labels
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'Printer {self.device}', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                job = self._jobs.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self._lock:
+                    # Jobs submitted meanwhile are picked up by this thread
+                    if self._jobs.empty():
+                        self._thread = None
+                        return
+                continue
+            with self._lock:
+                self._queued_labels -= job.labels
+                self.current = job
+            start = time.perf_counter()
+            try:
+                with self.gate.printing(self.device):
+                    job.run(self.sizer)
+            finally:
+                with self._lock:
+                    self.current = None
+                    self.busy_time += time.perf_counter() - start
+                    self.labels_printed += job.labels_sent
+                    if job.state == JOB_DONE:
+                        self.jobs_done += 1
+                    else:
+                        self.jobs_failed += 1
+                job.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'device': self.device,
+                'busy': self.current is not None,
+                'current_job': self.current.id if self.current is not None else None,
+                'queued_jobs': self._jobs.qsize(),
+                'queued_labels': self._queued_labels,
+                'jobs_done': self.jobs_done,
+                'jobs_failed': self.jobs_failed,
+                'labels_printed': self.labels_printed,
+                'busy_seconds': self.busy_time,
+                'labels_per_second': self.labels_printed / self.busy_time if self.busy_time else None,
+            }
+
+
+class JobManager:
+    """Hands print jobs to one worker per printer device and keeps the state
+    of the most recent finished jobs for polling. Jobs are recorded in the
+    optional journal, older jobs are looked up there."""
+
+    def __init__(self, history: int = DEFAULT_JOB_HISTORY,
+                 idle_timeout: float = DEFAULT_WORKER_IDLE_TIMEOUT,
+                 journal: Optional[PrintJournal] = None, lock_dir: str = ''):
+        self.history = history
+        self.idle_timeout = idle_timeout
+        self.journal = journal
+        self._jobs = OrderedDict()
+        self._workers: Dict[str, PrinterWorker] = {}
+        self._gate = DeviceGate(lock_dir)
+        self._lock = threading.Lock()
+
+    def submit(self, printer: PrinterQueue, journal: bool = True) -> PrintJob:
+        """Queue a print job. Jobs whose caller waits for them are submitted
+        without ``journal``, so they are not resumed after a restart as
+        their caller already got an error."""
+        job = PrintJob(printer, self.journal if journal else None)
+        if job.journal is not None:
+            try:
+                self.journal.add(job.id, printer, job.labels, job.created)
+            except Exception:
+                # Printing does not depend on the journal
+                logger.exception('Cannot journal print job %s', job.id)
+                job.journal = None
+        self._enqueue(job)
+        return job
+
+    def resume(self) -> List[PrintJob]:
+        """Submit the jobs of a previous run which were interrupted, starting
+        with the first batch not confirmed as sent."""
+        if self.journal is None:
+            return []
+        jobs = [PrintJob(printer, self.journal, job_id, labels_sent, batches, created)
+                for job_id, printer, labels_sent, created, batches in self.journal.claim_interrupted()]
+        for job in jobs:
+            logger.info('Resuming print job %s with %d of %d labels', job.id, len(job.printer), job.labels)
+            self._enqueue(job)
+        return jobs
+
+    def _enqueue(self, job: PrintJob):
+        key = device_key(job.device)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+            worker = self._workers.get(key)
+            if worker is None:
+                worker = self._workers[key] = PrinterWorker(key, self.idle_timeout, self._gate)
+        worker.submit(job)
+
+    def get(self, job_id: str) -> Optional[PrintJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def job_state(self, job_id: str) -> Optional[dict]:
+        """Return :meth:`PrintJob.to_dict` of a job, which may have run
+        before a restart."""
+        job = self.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self.journal is not None:
+            return self.journal.job_state(job_id)
+        return None
+
+    def jobs(self) -> List[PrintJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def querying(self, device_specifier) -> Iterator[bool]:
+        """Context manager for querying a printer outside of a job, see
+        :meth:`DeviceGate.querying`."""
+        return self._gate.querying(device_key(device_specifier))
+
+    def printer_stats(self) -> List[dict]:
+        with self._lock:
+            workers = list(self._workers.values())
+        return [worker.stats() for worker in workers]
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
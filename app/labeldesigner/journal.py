@@ -0,0 +1,256 @@
+"""
+SQLite journal of print jobs, so jobs interrupted by a restart are resumed
+and callers can still look up which labels of a job were printed.
+
+A job is stored once with its pickled :class:`PrinterQueue` when it is
+submitted. Afterwards only its state and one row per sent batch are
+written. Each process holds a lock file while it runs, jobs owned by a
+process whose lock is free again were interrupted and get resumed.
+"""
+
+import io
+import os
+import glob
+import time
+import uuid
+import pickle
+import sqlite3
+import logging
+import threading
+from typing import Any, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from .printer import PrinterQueue
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+# Owners are tracked with file locks
+JOURNAL_SUPPORTED = fcntl is not None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    state TEXT NOT NULL,
+    message TEXT NOT NULL DEFAULT '',
+    device TEXT NOT NULL,
+    labels INTEGER NOT NULL,
+    labels_sent INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    printer BLOB
+);
+CREATE TABLE IF NOT EXISTS batches (
+    job_id TEXT NOT NULL,
+    labels INTEGER NOT NULL,
+    success INTEGER NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS batches_job_id ON batches (job_id);
+"""
+
+
+class _Pickler(pickle.Pickler):
+    # The fonts are referenced by labels using fallback fonts, they are
+    # replaced by the fonts of the process loading the journal
+    def __init__(self, file, fonts):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.fonts = fonts
+
+    def persistent_id(self, obj):
+        if self.fonts is not None and obj is self.fonts:
+            return 'fonts'
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, fonts):
+        super().__init__(file)
+        self.fonts = fonts
+
+    def persistent_load(self, pid):
+        if pid == 'fonts' and self.fonts is not None:
+            return self.fonts
+        raise pickle.UnpicklingError(f'Unsupported persistent object: {pid}')
+
+
+class PrintJournal:
+    """Journal of the print jobs of all processes using the same file."""
+
+    def __init__(self, path: str, fonts: Any = None, history: int = 100):
+        self.path = path
+        self.fonts = fonts
+        # Number of finished jobs kept
+        self.history = history
+        self.owner = uuid.uuid4().hex
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Held as long as this journal (i.e. the process) is alive. It is
+        # locked before it is renamed to the name other processes look for,
+        # so they never see it unlocked
+        unpublished = f'{self._lock_path(self.owner)}.new'
+        self._owner_lock = open(unpublished, 'w')
+        fcntl.flock(self._owner_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(unpublished, self._lock_path(self.owner))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        # Batch updates must not slow down printing, a power loss may only
+        # lose the last few of them
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, JOURNAL_VERSION):
+            logger.warning('Print journal %s has an unsupported format, recreating it', path)
+            self._db.executescript('DROP TABLE IF EXISTS jobs; DROP TABLE IF EXISTS batches;')
+        self._db.executescript(SCHEMA)
+        self._db.execute(f'PRAGMA user_version={JOURNAL_VERSION}')
+
+    def _lock_path(self, owner: str) -> str:
+        return f'{self.path}.{owner}.lock'
+
+    def _execute(self, *statements: Tuple[str, tuple]):
+        """Run ``(sql, parameters)`` statements in one transaction, failing
+        writes are logged as printing goes on."""
+        try:
+            with self._lock:
+                self._db.execute('BEGIN IMMEDIATE')
+                try:
+                    for sql, parameters in statements:
+                        self._db.execute(sql, parameters)
+                    self._db.execute('COMMIT')
+                except BaseException:
+                    self._db.execute('ROLLBACK')
+                    raise
+        except sqlite3.Error:
+            logger.exception('Failed to write print journal %s', self.path)
+
+    def add(self, job_id: str, printer: PrinterQueue, labels: int, created: float):
+        buffer = io.BytesIO()
+        _Pickler(buffer, self.fonts).dump(printer)
+        self._execute(('INSERT INTO jobs (id, owner, state, device, labels, created, printer) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (job_id, self.owner, 'queued', str(printer.device_specifier), labels, created,
+                        buffer.getvalue())))
+
+    def started(self, job_id: str, started: float):
+        self._execute(("UPDATE jobs SET state = 'running', started = ? WHERE id = ?", (started, job_id)))
+
+    def batch_done(self, job_id: str, labels: int, status: str):
+        self._execute(('INSERT INTO batches (job_id, labels, success, message) VALUES (?, ?, ?, ?)',
+                       (job_id, labels, not status, status)),
+                      ('UPDATE jobs SET labels_sent = labels_sent + ? WHERE id = ?',
+                       (0 if status else labels, job_id)))
+
+    def finished(self, job_id: str, state: str, message: str, finished: float):
+        # The labels are only needed to resume the job
+        pruned = ('SELECT id FROM jobs WHERE finished IS NOT NULL '
+                  'ORDER BY finished DESC LIMIT -1 OFFSET ?')
+        self._execute(('UPDATE jobs SET state = ?, message = ?, finished = ?, printer = NULL WHERE id = ?',
+                       (state, message, finished, job_id)),
+                      (f'DELETE FROM batches WHERE job_id IN ({pruned})', (self.history,)),
+                      (f'DELETE FROM jobs WHERE id IN ({pruned})', (self.history,)))
+
+    def job_state(self, job_id: str) -> Optional[dict]:
+        """Return the state of a job like :meth:`PrintJob.to_dict`, or None
+        if the job is not in the journal."""
+        with self._lock:
+            row = self._db.execute('SELECT id, state, message, device, labels, labels_sent, created, started, '
+                                   'finished FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            batches = self.batches(job_id)
+        job_id, state, message, device, labels, labels_sent, created, started, finished = row
+        return {
+            'id': job_id,
+            'state': state,
+            'success': state == 'done' if finished is not None else None,
+            'message': message,
+            'printer': device,
+            'labels': labels,
+            'labels_sent': labels_sent,
+            'batches_sent': sum(1 for batch in batches if batch['success']),
+            'batches': batches,
+            'created': created,
+            'started': started,
+            'finished': finished,
+        }
+
+    def batches(self, job_id: str) -> List[dict]:
+        rows = self._db.execute('SELECT labels, success, message FROM batches WHERE job_id = ? ORDER BY rowid',
+                                (job_id,)).fetchall()
+        return [{'index': index, 'labels': labels, 'success': bool(success), 'message': message}
+                for index, (labels, success, message) in enumerate(rows, start=1)]
+
+    def _owner_alive(self, owner: str) -> bool:
+        """Return True if the process owning the jobs still holds its lock.
+        A missing lock file was removed after its owner was gone."""
+        try:
+            fd = os.open(self._lock_path(owner), os.O_RDWR)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+        return False
+
+    def claim_interrupted(self) -> List[Tuple[str, PrinterQueue, int, float, List[dict]]]:
+        """Take over the unfinished jobs of processes which are gone. Returns
+        ``(job_id, printer, labels_sent, created, batches)`` for each job,
+        the labels already sent are removed from the printer queue."""
+        with self._lock:
+            owners = [owner for owner, in self._db.execute(
+                'SELECT DISTINCT owner FROM jobs WHERE finished IS NULL AND owner != ?', (self.owner,))]
+        jobs = []
+        for owner in owners:
+            if self._owner_alive(owner):
+                continue
+            with self._lock:
+                rows = self._db.execute('SELECT id, printer, labels_sent, created FROM jobs '
+                                        'WHERE finished IS NULL AND owner = ? ORDER BY created', (owner,)).fetchall()
+            for job_id, data, labels_sent, created in rows:
+                # Only one process takes over each job
+                with self._lock:
+                    claimed = self._db.execute("UPDATE jobs SET owner = ?, state = 'queued' WHERE id = ? AND owner = ?",
+                                               (self.owner, job_id, owner)).rowcount
+                if not claimed:
+                    continue
+                try:
+                    printer = _Unpickler(io.BytesIO(data), self.fonts).load()
+                except Exception as e:
+                    logger.exception('Cannot resume print job %s', job_id)
+                    self.finished(job_id, 'failed', f'Cannot resume print job: {e}', time.time())
+                    continue
+                printer.drop_labels(labels_sent)
+                with self._lock:
+                    batches = self.batches(job_id)
+                jobs.append((job_id, printer, labels_sent, created, batches))
+        # Lock files of processes which are gone
+        for lock_path in glob.glob(glob.escape(self.path) + '.*.lock'):
+            owner = lock_path[len(self.path) + 1:-len('.lock')]
+            if owner != self.owner and not self._owner_alive(owner):
+                try:
+                    os.remove(lock_path)
+                except OSError:
+                    pass
+        return jobs
+
+    def close(self):
+        with self._lock:
+            if self._owner_lock.closed:
+                return
+            self._db.close()
+        self._owner_lock.close()
+        try:
+            os.remove(self._lock_path(self.owner))
+        except OSError:
+            pass
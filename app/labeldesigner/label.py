@@ -1,4 +1,5 @@
 from .enums import LabelContent, LabelOrientation, LabelType
+from app.cache import LRUCache
 import os
 import uuid
 from qrcode import QRCode, constants
@@ -11,7 +12,9 @@ import re
 import random
 import string
 import copy
-from typing import Any, Dict, List, Optional, Tuple, Union
+import json
+import hashlib
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 logger = logging.getLogger(__name__)
 
@@ -19,7 +22,216 @@ logger = logging.getLogger(__name__)
 WARNING_TEXT_LENGTH = 500
 DEFAULT_RANDOM_LENGTH = 64
 DEFAULT_FONT_SIZE = 12
-FONT_CACHE: Dict[Tuple[str, int], ImageFont.FreeTypeFont] = {}
+DEFAULT_FONT_CACHE_SIZE = 64
+# Loaded fonts keyed by (path, size), resized from the app config
+FONT_CACHE = LRUCache(DEFAULT_FONT_CACHE_SIZE)
+DEFAULT_TEXT_BBOX_CACHE_SIZE = 4096
+# Text bounding boxes at the origin keyed by (path, size, text, anchor, align, fontmode)
+TEXT_BBOX_CACHE = LRUCache(DEFAULT_TEXT_BBOX_CACHE_SIZE)
+# Characters defining the uniform height of a line
+LINE_HEIGHT_CHARACTERS = string.ascii_letters + string.digits + string.punctuation
+# Vertical extents of LINE_HEIGHT_CHARACTERS keyed by (path, size, fontmode)
+LINE_EXTENTS_CACHE = LRUCache(DEFAULT_FONT_CACHE_SIZE)
+DEFAULT_RENDER_CACHE_SIZE = 128
+DEFAULT_RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Rendered labels keyed by a digest of all rendering inputs, limited to a
+# total number of pixel bytes
+RENDER_CACHE = LRUCache(DEFAULT_RENDER_CACHE_SIZE, DEFAULT_RENDER_CACHE_MAX_BYTES,
+                        lambda img: img.width * img.height * len(img.getbands()))
+DEFAULT_TEMPLATE_CACHE_SIZE = 1024
+# Compiled templates keyed by the text of a line
+TEMPLATE_CACHE = LRUCache(DEFAULT_TEMPLATE_CACHE_SIZE)
+# Placeholders supported in text lines:
+# {{counter[:<start>]}} current label counter (<start> is an optional offset
+#     defaulting to 1)
+# {{datetime:<format>}} current datetime formatted as <format>
+# {{uuid}}, {{short-uuid}} a new (shortened) UUID, the same within a line
+# {{env:<var>}} the value of the environment variable var
+# {{random[:<len>][:shift]}} random string of optional length <len> and
+#     shifting instruction. ":s" is accepted as shorthand for ":shift"
+TEMPLATE_PLACEHOLDER = re.compile(
+    r"\{\{(?:"
+    r"counter(?:\:(?P<counter>\d+))?"
+    r"|datetime:(?P<datetime>[^}]+)"
+    r"|(?P<uuid>uuid)"
+    r"|(?P<short_uuid>short-uuid)"
+    r"|env:(?P<env>[^}]+)"
+    r"|(?P<random>random)(?:\:(?P<random_length>\d+))?(?:\:(?P<shift>s(?:hift)?))?"
+    r")\}\}")
+RANDOM_CHARACTERS = string.ascii_letters + string.digits + string.punctuation
+# Canvas modes the printer can use without converting, from smallest to
+# largest. Previews are always rendered in RGB
+NATIVE_CANVAS_MODES = ('1', 'L', 'RGB')
+BILEVEL_COLORS = ((0, 0, 0), (255, 255, 255))
+
+
+# Incremented by clear_font_caches(), part of the render key so labels
+# still being rendered with the previous fonts are not cached
+_font_generation = 0
+
+
+def clear_font_caches():
+    """Drop everything derived from font files, e.g. after a font file was
+    replaced at the same path."""
+    global _font_generation
+    _font_generation += 1
+    for cache in (FONT_CACHE, TEXT_BBOX_CACHE, LINE_EXTENTS_CACHE, RENDER_CACHE):
+        cache.clear()
+
+
+def ink(color: Tuple[int, int, int], mode: str):
+    """Return an RGB color as ink for an image of the given mode, grayscale
+    and 1-bit images take its luma (ITU-R 601-2, as ``Image.convert``)."""
+    if mode not in ('L', '1'):
+        return color
+    r, g, b = color
+    luma = (r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16
+    if mode == '1':
+        return 255 if luma >= 128 else 0
+    return luma
+
+
+class CompiledTemplate:
+    """
+    A line of text split into literal strings and ``(kind, argument)``
+    placeholder tokens. Static templates contain no placeholders.
+    """
+    __slots__ = ('tokens', 'is_static', 'uses_uuid', 'uses_short_uuid', 'uses_random')
+
+    def __init__(self, text: str):
+        self.tokens: List[Union[str, Tuple[str, Any]]] = []
+        position = 0
+        for match in TEMPLATE_PLACEHOLDER.finditer(text):
+            if match.start() > position:
+                self.tokens.append(text[position:match.start()])
+            position = match.end()
+            if match.group('datetime') is not None:
+                self.tokens.append(('datetime', match.group('datetime')))
+            elif match.group('uuid'):
+                self.tokens.append(('uuid', None))
+            elif match.group('short_uuid'):
+                self.tokens.append(('short-uuid', None))
+            elif match.group('env') is not None:
+                self.tokens.append(('env', match.group('env')))
+            elif match.group('random'):
+                length = int(match.group('random_length')) if match.group('random_length') else DEFAULT_RANDOM_LENGTH
+                self.tokens.append(('random', (length, bool(match.group('shift')))))
+            else:
+                counter = match.group('counter')
+                self.tokens.append(('counter', int(counter) if counter else 1))
+        if position < len(text):
+            self.tokens.append(text[position:])
+        self.is_static = all(isinstance(token, str) for token in self.tokens)
+        self.uses_uuid = ('uuid', None) in self.tokens
+        self.uses_short_uuid = ('short-uuid', None) in self.tokens
+        # Placeholders drawing from the random number generator
+        self.uses_random = any(token[0] in ('random', 'uuid', 'short-uuid')
+                               for token in self.tokens if not isinstance(token, str))
+
+    def substitute(self, counter: int, now: Callable[[], datetime.datetime], line: Dict[str, Any]) -> str:
+        """Return the text with all placeholders replaced, ``now`` returns
+        the datetime of the label. Sets ``line['shift']`` if requested."""
+        # UUIDs are drawn before random strings, keeping seeded output stable
+        uuid_text = str(uuid.UUID(int=random.getrandbits(128))) if self.uses_uuid else ''
+        short_uuid_text = str(uuid.UUID(int=random.getrandbits(128)))[:8] if self.uses_short_uuid else ''
+        parts = []
+        for token in self.tokens:
+            if isinstance(token, str):
+                parts.append(token)
+                continue
+            kind, argument = token
+            if kind == 'counter':
+                parts.append(str(counter + argument))
+            elif kind == 'datetime':
+                parts.append(now().strftime(argument))
+            elif kind == 'uuid':
+                parts.append(uuid_text)
+            elif kind == 'short-uuid':
+                parts.append(short_uuid_text)
+            elif kind == 'env':
+                parts.append(os.getenv(argument, ""))
+            elif kind == 'random':
+                length, shift = argument
+                if shift:
+                    line['shift'] = True
+                parts.append(''.join(random.choices(RANDOM_CHARACTERS, k=length)))
+        return ''.join(parts)
+
+
+def compile_template(text: str) -> CompiledTemplate:
+    """Return the compiled template of a line of text, compiled only once."""
+    return TEMPLATE_CACHE.get_or_create(text, lambda: CompiledTemplate(text))
+
+# Anchor used for each text alignment
+TEXT_ANCHORS = {'left': 'lt', 'center': 'mt', 'right': 'rt'}
+
+
+class LineLayout:
+    """Font and position of a single line of text."""
+    __slots__ = ('line', 'font', 'runs', 'align', 'spacing', 'bbox', 'ink', 'y', 'x')
+
+    def __init__(self, line, font, runs, align, spacing, bbox, ink, y):
+        self.line = line
+        self.font = font
+        self.runs = runs
+        self.align = align
+        self.spacing = spacing
+        # Text box with uniform line height, in form (x0, y0, x1, y1)
+        self.bbox = bbox
+        # Measured box of the text itself
+        self.ink = ink
+        self.y = y
+        self.x = 0
+
+
+class TextLayout:
+    """
+    Positions of all lines of text relative to the text offset. The horizontal
+    extents of all lines are computed once, aligning each line is O(1).
+    """
+
+    def __init__(self, lines: List[LineLayout]):
+        self.lines = lines
+        if lines:
+            self.min_x = min(line.bbox[0] for line in lines)
+            self.max_x = max(line.bbox[2] for line in lines)
+            # Total bbox in form (x0, y0, x1, y1)
+            self.bbox = (lines[0].bbox[0], lines[0].bbox[1], self.max_x, lines[-1].bbox[3])
+        else:
+            self.min_x = self.max_x = 0
+            self.bbox = (0, 0, 0, 0)
+        self.center_x = (self.min_x + self.max_x) // 2
+        for line in lines:
+            if line.align == "left":
+                line.x = self.min_x
+            elif line.align == "center":
+                line.x = (self.max_x - self.min_x) // 2 + self.min_x
+            else:
+                line.x = self.max_x
+
+
+class LabelLayers:
+    """
+    Rendered parts shared by copies of a label which only differ in the
+    text of some lines, see :meth:`SimpleLabel.clone`.
+    """
+
+    def __init__(self):
+        # (img, img_width, img_height) of the code or image
+        self.content = None
+        # (geometry, canvas) with the content and all static lines
+        self.base = None
+        # (image, digest) of the label image, as hashing it for the render
+        # key of every copy would cost about as much as rendering it
+        self.image_digest = None
+
+    def __getstate__(self):
+        # Copies sent to another process share the layers object, but
+        # render the parts again there
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
 
 
 class SimpleLabel:
@@ -60,6 +272,7 @@ class SimpleLabel:
         counter: int = 0,
         red_support: bool = False,
         code_text: str = '',
+        font_fallback: Optional[Callable[[str, str], List[Tuple[str, str]]]] = None,
     ):
         """Initialize a SimpleLabel object."""
         # Input validation
@@ -98,6 +311,8 @@ class SimpleLabel:
         self._timestamp = timestamp
         self._red_support = red_support
         self._code_text = code_text
+        self._font_fallback = font_fallback
+        self._layers: Optional[LabelLayers] = None
 
     @property
     def label_content(self):
@@ -173,140 +388,162 @@ class SimpleLabel:
 
     def process_templates(self) -> None:
         """Process and replace templates in the text lines."""
-        self.text = copy.deepcopy(self.input_text)
+        self.text = [dict(line) for line in self.input_text]
+        now = None
+
+        def get_now():
+            # Use the same time for all {{datetime}} templates of a label
+            nonlocal now
+            if now is None:
+                now = datetime.datetime.fromtimestamp(self._timestamp) if self._timestamp > 0 else datetime.datetime.now()
+            return now
+
         for line in self.text:
             text_val = line.get('text', '')
             if len(text_val) > WARNING_TEXT_LENGTH:
                 logger.warning(
                     f"Text line is very long (> {WARNING_TEXT_LENGTH} characters), "
                     "this may lead to long processing times.")
-
-            # Replace {{counter[:<start>]}} with current label counter (<start> is
-            # an optional offset defaulting to 1)
-            def counter_replacer(match):
-                offset = int(match.group(1)) if match.group(1) else 1
-                return str(self._counter + offset)
-            text_val = re.sub(r"\{\{counter(?:\:(\d+))?\}\}", counter_replacer, text_val)
-
-            # Replace {{datetime:<format>}} with current datetime formatted as <format>
-            def datetime_replacer(match):
-                fmt = match.group(1)
-                now = datetime.datetime.fromtimestamp(self._timestamp) if self._timestamp > 0 else datetime.datetime.now()
-                return now.strftime(fmt)
-            text_val = re.sub(r"\{\{datetime:([^}]+)\}\}", datetime_replacer, text_val)
-
-            # Replace {{uuid}} with a new UUID
-            if "{{uuid}}" in text_val:
-                ui = uuid.UUID(int=random.getrandbits(128))
-                text_val = text_val.replace("{{uuid}}", str(ui))
-
-            # Replace {{short-uuid}} with a shortened UUID
-            if "{{short-uuid}}" in text_val:
-                ui = uuid.UUID(int=random.getrandbits(128))
-                text_val = text_val.replace("{{short-uuid}}", str(ui)[:8])
-
-            # Replace {{env:<var>}} with the value of the environment variable var
-            def env_replacer(match):
-                var_name = match.group(1)
-                return os.getenv(var_name, "")
-            text_val = re.sub(r"\{\{env:([^}]+)\}\}", env_replacer, text_val)
-
-            # Replace {{random[:<len>][:shift]}} with random string of optional
-            # length <len> and shifting instruction. ":s" is accepted as
-            # shorthand for ":shift"
-            def random_replacer(match):
-                length = int(match.group(1)) if match.group(1) else DEFAULT_RANDOM_LENGTH
-                if match.group(2):
-                    line['shift'] = True
-                return ''.join(random.choices(string.ascii_letters + string.digits + string.punctuation, k=length))
-            text_val = re.sub(r"\{\{random(?:\:(\d+))?(?:\:(s(hift)?))?\}\}", random_replacer, text_val)
-
-            line['text'] = text_val
-
-    def generate(self, rotate: bool = False):
+            template = compile_template(text_val)
+            line['text'] = text_val if template.is_static else template.substitute(self._counter, get_now, line)
+
+    def clone(self, counter: int) -> 'SimpleLabel':
+        """Return a copy of the label with another counter, e.g. for the
+        next copy of a print job. All copies share the rendered code or image
+        and a layer with the lines that do not depend on templates."""
+        if self._layers is None:
+            self._layers = LabelLayers()
+        label = copy.copy(self)
+        label._counter = counter
+        label.text = None
+        return label
+
+    def is_portable(self) -> bool:
+        """Return True if the label renders the same in another process:
+        it draws no random text, which depends on the state of the random
+        number generator, and uses no fallback fonts, which need the
+        installed fonts of this process."""
+        if self._font_fallback is not None:
+            return False
+        for line in self.input_text or []:
+            if 'shift' in line or compile_template(line.get('text', '')).uses_random:
+                return False
+        return True
+
+    def generate(self, rotate: bool = False, canvas_modes: Tuple[str, ...] = ('RGB',)):
+        """Render the label, reusing the image of an identical label if it
+        is still in the render cache.
+
+        ``canvas_modes`` are the image modes the caller accepts, the label is
+        rendered in the smallest one (see :meth:`canvas_mode`)."""
+        key = self.render_key(rotate, canvas_modes)
+        if key is None:
+            return self._render(rotate, canvas_modes)
+        rendered = None
+
+        def render():
+            nonlocal rendered
+            rendered = self._render(rotate, canvas_modes)
+            # Callers may modify the returned image
+            return rendered.copy()
+
+        img = RENDER_CACHE.get_or_create(key, render)
+        if rendered is not None:
+            return rendered
+        self.process_templates()
+        return img.copy()
+
+    def render_key(self, rotate: bool = False, canvas_modes: Tuple[str, ...] = ('RGB',)) -> Optional[str]:
+        """Return a digest of all inputs affecting the rendered label, or
+        None if the label cannot be cached because its text contains
+        templates changing on every rendering."""
+        text = self.input_text or []
+        if not all(compile_template(line.get('text', '')).is_static for line in text):
+            return None
+        inputs = {
+            'size': (self._width, self._height),
+            'content': self._label_content.name,
+            'orientation': self._label_orientation.name,
+            'type': self._label_type.name,
+            'barcode_type': self.barcode_type,
+            'margin': self._label_margin,
+            'fore_color': self._fore_color,
+            'text': text,
+            'qr': (self._qr_size, self._qr_correction),
+            'image': self._image_digest(),
+            'image_settings': (self._image_fit, self._image_crop, self._image_scaling_factor, self._image_rotation),
+            'border': (self._border_thickness, self._border_roundness, self._border_distance, self._border_color),
+            'red_support': self._red_support,
+            'code_text': self._code_text,
+            'font_fallback': self._font_fallback is not None,
+            'fonts': _font_generation,
+            'rotate': rotate,
+            'canvas_modes': canvas_modes,
+        }
+        canonical = json.dumps(inputs, sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def _image_digest(self) -> Optional[str]:
+        img = self._image
+        if img is None:
+            return None
+        layers = self._layers
+        if layers is not None and layers.image_digest is not None and layers.image_digest[0] is img:
+            return layers.image_digest[1]
+        digest = hashlib.sha256(f'{img.mode}:{img.size}'.encode())
+        if img.mode == 'P':
+            digest.update(bytes(img.getpalette() or []))
+        digest.update(img.tobytes())
+        digest = digest.hexdigest()
+        if layers is not None:
+            layers.image_digest = (img, digest)
+        return digest
+
+    def uses_red(self) -> bool:
+        """Return True if any part of the label may be red (or any other
+        color which is not a shade of gray)."""
+        def is_gray(color):
+            return color[0] == color[1] == color[2]
+        if not is_gray(self._fore_color):
+            return True
+        if self._border_thickness > 0 and not is_gray(self._border_color):
+            return True
+        if any(line.get('color') == 'red' for line in self.input_text or []):
+            return True
+        # Whatever the label content says, e.g. red and black images are
+        # sent as IMAGE_BW by some clients
+        return self._image is not None and self._image.mode not in ('1', 'L')
+
+    def canvas_mode(self, img: Optional[Image.Image], draws_text: bool,
+                    canvas_modes: Tuple[str, ...] = NATIVE_CANVAS_MODES) -> str:
+        """Return the smallest of ``canvas_modes`` holding the label without
+        changing how it is printed: '1' for a bilevel image without text,
+        'L' if no red is used and RGB otherwise."""
+        if '1' in canvas_modes and img is not None and img.mode == '1' and not draws_text and \
+                (self._border_thickness == 0 or self._border_color in BILEVEL_COLORS):
+            return '1'
+        if 'L' in canvas_modes and not self.uses_red():
+            return 'L'
+        if 'RGB' in canvas_modes:
+            return 'RGB'
+        raise ValueError(f"Cannot render label in modes {canvas_modes}")
+
+    def _render(self, rotate: bool = False, canvas_modes: Tuple[str, ...] = ('RGB',)):
         # Process possible templates in the text
         self.process_templates()
 
-        # Generate codes or load images if requested
-        if self._label_content in (LabelContent.QRCODE_ONLY, LabelContent.TEXT_QRCODE):
-            if self.barcode_type == "QR":
-                img = self._generate_qr()
-            else:
-                img = self._generate_barcode()
-        elif self._label_content in (LabelContent.IMAGE_BW, LabelContent.IMAGE_GRAYSCALE, LabelContent.IMAGE_RED_BLACK, LabelContent.IMAGE_COLORED):
-            img = self._image
-        else:
-            img = None
+        img, img_width, img_height = self._content_image()
 
         # Initialize dimensions
         width, height = self._width, self._height
         margin_left, margin_right, margin_top, margin_bottom = self._label_margin
 
-        # Resize image to fit if image_fit is True
-        if img is not None:
-            if self._image_crop:
-                img = self._crop_image_to_content(img)
-
-            # First rotate the image if requested
-            if self._image_rotation != 0 and self._image_rotation != 360:
-                img = img.rotate(-self._image_rotation, expand=True, fillcolor="white")
-
-            # Rotation with expand=True may add an empty border around content.
-            if self._image_crop:
-                img = self._crop_image_to_content(img)
-
-            # Resize image to fit if image_fit is True
-            if self._image_fit:
-                # Calculate the maximum allowed dimensions
-                max_width = max(width - margin_left - margin_right, 1)
-                max_height = max(height - margin_top - margin_bottom, 1)
-
-                # Get image dimensions
-                img_width, img_height = img.size
-
-                # Print the original image size
-                logger.debug(f"Maximal allowed dimensions: {max_width}x{max_height} mm")
-                logger.debug(f"Original image size: {img_width}x{img_height} px")
-
-                # Resize the image to fit within the maximum dimensions
-                scale = 1.0
-                if self._label_orientation == LabelOrientation.STANDARD:
-                    if self._label_type in (LabelType.ENDLESS_LABEL,):
-                        # Only width is considered for endless label without rotation
-                        scale = max_width / img_width
-                    else:
-                        # Both dimensions are considered for standard label
-                        scale = min(max_width / img_width, max_height / img_height)
-                else:
-                    if self._label_type in (LabelType.ENDLESS_LABEL,):
-                        # Only height is considered for endless label without rotation
-                        scale = max_height / img_height
-                    else:
-                        # Both dimensions are considered for standard label
-                        scale = min(max_width / img_width, max_height / img_height)
-                logger.debug(f"Scaling image by factor: {scale}")
-                new_size = (int(img_width * scale), int(img_height * scale))
-                logger.debug(f"Resized image size: {new_size} px")
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-                # Update image dimensions
-                img_width, img_height = img.size
-            else:
-                # Use image_scaling_factor if provided
-                img_width, img_height = img.size
-                scale = self._image_scaling_factor / 100.0
-                logger.debug(f"Manual image scaling factor: {scale}")
-                new_size = (int(img_width * scale), int(img_height * scale))
-                logger.debug(f"Resized image size: {new_size} px")
-                img = img.resize(new_size, Image.Resampling.LANCZOS)
-                img_width, img_height = img.size
+        draws_text = self.want_text(img)
+        if draws_text:
+            layout = self._layout_text()
+            textsize = layout.bbox
         else:
-            img_width, img_height = (0, 0)
-
-        if self.want_text(img):
-            bboxes = self._draw_text(None, [])
-            textsize = self._compute_bbox(bboxes)
-        else:
-            bboxes = []
+            layout = None
             textsize = (0, 0, 0, 0)
 
         # Adjust label size for endless label
@@ -359,13 +596,8 @@ class SimpleLabel:
         height = max(int(height), 1)
 
         logger.debug(f"Image resolution: {int(width)} x {int(height)} px")
-        imgResult = Image.new('RGB', (int(width), int(height)), 'white')
-
-        if img is not None:
-            imgResult.paste(img, image_offset)
-
-        if self.want_text(img):
-            self._draw_text(imgResult, bboxes, text_offset)
+        mode = self.canvas_mode(img, draws_text, canvas_modes)
+        imgResult = self._compose((int(width), int(height)), mode, img, image_offset, layout, text_offset)
 
         # Check if the image needs rotation (only applied when generating
         # preview images)
@@ -391,9 +623,181 @@ class SimpleLabel:
                 raise ValueError("Invalid border rectangle")
 
             # Draw (rounded) rectangle
-            draw.rounded_rectangle(rect, radius=self._border_roundness, outline=self._border_color, width=self._border_thickness)
+            draw.rounded_rectangle(rect, radius=self._border_roundness, outline=ink(self._border_color, imgResult.mode), width=self._border_thickness)
         return imgResult
 
+    def _content_image(self):
+        """Generate the code or process the image of the label. Returns
+        ``(img, img_width, img_height)``, img is None for text only labels."""
+        layers = self._layers
+        if layers is not None and layers.content is not None:
+            return layers.content
+
+        # Generate codes or load images if requested
+        if self._label_content in (LabelContent.QRCODE_ONLY, LabelContent.TEXT_QRCODE):
+            if self.barcode_type == "QR":
+                img = self._generate_qr()
+            else:
+                img = self._generate_barcode()
+        elif self._label_content in (LabelContent.IMAGE_BW, LabelContent.IMAGE_GRAYSCALE, LabelContent.IMAGE_RED_BLACK, LabelContent.IMAGE_COLORED):
+            img = self._image
+        else:
+            img = None
+
+        # Initialize dimensions
+        width, height = self._width, self._height
+        margin_left, margin_right, margin_top, margin_bottom = self._label_margin
+
+        # Resize image to fit if image_fit is True
+        if img is not None:
+            if self._image_crop:
+                img = self._crop_image_to_content(img)
+
+            # First rotate the image if requested
+            if self._image_rotation != 0 and self._image_rotation != 360:
+                img = img.rotate(-self._image_rotation, expand=True, fillcolor="white")
+
+            # Rotation with expand=True may add an empty border around content.
+            if self._image_crop:
+                img = self._crop_image_to_content(img)
+
+            # Resize image to fit if image_fit is True
+            if self._image_fit:
+                # Calculate the maximum allowed dimensions
+                max_width = max(width - margin_left - margin_right, 1)
+                max_height = max(height - margin_top - margin_bottom, 1)
+
+                # Get image dimensions
+                img_width, img_height = img.size
+
+                # Print the original image size
+                logger.debug(f"Maximal allowed dimensions: {max_width}x{max_height} mm")
+                logger.debug(f"Original image size: {img_width}x{img_height} px")
+
+                # Resize the image to fit within the maximum dimensions
+                scale = 1.0
+                if self._label_orientation == LabelOrientation.STANDARD:
+                    if self._label_type in (LabelType.ENDLESS_LABEL,):
+                        # Only width is considered for endless label without rotation
+                        scale = max_width / img_width
+                    else:
+                        # Both dimensions are considered for standard label
+                        scale = min(max_width / img_width, max_height / img_height)
+                else:
+                    if self._label_type in (LabelType.ENDLESS_LABEL,):
+                        # Only height is considered for endless label without rotation
+                        scale = max_height / img_height
+                    else:
+                        # Both dimensions are considered for standard label
+                        scale = min(max_width / img_width, max_height / img_height)
+                logger.debug(f"Scaling image by factor: {scale}")
+                new_size = (int(img_width * scale), int(img_height * scale))
+                logger.debug(f"Resized image size: {new_size} px")
+                img = img.resize(new_size, Image.Resampling.LANCZOS)
+                # Update image dimensions
+                img_width, img_height = img.size
+            else:
+                # Use image_scaling_factor if provided
+                img_width, img_height = img.size
+                scale = self._image_scaling_factor / 100.0
+                logger.debug(f"Manual image scaling factor: {scale}")
+                new_size = (int(img_width * scale), int(img_height * scale))
+                logger.debug(f"Resized image size: {new_size} px")
+                img = img.resize(new_size, Image.Resampling.LANCZOS)
+                img_width, img_height = img.size
+        else:
+            img_width, img_height = (0, 0)
+
+        if layers is not None and self._content_is_static():
+            layers.content = (img, img_width, img_height)
+        return img, img_width, img_height
+
+    def _compose(self, size, mode, img, image_offset, layout, text_offset):
+        """Paste the image and paint the text (if there is a layout) on a new
+        canvas. Copies sharing layers reuse a canvas holding all parts which
+        are the same for each copy and only paint the changing lines."""
+        dynamic = None
+        if self._layers is not None and layout is not None:
+            dynamic = self._dynamic_lines(layout)
+        if dynamic is None:
+            canvas = self._new_canvas(size, mode, img, image_offset)
+            if layout is not None:
+                self._paint_text(canvas, layout.lines, layout, text_offset)
+            return canvas
+
+        dynamic_ids = {id(line_layout) for line_layout in dynamic}
+        static = [line_layout for line_layout in layout.lines if id(line_layout) not in dynamic_ids]
+        # Static lines move if the extents of the text change
+        key = (size, mode, image_offset, text_offset, layout.min_x, layout.max_x,
+               tuple((line_layout.x, line_layout.y, line_layout.bbox) for line_layout in static))
+        base = self._layers.base
+        if base is None or base[0] != key:
+            canvas = self._new_canvas(size, mode, img, image_offset)
+            self._paint_text(canvas, static, layout, text_offset)
+            base = self._layers.base = (key, canvas)
+        canvas = base[1].copy()
+        self._paint_text(canvas, dynamic, layout, text_offset)
+        return canvas
+
+    @staticmethod
+    def _new_canvas(size, mode, img, image_offset):
+        canvas = Image.new(mode, size, 'white')
+        if img is not None:
+            canvas.paste(img, image_offset)
+        return canvas
+
+    def _dynamic_lines(self, layout: 'TextLayout') -> Optional[List['LineLayout']]:
+        """Return the lines whose text changes between copies, or None if
+        they cannot be painted separately from the rest of the label: when
+        nothing changes, the code changes or a changing line is inverted,
+        shifted or overlaps another line."""
+        if not self._content_is_static():
+            return None
+        dynamic = []
+        bands = []
+        for line_layout, line in zip(layout.lines, self.input_text):
+            is_dynamic = not compile_template(line.get('text', '')).is_static
+            if is_dynamic:
+                if line_layout.line.get('inverted') or 'shift' in line_layout.line:
+                    return None
+                dynamic.append(line_layout)
+            bands.append(self._line_band(line_layout) + (is_dynamic,))
+        if not dynamic:
+            return None
+
+        # Lines are painted in a different order, so static and dynamic lines
+        # must not touch the same pixels
+        bands.sort()
+        bottoms = {True: float('-inf'), False: float('-inf')}
+        for top, bottom, is_dynamic in bands:
+            if top <= bottoms[not is_dynamic]:
+                return None
+            bottoms[is_dynamic] = max(bottoms[is_dynamic], bottom)
+        return dynamic
+
+    @staticmethod
+    def _line_band(line_layout: 'LineLayout') -> Tuple[float, float]:
+        """Vertical range painted by a line relative to the text offset,
+        with a pixel of tolerance for fractional offsets."""
+        line = line_layout.line
+        top, bottom = line_layout.ink[1], line_layout.ink[3]
+        if line.get('inverted'):
+            shift = 0.1 * int(line['size'])
+            top = min(top, line_layout.bbox[1] - shift)
+            bottom = max(bottom, line_layout.bbox[3] - shift)
+        if line.get('checkbox'):
+            top = min(top, line_layout.y)
+            bottom = max(bottom, line_layout.y + 8 * int(line['size']) // 10)
+        return (top - 1, bottom + 1)
+
+    def _content_is_static(self) -> bool:
+        """Return True if the code or image is the same for all copies."""
+        if self._label_content in (LabelContent.QRCODE_ONLY, LabelContent.TEXT_QRCODE) and not self._code_text:
+            # QR codes contain all lines of text, barcodes the first one
+            lines = (self.input_text or [])[:None if self.barcode_type == "QR" else 1]
+            return all(compile_template(line.get('text', '')).is_static for line in lines)
+        return True
+
     @staticmethod
     def _crop_image_to_content(img: Image.Image) -> Image.Image:
         """Trim uniform border/background from an image.
@@ -445,14 +849,13 @@ class SimpleLabel:
         qr_img = qr.make_image(fill_color=fill_color, back_color="white")
         return qr_img
 
-    def _draw_text(self, img = None, bboxes = [], text_offset = (0, 0)):
+    def _layout_text(self) -> 'TextLayout':
         """
-        Returns a list of bounding boxes for each line, so each line can use a different font.
+        Measure all lines of text once, so each line can use a different font.
+        Returns the layout holding the position of each line.
         """
-        do_draw = img is not None
-        if not do_draw:
-            img = Image.new('L', (20, 20), 'white')
-        draw = ImageDraw.Draw(img)
+        draw = ImageDraw.Draw(Image.new('L', (20, 20), 'white'))
+        lines = []
         y = 0
 
         # Iterate over lines of text
@@ -464,128 +867,173 @@ class SimpleLabel:
             font = self._get_font(line['path'], line['size'])
 
             # Determine anchors
-            anchor = None
             align = line.get('align', 'center')
+            if align not in TEXT_ANCHORS:
+                raise ValueError(f"Unsupported alignment: {align}")
+
+            INVERT_LINE = 'inverted' in line and line['inverted']
+
+            # Fonts for characters missing in the selected font
+            runs = self._get_runs(line)
 
-            # Left aligned text
-            if align == "left":
-                anchor = "lt"
-            # Center aligned text
-            elif align == "center":
-                anchor = "mt"
-            # Right aligned text
-            elif align == "right":
-                anchor = "rt"
-            # else: error
+            # Get bbox of the text
+            if runs:
+                bbox = self._runs_bbox(draw, runs, (0, y), "lt")
             else:
-                raise ValueError(f"Unsupported alignment: {align}")
+                bbox = self._text_bbox(draw, (0, y), line['text'], line, font, "lt")
+            ink = bbox
+
+            # Ensure consistent line heights for each line except the last
+            # one (where it is not needed). We still need this when
+            # inverting text to ensure the inversion box is large enough to
+            # hold the entire text
+            IS_LAST_LINE = i == len(self.text) - 1
+            if not IS_LAST_LINE or INVERT_LINE:
+                # Some characters may need special height
+                top, bottom = self._line_extents(draw, line, font)
+                # Get bbox with width of text and dummy height
+                bbox = (bbox[0], y + top, bbox[2], y + bottom)
+            lines.append(LineLayout(line, font, runs, align, spacing, bbox, ink, y))
+            y += bbox[3] - bbox[1] + (spacing if i < len(self.text)-1 else 0)
+
+        return TextLayout(lines)
+
+    def _paint_text(self, img: Image.Image, lines: List['LineLayout'], layout: 'TextLayout', text_offset = (0, 0)):
+        """Draw lines of a layout computed by :meth:`_layout_text`."""
+        draw = ImageDraw.Draw(img)
+        for line_layout in lines:
+            line = line_layout.line
+            font = line_layout.font
+            runs = line_layout.runs
+            align = line_layout.align
+            anchor = TEXT_ANCHORS[align]
+            spacing = line_layout.spacing
+            bbox = line_layout.bbox
 
             red_font = 'color' in line and line['color'] == 'red'
 #            if red_font and not self._red_support:
 #                raise ValueError("Red font is not supported on this label")
-            color = (255, 0, 0) if red_font else (0, 0, 0)
+            color = ink((255, 0, 0) if red_font else (0, 0, 0), img.mode)
 
             # Draw checkbox if needed
             checkbox = line.get('checkbox', False)
 
             INVERT_LINE = 'inverted' in line and line['inverted']
-            if do_draw and INVERT_LINE:
+            if INVERT_LINE:
                 # Draw a filled rectangle
-                center_x = 0
                 if anchor == "lt":
-                    min_bbox_x = text_offset[0] + min(bbox[0][0] for bbox in bboxes)
-                    max_bbox_x = text_offset[0] + bboxes[i][0][2] # max(bbox[0][2] for bbox in bboxes)
+                    min_bbox_x = text_offset[0] + layout.min_x
+                    max_bbox_x = text_offset[0] + bbox[2]
                 elif anchor == "mt":
-                    min_bbox_x = min(bbox[0][0] for bbox in bboxes)
-                    max_bbox_x = max(bbox[0][2] for bbox in bboxes)
-                    center_x = (min_bbox_x + max_bbox_x) // 2
-                    min_bbox_x = text_offset[0] + center_x - (bboxes[i][0][2] - bboxes[i][0][0]) // 2
-                    max_bbox_x = text_offset[0] + center_x + (bboxes[i][0][2] - bboxes[i][0][0]) // 2
+                    min_bbox_x = text_offset[0] + layout.center_x - (bbox[2] - bbox[0]) // 2
+                    max_bbox_x = text_offset[0] + layout.center_x + (bbox[2] - bbox[0]) // 2
                 elif anchor == "rt":
-                    max_bbox_x = text_offset[0] + max(bbox[0][2] for bbox in bboxes)
-                    min_bbox_x = max_bbox_x - (bboxes[i][0][2] - bboxes[i][0][0])
+                    max_bbox_x = text_offset[0] + layout.max_x
+                    min_bbox_x = max_bbox_x - (bbox[2] - bbox[0])
                 shift = 0.1 * int(line['size'])
-                y_min = bboxes[i][0][1] + text_offset[1] - shift
-                y_max = bboxes[i][0][3] + text_offset[1] - shift
+                y_min = bbox[1] + text_offset[1] - shift
+                y_max = bbox[3] + text_offset[1] - shift
                 draw.rectangle((min_bbox_x, y_min, max_bbox_x, y_max), fill=color)
                 # Overwrite font color with white on colored background
-                color = (255, 255, 255)
-
-            # Either calculate bbox or actually draw
-            if not do_draw:
-                # Get bbox of the text
-                bbox = draw.textbbox((0, y), line['text'], font=font, align=align, anchor="lt")
-
-                # Ensure consistent line heights for each line except the last
-                # one (where it is not needed). We still need this when
-                # inverting text to ensure the inversion box is large enough to
-                # hold the entire text
-                IS_LAST_LINE = i == len(self.text) - 1
-                if not IS_LAST_LINE or INVERT_LINE:
-                    # Some characters may need special height
-                    all_characters = ''.join(string.ascii_letters + string.digits + string.punctuation)
-                    Ag = draw.textbbox((0, y), all_characters, font, anchor="lt")
-                    # Get bbox with width of text and dummy height
-                    bbox = (bbox[0], Ag[1], bbox[2], Ag[3])
-                bboxes.append((bbox, y))
-                y += bbox[3] - bbox[1] + (spacing if i < len(self.text)-1 else 0)
-            else:
-                bbox = bboxes[i][0]
-                y = bboxes[i][1] + text_offset[1]
-                # Left aligned text
-                if align == "left":
-                    min_bbox_x = min(bbox[0][0] for bbox in bboxes) if len(bboxes) > 0 else 0
-                    x = min_bbox_x + text_offset[0]
-                # Center aligned text
-                elif align == "center":
-                    min_bbox_x = min(bbox[0][0] for bbox in bboxes) if len(bboxes) > 0 else 0
-                    max_bbox_x = max(bbox[0][2] for bbox in bboxes) if len(bboxes) > 0 else 0
-                    x = (max_bbox_x - min_bbox_x) // 2 + min_bbox_x + text_offset[0]
-                # Right aligned text
-                elif align == "right":
-                    max_bbox_x = max(bbox[0][2] for bbox in bboxes) if len(bboxes) > 0 else 0
-                    x = max_bbox_x + text_offset[0]
-
-                # Draw checkbox if needed
-                if checkbox:
-                    checkbox_box_dimensions = 8 * int(line['size']) // 10
-                    bbox = draw.textbbox((x - 1.2 * checkbox_box_dimensions, y), line['text'], font=font, align=align, anchor=anchor)
-                    box_dimensions = bbox[0], y, bbox[0] + checkbox_box_dimensions, y + checkbox_box_dimensions
-                    draw.rounded_rectangle(box_dimensions, radius=5, outline=color, width=max(1, checkbox_box_dimensions//10), fill=(255,255,255))
+                color = ink((255, 255, 255), img.mode)
 
+            y = line_layout.y + text_offset[1]
+            x = line_layout.x + text_offset[0]
+
+            # Draw checkbox if needed
+            if checkbox:
+                checkbox_box_dimensions = 8 * int(line['size']) // 10
+                checkbox_xy = (x - 1.2 * checkbox_box_dimensions, y)
+                if runs:
+                    bbox = self._runs_bbox(draw, runs, checkbox_xy, anchor)
+                else:
+                    bbox = draw.textbbox(checkbox_xy, line['text'], font=font, align=align, anchor=anchor)
+                box_dimensions = bbox[0], y, bbox[0] + checkbox_box_dimensions, y + checkbox_box_dimensions
+                draw.rounded_rectangle(box_dimensions, radius=5, outline=color, width=max(1, checkbox_box_dimensions//10), fill=ink((255, 255, 255), img.mode))
+
+            if runs:
+                for origin, (text, run_font) in zip(self._run_origins(runs, (x, y), anchor), runs):
+                    draw.text(origin, text, color, font=run_font, anchor="ls")
+            else:
                 draw.text((x, y), line['text'], color, font=font, anchor=anchor, align=align, spacing=spacing)
 
-                # Shift text around if requested
-                if "shift" in line:
-                    def get_shift_amount():
-                        return 0.03 * random.randint(5, 10) * int(line['size'])
-                    for x_shift in [-get_shift_amount(), get_shift_amount()]:
-                        for y_shift in [-get_shift_amount(), get_shift_amount()]:
-                            new_random_text = ''.join(random.choices(string.ascii_letters + string.digits + string.punctuation, k=len(line['text'])))
-                            draw.text((x + x_shift, y + y_shift), new_random_text, color, font=font, anchor=anchor, align=align, spacing=spacing)
-
-        # Return total bbox
-        # each in form (x0, y0, x1, y1)
-        return bboxes
-
-    def _compute_bbox(self, bboxes):
-        # Edge case: No text
-        if not bboxes:
-            return (0, 0, 0, 0)
-        # Iterate over right margins of multiple text lines and find the maximum
-        # width needed to fit all lines of text
-        max_width = max(bbox[0][2] for bbox in bboxes)
-        return (bboxes[0][0][0], bboxes[0][0][1], max_width, bboxes[-1][0][3])
+            # Shift text around if requested
+            if "shift" in line:
+                def get_shift_amount():
+                    return 0.03 * random.randint(5, 10) * int(line['size'])
+                for x_shift in [-get_shift_amount(), get_shift_amount()]:
+                    for y_shift in [-get_shift_amount(), get_shift_amount()]:
+                        new_random_text = ''.join(random.choices(RANDOM_CHARACTERS, k=len(line['text'])))
+                        draw.text((x + x_shift, y + y_shift), new_random_text, color, font=font, anchor=anchor, align=align, spacing=spacing)
+
+    @staticmethod
+    def _text_bbox(draw, xy, text, line, font, anchor):
+        """Bounding box of ``text`` drawn in the font of ``line`` at the
+        integer position ``xy``. Boxes are measured once at the origin and
+        shifted, Pillow only uses the fractional part of the position."""
+        align = line.get('align', 'center')
+        key = (line['path'], int(line['size']), text, anchor, align, draw.fontmode)
+        bbox = TEXT_BBOX_CACHE.get_or_create(
+            key, lambda: draw.textbbox((0, 0), text, font=font, align=align, anchor=anchor))
+        x, y = xy
+        return (bbox[0] + x, bbox[1] + y, bbox[2] + x, bbox[3] + y)
+
+    @staticmethod
+    def _line_extents(draw, line, font):
+        """Return the vertical extents ``(top, bottom)`` relative to the
+        line position shared by all lines using the font of ``line``. They
+        are measured once per font and size."""
+        key = (line['path'], int(line['size']), draw.fontmode)
+
+        def measure():
+            bbox = draw.textbbox((0, 0), LINE_HEIGHT_CHARACTERS, font=font, anchor="lt")
+            return (bbox[1], bbox[3])
+
+        return LINE_EXTENTS_CACHE.get_or_create(key, measure)
+
+    def _get_runs(self, line):
+        """Split the text of a line into ``(text, font)`` runs using fallback
+        fonts for glyphs missing in the selected font. Returns None if the
+        line is rendered with the selected font only."""
+        if self._font_fallback is None:
+            return None
+        runs = self._font_fallback(line['text'], line['path'])
+        if not runs or (len(runs) == 1 and runs[0][1] == line['path']):
+            return None
+        return [(text, self._get_font(path, line['size'])) for text, path in runs]
+
+    @staticmethod
+    def _run_origins(runs, xy, anchor):
+        """Return the origins of runs drawn next to each other as if they
+        were a single text drawn at ``xy`` with ``anchor``. All runs share one
+        baseline, origins use the "ls" anchor."""
+        x, y = xy
+        width = sum(font.getlength(text) for text, font in runs)
+        if anchor[0] == "m":
+            x -= width / 2
+        elif anchor[0] == "r":
+            x -= width
+        # "t" anchors at the top of the inked text, not the font ascender
+        baseline = y - min(font.getbbox(text, anchor="ls")[1] for text, font in runs)
+        origins = []
+        for text, font in runs:
+            origins.append((x, baseline))
+            x += font.getlength(text)
+        return origins
+
+    def _runs_bbox(self, draw, runs, xy, anchor):
+        """Bounding box of runs drawn at ``xy``, see :meth:`_run_origins`."""
+        boxes = [draw.textbbox(origin, text, font=font, anchor="ls")
+                 for origin, (text, font) in zip(self._run_origins(runs, xy, anchor), runs)]
+        return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+                max(box[2] for box in boxes), max(box[3] for box in boxes))
 
     def _get_font(self, font_path: str, size: int) -> ImageFont.FreeTypeFont:
         """Get a font object, using cache for performance."""
-        key = (font_path, size)
-        if key in FONT_CACHE:
-            return FONT_CACHE[key]
         try:
-            font = ImageFont.truetype(font_path, int(size))
-            FONT_CACHE[key] = font
-            return font
+            # Sizes arrive as int or str, normalize them to share cache entries
+            key = (font_path, int(size))
+            return FONT_CACHE.get_or_create(key, lambda: ImageFont.truetype(font_path, key[1]))
         except Exception as e:
             logger.error(f"Failed to load font '{font_path}' with size {size}: {e}")
             return ImageFont.load_default()
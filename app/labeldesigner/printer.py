@@ -1,22 +1,50 @@
 import logging
 import os
 import time
+import queue
 import datetime
+import threading
+import multiprocessing
+from typing import Callable, Optional
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from brother_ql.backends.helpers import send
 from brother_ql import BrotherQLRaster, create_label
 from brother_ql.backends.helpers import get_status
+from brother_ql.reader import interpret_response
 from brother_ql.backends import backend_factory, guess_backend
 from flask import Config
-from .label import LabelOrientation, LabelType, LabelContent
+from .label import LabelOrientation, LabelType, LabelContent, NATIVE_CANVAS_MODES
+from .connections import CONNECTIONS
 from brother_ql.models import ALL_MODELS
 
 SIMULATED_LABELS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'simulated_labels')
 
-# Default maximum number of labels to rasterize and send in a single batch.
-# Sending too many labels at once can cause printer timeouts/failures.
-# Override via PRINT_BATCH_SIZE environment variable or Flask config.
+# Number of labels rasterized and sent in the first batches of a job, until
+# the throughput of the printer is known. Sending too many labels at once
+# can cause printer timeouts/failures. The PRINT_BATCH_SIZE environment
+# variable sets a fixed batch size instead.
 DEFAULT_BATCH_SIZE = 5
 
+# Without a fixed batch size, batches hold as many labels as the printer
+# is expected to print in TARGET_BATCH_SECONDS, judged by the raster bytes
+# per label and the bytes per second of the batches sent so far. send()
+# gives up after 10 seconds.
+MIN_BATCH_SIZE = 1
+MAX_BATCH_SIZE = 50
+TARGET_BATCH_SECONDS = 4
+
+# Default number of processes rasterizing the labels of a batch. With a
+# single worker all labels are rasterized on the calling thread.
+DEFAULT_RASTER_WORKERS = 1
+
+# Number of rasterized batches waiting to be sent while the next batch is
+# rasterized
+PIPELINE_DEPTH = 1
+
+# Seconds to wait for the printer to report the end of a streamed batch
+STREAM_STATUS_TIMEOUT = 10
+
 logger = logging.getLogger(__name__)
 
 # Experimentally identified MAC address prefixes for Brother network printers
@@ -26,12 +54,248 @@ BROTHER_MAC_ADDRESS_PREFIXES = [
 ]
 
 
+_raster_pool = None
+_raster_pool_workers = 0
+_raster_pool_lock = threading.Lock()
+
+
+def get_raster_pool(workers: int) -> ProcessPoolExecutor:
+    """Return the process pool shared by all print jobs, created on first
+    use. Workers are spawned rather than forked, as forking a server with
+    running threads could copy locks held by them."""
+    global _raster_pool, _raster_pool_workers
+    with _raster_pool_lock:
+        if _raster_pool is None or _raster_pool_workers != workers:
+            if _raster_pool is not None:
+                _raster_pool.shutdown(wait=False)
+            _raster_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _raster_pool_workers = workers
+        return _raster_pool
+
+
+def _discard_raster_pool(pool: ProcessPoolExecutor):
+    """Drop a broken pool, e.g. after a worker was killed, so the next print
+    job starts new workers."""
+    global _raster_pool
+    with _raster_pool_lock:
+        if _raster_pool is pool:
+            _raster_pool = None
+    pool.shutdown(wait=False)
+
+
+def rasterize_entry(qlr: BrotherQLRaster, label_size: str, entry: dict):
+    """Render the label of a queue entry and append its raster data to
+    ``qlr``. Returns the rendered image."""
+    label = entry['label']
+    high_res = entry['high_res']
+    if label.label_type == LabelType.ENDLESS_LABEL:
+        rotate = 0 if label.label_orientation == LabelOrientation.STANDARD else 90
+    else:
+        rotate = 'auto'
+    # brother_ql halves 600 dpi images with a filter which would not
+    # be applied to 1-bit images
+    canvas_modes = NATIVE_CANVAS_MODES[1:] if high_res else NATIVE_CANVAS_MODES
+    img = label.generate(rotate=False, canvas_modes=canvas_modes)
+    dither = label.label_content != LabelContent.IMAGE_BW
+    create_label(
+        qlr,
+        img,
+        label_size,
+        red='red' in str(label_size),
+        dither=dither,
+        cut=entry['cut'],
+        dpi_600=high_res,
+        rotate=rotate
+    )
+    return img
+
+
+def _rasterize_chunk(model: str, label_size: str, entries: list, keep_images: bool):
+    """Rasterize queue entries in a worker process. Returns a list of
+    ``(raster data, image)`` tuples, image is None unless requested."""
+    results = []
+    for entry in entries:
+        qlr = BrotherQLRaster(model)
+        img = rasterize_entry(qlr, label_size, entry)
+        results.append((qlr.data, img if keep_images else None))
+    return results
+
+
+class BatchSizer:
+    """Chooses the number of labels of each batch. Batches start with
+    DEFAULT_BATCH_SIZE labels until the first batch was sent. A sizer is
+    kept per printer, so jobs start with the throughput measured by the
+    previous ones. With ``min_size == max_size`` every batch has that
+    size."""
+
+    def __init__(self, min_size: int = MIN_BATCH_SIZE, max_size: int = MAX_BATCH_SIZE,
+                 target_seconds: Optional[float] = None):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = TARGET_BATCH_SECONDS if target_seconds is None else target_seconds
+        # Moving averages of the raster bytes per label and the bytes per
+        # second sent to the printer
+        self.label_bytes: Optional[float] = None
+        self.throughput: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _average(average: Optional[float], value: float) -> float:
+        return value if average is None else (average + value) / 2
+
+    def next_size(self) -> int:
+        with self._lock:
+            if self.throughput is None or not self.label_bytes:
+                size = DEFAULT_BATCH_SIZE
+            else:
+                size = int(self.throughput * self.target_seconds / self.label_bytes)
+        return max(self.min_size, min(self.max_size, size))
+
+    def rasterized(self, labels: int, size: int):
+        """Record the raster data size of ``labels`` labels."""
+        if labels:
+            with self._lock:
+                self.label_bytes = self._average(self.label_bytes, size / labels)
+
+    def sent(self, size: int, seconds: float):
+        """Record a batch of ``size`` bytes the printer took ``seconds`` to
+        receive and print."""
+        if seconds > 0:
+            with self._lock:
+                self.throughput = self._average(self.throughput, size / seconds)
+
+
+class RasterStream:
+    """
+    Raster instructions written to a printer label by label as they are
+    produced, instead of collecting a whole batch in a BrotherQLRaster
+    first. :meth:`finish` waits for the printer like ``send()`` of
+    brother_ql.
+    """
+
+    def __init__(self, device_specifier):
+        self.network = isinstance(device_specifier, str) and device_specifier.startswith('tcp://')
+        if self.network:
+            # The persistent connection to the printer is used instead
+            self.connection = CONNECTIONS.acquire(device_specifier)
+            self.printer = None
+        else:
+            self.connection = None
+            self.printer = get_printer(device_specifier)
+        self.bytes_written = 0
+        self._failed = False
+
+    def write(self, data: bytes, img=None):
+        try:
+            if self.connection is not None:
+                self.connection.write(data)
+            else:
+                self.printer.write(data)
+        except Exception:
+            self._failed = True
+            raise
+        self.bytes_written += len(data)
+
+    def finish(self) -> dict:
+        """Wait until the printer reports the end of the job. Returns a
+        status dict with the keys of the one returned by ``send()``."""
+        status = {
+            'instructions_sent': True,
+            'outcome': 'sent',
+            'printer_state': None,
+            'did_print': False,
+            'ready_for_next_job': False,
+        }
+        if self.network:
+            # The network backend does not support reading back the state
+            return status
+
+        # Unlike send() the timeout starts after the last label, as writing
+        # spans the time needed to rasterize all labels
+        start = time.time()
+        while time.time() - start < STREAM_STATUS_TIMEOUT:
+            data = self.printer.read()
+            if not data:
+                time.sleep(0.005)
+                continue
+            try:
+                result = interpret_response(data)
+            except ValueError:
+                logger.error("Couldn't understand printer response: %s", data)
+                continue
+            status['printer_state'] = result
+            if result['errors']:
+                logger.error('Errors occured: %s', result['errors'])
+                status['outcome'] = 'error'
+                break
+            if result['status_type'] == 'Printing completed':
+                status['did_print'] = True
+                status['outcome'] = 'printed'
+            if result['status_type'] == 'Phase change' and result['phase_type'] == 'Waiting to receive':
+                status['ready_for_next_job'] = True
+            if status['did_print'] and status['ready_for_next_job']:
+                break
+        return status
+
+    def close(self):
+        if self.connection is not None:
+            CONNECTIONS.release(self.connection, discard=self._failed)
+            self.connection = None
+        else:
+            self.printer.dispose()
+
+
+class SimulatedRasterStream:
+    """Stream to the simulator, saving each label as PNG as it arrives."""
+
+    def __init__(self, batch_index: int):
+        self.batch_index = batch_index
+        self.bytes_written = 0
+        self._timestamp = datetime.datetime.now(datetime.UTC).strftime('%Y%m%d_%H%M%S_%f')
+        self._count = 0
+        os.makedirs(SIMULATED_LABELS_DIR, exist_ok=True)
+
+    def write(self, data: bytes, img=None):
+        self.bytes_written += len(data)
+        if img is not None:
+            path = os.path.join(SIMULATED_LABELS_DIR, f'{self._timestamp}_b{self.batch_index}_{self._count}.png')
+            img.save(path, format='PNG')
+            logger.info('Saved simulated label to %s', path)
+        self._count += 1
+
+    def finish(self) -> dict:
+        return {'instructions_sent': True, 'outcome': 'printed', 'printer_state': None,
+                'did_print': True, 'ready_for_next_job': True}
+
+    def close(self):
+        pass
+
+
 class PrinterQueue:
-    def __init__(self, model, device_specifier, label_size):
+    def __init__(self, model, device_specifier, label_size, workers: int = DEFAULT_RASTER_WORKERS,
+                 streaming: bool = False):
         self.model = model
         self.device_specifier = device_specifier
         self.label_size = label_size
+        # Processes rasterizing the labels of a batch, 0 uses all CPU cores
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        # Write each label to the printer as soon as it is rasterized
+        self.streaming = streaming
         self._print_queue = []
+        # Raster data and image of the last rasterized static label by
+        # raster_key(), reused for its copies
+        self._rasters = {}
+
+    def __len__(self) -> int:
+        return len(self._print_queue)
+
+    @property
+    def is_simulation(self) -> bool:
+        return isinstance(self.device_specifier, str) and self.device_specifier in ['simulation', '?']
+
+    @property
+    def is_network(self) -> bool:
+        return isinstance(self.device_specifier, str) and self.device_specifier.startswith('tcp://')
 
     def add_label_to_queue(self, label, cut: bool = True, high_res: bool = False):
         self._print_queue.append({
@@ -40,42 +304,123 @@ class PrinterQueue:
             'high_res': high_res
         })
 
+    def drop_labels(self, count: int):
+        """Remove the first ``count`` labels, e.g. those already printed
+        before a job was interrupted."""
+        del self._print_queue[:count]
+
+    @staticmethod
+    def raster_key(entry: dict) -> Optional[tuple]:
+        """Return a key which is equal for entries rasterizing to the same
+        data, or None if the label changes on every rendering."""
+        key = entry['label'].render_key(False, NATIVE_CANVAS_MODES)
+        if key is None:
+            return None
+        return key, entry['cut'], entry['high_res']
+
+    def _store_raster(self, key: Optional[tuple], data: bytes, img):
+        if key is None:
+            return
+        # Copies of a label are queued one after another, only the copies
+        # of the last label (with and without cut) are kept
+        if any(other[0] != key[0] for other in self._rasters):
+            self._rasters.clear()
+        self._rasters[key] = (data, img)
+
     def _rasterize_entries(self, entries):
         """Rasterize a list of queue entries into a BrotherQLRaster and
         return ``(qlr, generated_images)``."""
         qlr = BrotherQLRaster(self.model)
         generated_images = []
-        is_simulation = isinstance(self.device_specifier, str) and self.device_specifier in ['simulation', '?']
-        for entry in entries:
-            label = entry['label']
-            cut = entry['cut']
-            high_res = entry['high_res']
-            if label.label_type == LabelType.ENDLESS_LABEL:
-                rotate = 0 if label.label_orientation == LabelOrientation.STANDARD else 90
-            else:
-                rotate = 'auto'
-            img = label.generate(rotate=False)
-            if is_simulation:
+        parts = []
+        for data, img in self._iter_rasterized(entries, self.is_simulation):
+            parts.append(data)
+            if img is not None:
                 generated_images.append(img)
-            dither = label.label_content != LabelContent.IMAGE_BW
-            create_label(
-                qlr,
-                img,
-                self.label_size,
-                red='red' in str(self.label_size),
-                dither=dither,
-                cut=cut,
-                dpi_600=high_res,
-                rotate=rotate
-            )
+        qlr.data = b''.join(parts)
         return qlr, generated_images
 
+    def _iter_rasterized(self, entries, keep_images: bool):
+        """Yield ``(raster data, image)`` for each entry in order, image is
+        None unless requested.
+
+        With several workers, runs of consecutive portable labels are
+        rasterized in worker processes and all other labels on this thread,
+        in order, so labels with random text draw the same values as when
+        rasterized serially. The raster data of each label is
+        self-contained, so joining it in order gives the same data as a
+        single BrotherQLRaster.
+
+        Copies of a static label reuse the raster data of the first one
+        instead of being rendered and rasterized again."""
+        keys = [self.raster_key(entry) for entry in entries]
+        repeats = set()
+        seen = set(self._rasters)
+        for index, key in enumerate(keys):
+            if key in seen:
+                repeats.add(index)
+            elif key is not None:
+                seen.add(key)
+        futures = {}
+        if self.workers > 1 and len(entries) - len(repeats) > 1:
+            pool = get_raster_pool(self.workers)
+            for chunk in self._pool_chunks(entries, repeats):
+                future = pool.submit(_rasterize_chunk, self.model, self.label_size,
+                                     [entries[index] for index in chunk], keep_images)
+                futures[chunk[0]] = (chunk, pool, future)
+        results = {}
+        for index, entry in enumerate(entries):
+            if index in futures:
+                chunk, pool, future = futures.pop(index)
+                try:
+                    chunk_results = future.result()
+                except BrokenProcessPool as e:
+                    logger.warning('Raster worker process died, rasterizing on this thread: %s', e)
+                    _discard_raster_pool(pool)
+                    chunk_results = _rasterize_chunk(self.model, self.label_size,
+                                                     [entries[i] for i in chunk], keep_images)
+                results.update(zip(chunk, chunk_results))
+            key = keys[index]
+            if index in repeats and key in self._rasters:
+                data, img = self._rasters[key]
+                yield data, img if keep_images else None
+                continue
+            if index in results:
+                data, img = results.pop(index)
+            else:
+                qlr = BrotherQLRaster(self.model)
+                img = rasterize_entry(qlr, self.label_size, entry)
+                data = qlr.data
+            self._store_raster(key, data, img)
+            yield data, img if keep_images else None
+
+    def _pool_chunks(self, entries, repeats=frozenset()):
+        """Split the indices of portable entries into runs of consecutive
+        entries, at most one run per worker for a batch of portable labels.
+        Entries in ``repeats`` reuse earlier raster data and are skipped."""
+        chunk_size = -(-(len(entries) - len(repeats)) // self.workers)
+        chunks = []
+        chunk = []
+        for index, entry in enumerate(entries):
+            if index in repeats:
+                continue
+            if entry['label'].is_portable():
+                chunk.append(index)
+                if len(chunk) < chunk_size:
+                    continue
+            if chunk:
+                chunks.append(chunk)
+                chunk = []
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
     def _send_raster(self, qlr, generated_images, batch_index=0) -> str:
         """Send rasterized data to the printer or simulator.
         Returns an empty string on success, or an error message."""
         try:
             # Simulator: pretend we sent data, save labels as PNG, and return success
-            if isinstance(self.device_specifier, str) and self.device_specifier in ['simulation', '?']:
+            if self.is_simulation:
                 logger.info('Simulated sending %d bytes to simulator printer (batch %d)',
                             len(qlr.data), batch_index)
                 os.makedirs(SIMULATED_LABELS_DIR, exist_ok=True)
@@ -86,49 +431,190 @@ class PrinterQueue:
                     logger.info('Saved simulated label to %s', path)
                 return ""
 
-            network_printer = isinstance(self.device_specifier, str) and self.device_specifier.startswith('tcp://')
             logger.info("Sending %d bytes to printer at %s (batch %d)",
                         len(qlr.data), self.device_specifier, batch_index)
-            info = send(qlr.data, self.device_specifier)
+            if self.is_network:
+                # Keeps the connection open for the next batch, unlike send()
+                CONNECTIONS.send(self.device_specifier, qlr.data)
+                info = {'instructions_sent': True, 'outcome': 'sent'}
+            else:
+                info = send(qlr.data, self.device_specifier)
             logger.info('Sent %d bytes to printer %s', len(qlr.data), self.device_specifier)
-            if network_printer:
-                logger.info('Network printer does not provide status information.')
-                return ""
-            logger.info('Printer response: %s', str(info))
-            if info.get('did_print') and info.get('ready_for_next_job'):
-                logger.info('Label printed successfully and printer is ready for next job')
-                return ""
-            logger.warning("Failed to print label (batch %d)", batch_index)
-            return f"Failed to print label (batch {batch_index})"
+            return self._check_printer_response(info, batch_index)
         except Exception as e:
             logger.exception("Exception during sending to printer (batch %d): %s", batch_index, e)
             return f"Exception during sending to printer (batch {batch_index}): {e}"
 
-    def process_queue(self, batch_size: int = 0) -> str:
+    def _check_printer_response(self, info: dict, batch_index: int) -> str:
+        """Return an empty string if the printer reported a successful job,
+        or an error message."""
+        if self.is_network:
+            logger.info('Network printer does not provide status information.')
+            return ""
+        logger.info('Printer response: %s', str(info))
+        if info.get('did_print') and info.get('ready_for_next_job'):
+            logger.info('Label printed successfully and printer is ready for next job')
+            return ""
+        logger.warning("Failed to print label (batch %d)", batch_index)
+        return f"Failed to print label (batch {batch_index})"
+
+    def process_queue(self, batch_size: int = 0,
+                      progress: Optional[Callable[[int, int, str], None]] = None,
+                      sizer: Optional[BatchSizer] = None) -> str:
+        """Rasterize and send all queued labels. Returns an empty string on
+        success, or the error message of the first failed batch.
+        ``progress(batch_index, labels, status)`` is called after each batch
+        was sent, with the number of labels in it and its status. Without a
+        batch size, batches are sized by ``sizer``, which should be the same
+        for all jobs of the printer."""
         if not self._print_queue:
             logger.warning("Print queue is empty.")
             return "Print queue is empty."
 
         if batch_size < 1:
-            batch_size = int(os.environ.get('PRINT_BATCH_SIZE', DEFAULT_BATCH_SIZE))
-        if batch_size < 1:
-            batch_size = DEFAULT_BATCH_SIZE
+            batch_size = int(os.environ.get('PRINT_BATCH_SIZE', 0))
+        if batch_size > 0:
+            sizer = BatchSizer(batch_size, batch_size)
+        elif sizer is None:
+            sizer = BatchSizer()
 
-        total = len(self._print_queue)
         entries = list(self._print_queue)
         self._print_queue.clear()
+        self._rasters.clear()
+
+        # Split into batches to avoid printer timeouts on large jobs. The
+        # next batch (or label when streaming) is rasterized on another
+        # thread while the current one is being sent
+        batches = queue.Queue(maxsize=PIPELINE_DEPTH)
+        stop = threading.Event()
+        rasterizer = threading.Thread(target=self._rasterize_batches, args=(entries, sizer, batches, stop),
+                                      name='Rasterizer', daemon=True)
+        rasterizer.start()
+        try:
+            if self.streaming:
+                return self._stream_batches(batches, progress, sizer)
+            return self._send_batches(batches, progress, sizer)
+        finally:
+            stop.set()
+            rasterizer.join()
 
-        # Split into batches to avoid printer timeouts on large jobs
-        for batch_index, start in enumerate(range(0, total, batch_size), start=1):
-            batch = entries[start:start + batch_size]
-            logger.info('Processing batch %d (%d labels, %d/%d)',
-                        batch_index, len(batch), start + len(batch), total)
-            qlr, generated_images = self._rasterize_entries(batch)
+    def _send_batches(self, batches: queue.Queue, progress, sizer: BatchSizer) -> str:
+        while True:
+            item = batches.get()
+            if item is None:
+                return ""
+            if isinstance(item, Exception):
+                raise item
+            batch_index, labels, qlr, generated_images = item
+            start = time.perf_counter()
             status = self._send_raster(qlr, generated_images, batch_index)
+            self._measure(sizer, len(qlr.data), time.perf_counter() - start, status)
+            if progress is not None:
+                progress(batch_index, labels, status)
             if status:
                 return status
 
-        return ""
+    def _measure(self, sizer: BatchSizer, size: int, seconds: float, status: str):
+        """Pass the time taken to print a batch on to ``sizer``. Failed
+        batches end the job, how long they took says nothing about the
+        printer. Network printers report nothing back, writing to them only
+        takes as long as filling the socket buffer, so their batches keep
+        the default size."""
+        if not status and not self.is_network:
+            sizer.sent(size, seconds)
+
+    def _stream_batches(self, batches: queue.Queue, progress, sizer: BatchSizer) -> str:
+        """Write labels to the printer as they arrive, waiting for the
+        printer at the end of each batch."""
+        stream = None
+        labels = 0
+        # Time spent writing and waiting for the printer, but not waiting
+        # for labels to be rasterized
+        sending = 0.0
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    return ""
+                if isinstance(item, Exception):
+                    raise item
+                batch_index, data, img = item
+                try:
+                    if stream is None:
+                        stream = SimulatedRasterStream(batch_index) if self.is_simulation \
+                            else RasterStream(self.device_specifier)
+                    start = time.perf_counter()
+                    if data is not None:
+                        stream.write(data, img)
+                        sending += time.perf_counter() - start
+                        labels += 1
+                        continue
+                    logger.info('Streamed %d bytes to printer %s (batch %d)',
+                                stream.bytes_written, self.device_specifier, batch_index)
+                    info = stream.finish()
+                    sending += time.perf_counter() - start
+                    status = "" if self.is_simulation else self._check_printer_response(info, batch_index)
+                    self._measure(sizer, stream.bytes_written, sending, status)
+                except Exception as e:
+                    logger.exception("Exception during sending to printer (batch %d): %s", batch_index, e)
+                    status = f"Exception during sending to printer (batch {batch_index}): {e}"
+                if progress is not None:
+                    progress(batch_index, labels, status)
+                if status:
+                    return status
+                stream.close()
+                stream = None
+                labels = 0
+                sending = 0.0
+        finally:
+            if stream is not None:
+                stream.close()
+
+    def _rasterize_batches(self, entries, sizer: BatchSizer, batches: queue.Queue, stop: threading.Event):
+        """Put ``(batch_index, labels, qlr, generated_images)`` for each batch
+        into ``batches``, followed by None when done or the exception raised
+        while rasterizing. When streaming, ``(batch_index, data, image)`` is put
+        for each label instead, followed by ``(batch_index, None, None)`` at
+        the end of each batch. Returns early once ``stop`` is set."""
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        total = len(entries)
+        start = 0
+        batch_index = 0
+        try:
+            while start < total:
+                if stop.is_set():
+                    return
+                batch_index += 1
+                batch = entries[start:start + sizer.next_size()]
+                start += len(batch)
+                logger.info('Processing batch %d (%d labels, %d/%d)',
+                            batch_index, len(batch), start, total)
+                if self.streaming:
+                    size = 0
+                    for data, img in self._iter_rasterized(batch, self.is_simulation):
+                        size += len(data)
+                        if not put((batch_index, data, img)):
+                            return
+                    sizer.rasterized(len(batch), size)
+                    item = (batch_index, None, None)
+                else:
+                    qlr, generated_images = self._rasterize_entries(batch)
+                    sizer.rasterized(len(batch), len(qlr.data))
+                    item = (batch_index, len(batch), qlr, generated_images)
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
 
 
 def get_printer(printer_identifier=None, backend_identifier=None):
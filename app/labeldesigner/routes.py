@@ -1,5 +1,6 @@
 import os
 import hmac
+import hashlib
 import base64
 import logging
 import barcode
@@ -8,10 +9,10 @@ from . import bp
 from app import FONTS
 from PIL import Image
 from werkzeug.datastructures import FileStorage
-from .printer import PrinterQueue, get_ptr_status
+from .printer import PrinterQueue
 from brother_ql.labels import ALL_LABELS, FormFactor
-from .label import SimpleLabel, LabelContent, LabelOrientation, LabelType
-from flask import Request, current_app, json, jsonify, render_template, request, make_response
+from .label import SimpleLabel, LabelContent, LabelOrientation, LabelType, FONT_CACHE, LINE_EXTENTS_CACHE, TEXT_BBOX_CACHE, RENDER_CACHE, TEMPLATE_CACHE
+from flask import Request, current_app, json, jsonify, render_template, request, make_response, url_for
 from werkzeug.utils import secure_filename
 from app.utils import (
     convert_image_to_bw, convert_image_to_grayscale, convert_image_to_red_and_black, fill_first_line_fields,
@@ -35,7 +36,7 @@ def index():
     ]
     return render_template(
         'labeldesigner.html',
-        fonts=FONTS.fontlist(),
+        font_catalog_version=_get_font_catalog()[1],
         label_sizes=label_sizes,
         debug=debug,
         default_label_size=current_app.config['LABEL_DEFAULT_SIZE'],
@@ -57,6 +58,41 @@ def index():
 
 
 # --- Label repository utilities and API -------------------------------------------------
+# JSON font catalog as (fonts generation, etag, body), rebuilt when fonts change
+_font_catalog = None
+
+
+def _get_font_catalog():
+    global _font_catalog
+    catalog = _font_catalog
+    if catalog is None or catalog[0] != FONTS.generation:
+        generation = FONTS.generation
+        family, style = FONTS.get_default_font()
+        body = json.dumps({'default': f'{family},{style}', 'fonts': FONTS.fontlist()}).encode('utf-8')
+        catalog = _font_catalog = (generation, hashlib.sha1(body).hexdigest(), body)
+    return catalog
+
+
+@bp.route('/api/fonts', methods=['GET'])
+def get_fonts():
+    """
+    Catalog of all font families and their styles
+    Versioned URLs (?v=<etag>) may be cached forever, others are revalidated
+    using the ETag
+    """
+    _, etag, body = _get_font_catalog()
+    response = make_response(body)
+    response.mimetype = 'application/json'
+    response.set_etag(etag)
+    response.cache_control.public = True
+    if request.args.get('v') == etag:
+        response.cache_control.max_age = current_app.config.get('FONT_CATALOG_MAX_AGE', 31536000)
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
 def _get_repo_dir():
     repo = current_app.config.get('LABEL_REPOSITORY_DIR')
     if not repo:
@@ -311,7 +347,8 @@ def repo_print():
         device = request.values.get('printer') or current_app.config['PRINTER_PRINTER']
         model = request.values.get('model') or current_app.config['PRINTER_MODEL']
         label_size = data.get('label_size') or current_app.config['LABEL_DEFAULT_SIZE']
-        printer = PrinterQueue(model=model, device_specifier=device, label_size=label_size)
+        printer = PrinterQueue(model=model, device_specifier=device, label_size=label_size,
+                               **_printer_queue_options())
 
         # Determine printing options (print_count, cut_once, high_res)
         print_count = int(request.values.get('print_count') or data.get('print_count') or 1)
@@ -325,11 +362,14 @@ def repo_print():
 
     status = ""
     try:
+        label = create_label_from_request(data, {}, 0)
         for i in range(print_count):
-            label = create_label_from_request(data, {}, i)
+            label_copy = label if i == 0 else label.clone(counter=i)
             cut = not cut_once or (cut_once and i == print_count - 1)
-            printer.add_label_to_queue(label, cut, high_res)
-        status = printer.process_queue()
+            printer.add_label_to_queue(label_copy, cut, high_res)
+        if _is_async(jdata):
+            return _submit_print_job(printer)
+        status = _print_and_wait(printer)
     except Exception as e:
         current_app.logger.exception(e)
         return make_response(jsonify({'success': False, 'message': str(e)}), 400)
@@ -341,6 +381,36 @@ def repo_print():
     return result
 
 
+@bp.route('/api/jobs', methods=['GET'])
+def get_print_jobs():
+    """
+    API to list the print jobs started with async=1
+    returns: JSON
+    """
+    return jsonify({'jobs': [job.to_dict() for job in current_app.extensions['print_jobs'].jobs()]})
+
+
+@bp.route('/api/print_queues', methods=['GET'])
+def get_print_queues():
+    """
+    API to get the queue depth and throughput of each printer
+    returns: JSON
+    """
+    return jsonify({'printers': current_app.extensions['print_jobs'].printer_stats()})
+
+
+@bp.route('/api/jobs/<job_id>', methods=['GET'])
+def get_print_job(job_id):
+    """
+    API to poll the state and per batch progress of a print job
+    returns: JSON
+    """
+    state = current_app.extensions['print_jobs'].job_state(job_id)
+    if state is None:
+        return make_response(jsonify({'success': False, 'message': 'Unknown print job'}), 404)
+    return jsonify(state)
+
+
 @bp.route('/api/barcodes', methods=['GET'])
 def get_barcodes():
     barcodes = [code.upper() for code in barcode.PROVIDED_BARCODES]
@@ -380,7 +450,19 @@ def preview_from_image():
 
 @bp.route('/api/printer_status', methods=['GET'])
 def get_printer_status():
-    return get_ptr_status(current_app.config)
+    # Status of the configured printer unless another one is given
+    return current_app.extensions['printer_status'].snapshot(request.args.get('printer'))
+
+
+@bp.route('/api/cache_stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify({
+        'font_cache': FONT_CACHE.stats(),
+        'text_bbox_cache': TEXT_BBOX_CACHE.stats(),
+        'line_extents_cache': LINE_EXTENTS_CACHE.stats(),
+        'render_cache': RENDER_CACHE.stats(),
+        'template_cache': TEMPLATE_CACHE.stats(),
+    })
 
 
 @bp.route('/api/print', methods=['POST', 'GET'])
@@ -409,16 +491,20 @@ def print_label():
 
     status = ""
     try:
+        values = request.values.to_dict(flat=True)
+        files = request.files.to_dict(flat=True)
+        label = create_label_from_request(values, files, 0)
         for i in range(print_count):
-            values = request.values.to_dict(flat=True)
-            files = request.files.to_dict(flat=True)
-            label = create_label_from_request(values, files, i)
+            # Copies share everything not depending on the counter
+            label_copy = label if i == 0 else label.clone(counter=i)
             # Cut only if we
             # - always cut, or
             # - we cut only once and this is the last label to be generated
             cut = not cut_once or (cut_once and i == print_count - 1)
-            printer.add_label_to_queue(label, cut, high_res)
-        status = printer.process_queue()
+            printer.add_label_to_queue(label_copy, cut, high_res)
+        if _is_async():
+            return _submit_print_job(printer)
+        status = _print_and_wait(printer)
     except Exception as e:
         return_dict['message'] = str(e)
         current_app.logger.exception(e)
@@ -440,10 +526,42 @@ def create_printer_from_request(request: Request):
     return PrinterQueue(
         model=model,
         device_specifier=device,
-        label_size=label_size
+        label_size=label_size,
+        **_printer_queue_options()
     )
 
 
+def _is_async(jdata: dict = {}) -> bool:
+    """Return True if the request asks to print in the background."""
+    return int(request.values.get('async') or jdata.get('async') or 0) != 0
+
+
+def _submit_print_job(printer: PrinterQueue):
+    job = current_app.extensions['print_jobs'].submit(printer)
+    return make_response(jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': url_for('.get_print_job', job_id=job.id),
+    }), 202)
+
+
+def _print_and_wait(printer: PrinterQueue) -> str:
+    """Print on the worker of the printer and wait for the job to finish.
+    Returns the status of :meth:`PrinterQueue.process_queue`."""
+    job = current_app.extensions['print_jobs'].submit(printer, journal=False)
+    job.wait()
+    if job.error is not None:
+        raise job.error
+    return job.message
+
+
+def _printer_queue_options() -> dict:
+    return {
+        'workers': current_app.config.get('PRINT_WORKERS', 1),
+        'streaming': current_app.config.get('PRINT_STREAMING', False),
+    }
+
+
 def create_label_from_request(d: dict = {}, files: dict = {}, counter: int = 0):
     label_size = d.get('label_size', "62")
     kind = next((label.form_factor for label in ALL_LABELS if label.identifier == label_size), None)
@@ -610,7 +728,8 @@ def create_label_from_request(d: dict = {}, files: dict = {}, counter: int = 0):
         border_color=border_color,
         timestamp=context['timestamp'],
         counter=counter,
-        code_text=context['code_text']
+        code_text=context['code_text'],
+        font_fallback=FONTS.split_runs if current_app.config.get('LABEL_FONT_FALLBACK') else None
     )
 
 
@@ -813,7 +932,8 @@ def webhook_print():
 
     # Process and queue each image
     try:
-        printer = PrinterQueue(model=model, device_specifier=device, label_size=label_size)
+        printer = PrinterQueue(model=model, device_specifier=device, label_size=label_size,
+                               **_printer_queue_options())
         for img in pil_images:
             img = _convert_image(img, image_mode, bw_threshold)
             img = _scale_image_to_label(img, label_size, orientation, high_res)
@@ -828,7 +948,9 @@ def webhook_print():
                 text=[],
             )
             printer.add_label_to_queue(label, cut=True, high_res=high_res)
-        status = printer.process_queue()
+        if _is_async(jdata):
+            return _submit_print_job(printer)
+        status = _print_and_wait(printer)
     except Exception as e:
         current_app.logger.exception(e)
         return make_response(jsonify({'success': False, 'message': 'Failed to print labels'}), 400)
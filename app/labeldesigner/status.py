@@ -0,0 +1,142 @@
+"""
+Printer status monitor. Querying a printer over USB can take seconds, so
+``/api/printer_status`` returns the status of each device last seen by a
+background thread instead of querying the printer itself. Requests only wait
+for a query if the device has no status yet, or if its status is older than
+the query interval and the thread is not running, e.g. after it exited for
+lack of requests. Requests arriving while a query runs share its result.
+"""
+
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Callable, ContextManager, Dict, Optional, Tuple
+
+from flask import Config
+
+from .printer import get_ptr_status
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two status queries
+DEFAULT_STATUS_INTERVAL = 5
+# Seconds without status requests after which the monitor thread exits, it
+# is started again by the next request
+DEFAULT_STATUS_IDLE_TIMEOUT = 60
+
+
+class _DeviceStatus:
+    def __init__(self):
+        self.status: Optional[dict] = None
+        self.updated: Optional[float] = None
+        self.in_flight: Optional[Future] = None
+        self.last_request = 0.0
+
+
+class PrinterStatusMonitor:
+    """Keeps the result of :func:`get_ptr_status` up to date for each
+    requested device, ``PRINTER_PRINTER`` by default. Each query runs inside
+    ``querying(device_specifier)``, which yields False while the printer is
+    printing, the last status is kept then. Jobs must not start until the
+    query is done, see :meth:`JobManager.querying`."""
+
+    def __init__(self, config: Config, interval: float = DEFAULT_STATUS_INTERVAL,
+                 idle_timeout: float = DEFAULT_STATUS_IDLE_TIMEOUT,
+                 querying: Optional[Callable[[str], ContextManager[bool]]] = None,
+                 probe: Callable[[Config], dict] = get_ptr_status):
+        self.config = config
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.querying = querying
+        self.probe = probe
+        self.probes = 0
+        self._devices: Dict[str, _DeviceStatus] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def _device(self, device_specifier: Optional[str]) -> Tuple[str, _DeviceStatus]:
+        device_specifier = device_specifier or self.config['PRINTER_PRINTER']
+        device = self._devices.get(device_specifier)
+        if device is None:
+            device = self._devices[device_specifier] = _DeviceStatus()
+        return device_specifier, device
+
+    def snapshot(self, device_specifier: Optional[str] = None) -> dict:
+        """Return the last known status of a device. The printer is only
+        queried if it has no status yet, or if the status is outdated and
+        nothing is about to update it."""
+        with self._lock:
+            device_specifier, device = self._device(device_specifier)
+            device.last_request = time.monotonic()
+            status = device.status
+            updating = device.in_flight is not None or self._thread is not None
+            stale = device.updated is None or time.time() - device.updated > self.interval
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='Printer status', daemon=True)
+                self._thread.start()
+        if status is None or (stale and not updating):
+            status = self.refresh(device_specifier)
+        return dict(status)
+
+    def refresh(self, device_specifier: Optional[str] = None) -> dict:
+        """Query a printer unless it is printing. Callers arriving while a
+        query is running wait for it instead of starting another one."""
+        with self._lock:
+            device_specifier, device = self._device(device_specifier)
+            future = device.in_flight
+            leader = future is None
+            if leader:
+                future = device.in_flight = Future()
+        if not leader:
+            return future.result()
+        try:
+            status = self._query(device_specifier)
+        except BaseException as e:
+            with self._lock:
+                device.in_flight = None
+            future.set_exception(e)
+            raise
+        with self._lock:
+            if status is not None:
+                self.probes += 1
+                device.status = status
+                device.updated = time.time()
+            elif device.status is not None:
+                status = device.status
+            else:
+                status = {'errors': ['The printer is busy printing']}
+            device.in_flight = None
+        future.set_result(status)
+        return status
+
+    def _query(self, device_specifier: str) -> Optional[dict]:
+        """Return the printer status, or None if the printer is printing."""
+        if self.querying is None:
+            return self._probe(device_specifier)
+        with self.querying(device_specifier) as idle:
+            return self._probe(device_specifier) if idle else None
+
+    def _probe(self, device_specifier: str) -> dict:
+        config = self.config
+        if device_specifier != config['PRINTER_PRINTER']:
+            config = dict(config, PRINTER_PRINTER=device_specifier)
+        try:
+            return self.probe(config)
+        except Exception as e:
+            # get_ptr_status() reports errors in the status already
+            logger.exception('Printer status query failed: %s', e)
+            return {'errors': [str(e)]}
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                now = time.monotonic()
+                devices = [device_specifier for device_specifier, device in self._devices.items()
+                           if now - device.last_request <= self.idle_timeout]
+                if not devices:
+                    self._thread = None
+                    return
+            for device_specifier in devices:
+                self.refresh(device_specifier)
@@ -1,6 +1,13 @@
-from flask import redirect, url_for
+from flask import current_app, jsonify, redirect, url_for
 from . import bp
 
 @bp.route('/')
 def index():
-    return redirect(url_for('labeldesigner.index'))
\ No newline at end of file
+    return redirect(url_for('labeldesigner.index'))
+
+
+@bp.route('/ready')
+def ready():
+    """Readiness probe for load balancers, 503 until warm-up finished."""
+    state = current_app.extensions['warmup']
+    return jsonify(state.status()), 200 if state.ready.is_set() else 503
@@ -534,6 +534,30 @@ function get_barcode_types() {
         });
 }
 
+function load_fonts() {
+    // Populate font select menu from the (browser cached) font catalog
+    return fetch(url_for_get_fonts)
+        .then(response => response.json())
+        .then(data => {
+            const select = document.getElementById('font');
+            if (!select || !Array.isArray(data['fonts'])) return;
+            const fragment = document.createDocumentFragment();
+            data['fonts'].forEach(font => {
+                const group = document.createElement('optgroup');
+                group.label = font.family;
+                font.styles.forEach(style => {
+                    const opt = document.createElement('option');
+                    opt.value = font.family + ',' + style;
+                    opt.textContent = font.family + ' (' + style + ')';
+                    group.appendChild(opt);
+                });
+                fragment.appendChild(group);
+            });
+            select.replaceChildren(fragment);
+        })
+        .catch(error => console.error('Failed to load fonts', error));
+}
+
 function updatePrinterStatus() {
     if ($('#label_size option:selected').val().includes('red')) {
         $(".red-support").show();
@@ -1096,6 +1120,9 @@ function set_all_inputs_default(force = false) {
 }
 
 window.onload = async function () {
+    // Fonts have to be available before settings are restored
+    await load_fonts();
+
     // Get supported barcodes
     get_barcode_types();
 
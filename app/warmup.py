@@ -0,0 +1,77 @@
+"""
+Warm-up of fonts and renderers, so the first request after a start is not
+slowed down by lazily loaded fonts, code generators and image plugins.
+"""
+
+import time
+import logging
+import threading
+from io import BytesIO
+from typing import Iterable, Optional
+
+from PIL import Image
+
+from .fonts import Fonts
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    """Preloads the default font at the given sizes and renders dummy labels
+    through :meth:`SimpleLabel.generate`. :attr:`ready` is set once done,
+    even if warming up failed, as the app is still usable in that case."""
+
+    def __init__(self, fonts: Fonts, font_sizes: Iterable[int]):
+        self.fonts = fonts
+        self.font_sizes = [int(size) for size in font_sizes]
+        self.ready = threading.Event()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def start(self, background: bool = True):
+        if background:
+            threading.Thread(target=self.run, name='Warmup', daemon=True).start()
+        else:
+            self.run()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.ready.wait(timeout)
+
+    def status(self) -> dict:
+        return {
+            'ready': self.ready.is_set(),
+            'duration': self.duration,
+            'error': self.error,
+        }
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            self._warm_up()
+        except Exception as e:
+            self.error = str(e)
+            logger.exception('Warm-up failed')
+        finally:
+            self.duration = time.perf_counter() - start
+            logger.info('Warm-up finished in %.2f s', self.duration)
+            self.ready.set()
+
+    def _warm_up(self):
+        # Imported here as the label designer blueprint needs the fonts to
+        # be loaded when it is imported
+        from .labeldesigner.label import SimpleLabel, LabelContent
+
+        Image.init()
+        family, style = self.fonts.get_default_font()
+        path = self.fonts.get_path(f'{family},{style}')
+        text = [{'text': 'Warm-up Ag 123', 'path': path, 'size': size, 'align': 'center'}
+                for size in self.font_sizes]
+        labels = (
+            SimpleLabel(width=696, label_content=LabelContent.TEXT_QRCODE, label_margin=(35, 35, 24, 24),
+                        text=text, code_text='warm-up'),
+            SimpleLabel(width=696, label_content=LabelContent.TEXT_QRCODE, label_margin=(35, 35, 24, 24),
+                        barcode_type='code128', text=text[:1], code_text='warm-up'),
+        )
+        for label in labels:
+            img = label.generate()
+            img.save(BytesIO(), format='PNG')
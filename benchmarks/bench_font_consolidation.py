@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for consolidating font families into parent families.
+
+Generates a synthetic set of font families (parents with width/weight
+children, as found in large font collections like Noto) and compares the
+indexed consolidation with the previous pairwise substring comparison. Both
+must produce the same families and styles.
+
+Usage: python benchmarks/bench_font_consolidation.py [--families 10000]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+from collections import defaultdict
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.fonts import consolidate_families
+
+SCRIPTS = ('Arabic', 'Armenian', 'Bengali', 'Cherokee', 'Devanagari', 'Ethiopic', 'Georgian', 'Hebrew',
+           'Kannada', 'Khmer', 'Lao', 'Malayalam', 'Myanmar', 'Sinhala', 'Tamil', 'Telugu', 'Thai')
+CHILDREN = ('', ' Condensed', ' SemiCondensed', ' ExtraCondensed', ' Mono', ' UI', ' Display')
+STYLES = ('Regular', 'Bold', 'Italic', 'Bold Italic', 'Light', 'Medium')
+
+
+def legacy_consolidate_families(fonts):
+    for family, styles in list(fonts.items()):
+        for other_family in list(fonts.keys()):
+            if family != other_family and family in other_family:
+                extra_style = other_family.replace(family + ' ', '')
+                for style in fonts[other_family].keys():
+                    new_style = extra_style + ((' / ' + style) if style != 'Regular' else '')
+                    fonts[family][new_style] = fonts[other_family][style]
+                del fonts[other_family]
+
+
+def make_families(count: int):
+    rng = random.Random(42)
+    families = set()
+    i = 0
+    while len(families) < count:
+        base = f'Synth {SCRIPTS[i % len(SCRIPTS)]} {i // len(SCRIPTS):04d}'
+        for child in CHILDREN:
+            families.add(base + child)
+        i += 1
+    families = sorted(families, key=str.lower)[:count]
+    fonts = defaultdict(dict)
+    for family in families:
+        for style in rng.sample(STYLES, 3):
+            fonts[family][style] = f'/fonts/{family}-{style}.ttf'
+    return fonts
+
+
+def copy_fonts(fonts):
+    return defaultdict(dict, {family: dict(styles) for family, styles in fonts.items()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--families', type=int, default=10000, help='Number of synthetic font families')
+    parser.add_argument('--skip-legacy', action='store_true', help='Do not run the pairwise comparison')
+    args = parser.parse_args()
+
+    fonts = make_families(args.families)
+
+    indexed = copy_fonts(fonts)
+    start = time.perf_counter()
+    consolidate_families(indexed)
+    indexed_time = time.perf_counter() - start
+    print(f'Indexed consolidation of {args.families} families: {indexed_time:.3f} s '
+          f'({len(indexed)} families left)')
+
+    if args.skip_legacy:
+        return 0
+
+    legacy = copy_fonts(fonts)
+    start = time.perf_counter()
+    legacy_consolidate_families(legacy)
+    legacy_time = time.perf_counter() - start
+    print(f'Pairwise consolidation of {args.families} families: {legacy_time:.3f} s '
+          f'(speedup {legacy_time / indexed_time:.1f}x)')
+
+    if list(indexed.items()) != list(legacy.items()):
+        print('ERROR: consolidated fonts differ')
+        return 1
+    print('Consolidated fonts are identical')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
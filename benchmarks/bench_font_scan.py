@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for rebuilding the font index with one or more scan workers.
+
+A synthetic font tree with a few thousand small TrueType files is generated in
+a temporary directory and scanned without a persistent index, once with a
+single worker and once with N workers. The resulting family/style mappings
+must be identical.
+
+Usage: python benchmarks/bench_font_scan.py [--fonts 3000] [--workers N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app.fonts import Fonts
+
+STYLES = ('Regular', 'Bold', 'Italic', 'Bold Italic')
+
+
+def build_font(path: str, family: str, style: str):
+    fb = FontBuilder(1000, isTTF=True)
+    glyphs = ['.notdef', 'space'] + [f'glyph{i}' for i in range(64)]
+    fb.setupGlyphOrder(glyphs)
+    fb.setupCharacterMap({0x20: 'space', **{0x41 + i: f'glyph{i}' for i in range(64)}})
+    fb.setupGlyf({name: TTGlyphPen(None).glyph() for name in glyphs})
+    fb.setupHorizontalMetrics({name: (500, 0) for name in glyphs})
+    fb.setupHorizontalHeader(ascent=800, descent=-200)
+    fb.setupNameTable({'familyName': family, 'styleName': style})
+    fb.setupOS2()
+    fb.setupPost()
+    fb.save(path)
+
+
+def build_tree(root: str, count: int):
+    for i in range(count):
+        family = f'Synthetic {i // len(STYLES):05d}'
+        style = STYLES[i % len(STYLES)]
+        folder = os.path.join(root, f'{i // 500:03d}')
+        os.makedirs(folder, exist_ok=True)
+        build_font(os.path.join(folder, f'font{i:05d}.ttf'), family, style)
+
+
+def scan(root: str, workers: int):
+    logger = logging.getLogger('bench')
+    start = time.perf_counter()
+    fonts = Fonts(logger, additional_path=root, workers=workers)
+    return time.perf_counter() - start, fonts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fonts', type=int, default=3000, help='Number of synthetic font files')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of parallel workers')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench_fonts_')
+    try:
+        start = time.perf_counter()
+        build_tree(root, args.fonts)
+        print(f'Generated {args.fonts} fonts in {time.perf_counter() - start:.2f} s')
+
+        serial_time, serial = scan(root, 1)
+        parallel_time, parallel = scan(root, args.workers)
+        print(f'1 worker:  {serial_time:.2f} s')
+        print(f'{args.workers} workers: {parallel_time:.2f} s (speedup {serial_time / parallel_time:.2f}x)')
+
+        if list(serial.fonts.items()) != list(parallel.fonts.items()):
+            print('ERROR: font mappings differ between serial and parallel scan')
+            return 1
+        print('Font mappings are identical')
+    finally:
+        shutil.rmtree(root)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
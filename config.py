@@ -25,6 +25,57 @@ class Config(object):
     LABEL_DEFAULT_LINE_SPACING = 100
     LABEL_DEFAULT_FONT_FAMILY = 'DejaVu Serif'
     LABEL_DEFAULT_FONT_STYLE = 'Book'
+    # Render characters missing in the selected font with another installed
+    # font covering them instead of showing placeholder boxes
+    LABEL_FONT_FALLBACK = False
+    # Preload the default font and render dummy labels at startup, so the
+    # first request is as fast as later ones. /ready returns 503 until the
+    # warm-up finished, it runs in a background thread unless disabled below
+    WARMUP = True
+    WARMUP_BACKGROUND = True
+    # Sizes of the default font loaded during warm-up
+    WARMUP_FONT_SIZES = [12, 40, 70]
+    # Seconds browsers may cache the versioned font catalog, its URL changes
+    # whenever the installed fonts change
+    FONT_CATALOG_MAX_AGE = 365 * 24 * 3600
+    # Maximum number of loaded fonts (family, style and size) and their line
+    # heights kept in memory
+    FONT_CACHE_SIZE = 64
+    # Maximum number of measured text bounding boxes kept in memory
+    TEXT_BBOX_CACHE_SIZE = 4096
+    # Maximum number of rendered labels kept in memory and their total size
+    # in bytes. Labels with dynamic templates like {{datetime}} are not cached
+    RENDER_CACHE_SIZE = 128
+    RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+    # Number of processes rendering and rasterizing the labels of a print
+    # job. 1 rasterizes on the request thread, 0 uses all available CPU cores
+    PRINT_WORKERS = 1
+    # Write each label to the printer as soon as it is rasterized instead of
+    # sending whole batches, keeping memory use constant for large jobs
+    PRINT_STREAMING = False
+    # Each printer prints its jobs one after another on its own thread.
+    # Print requests with async=1 return a job ID right away instead of
+    # waiting, the state of the last PRINT_JOB_HISTORY finished jobs is kept
+    # for /api/jobs/<id>
+    PRINT_JOB_HISTORY = 100
+    # Print jobs started with async=1 are recorded in this file. Jobs
+    # interrupted by a restart are resumed with the labels not sent yet, the
+    # batch being sent when the server stopped is printed again. Not
+    # available on Windows. Set to an empty string to disable.
+    PRINT_JOURNAL_FILE = os.path.join(basedir, 'instance', 'print_journal.sqlite')
+    # Seconds the connection to a network printer is kept open after a
+    # batch, so the next batch or job does not connect again. 0 connects for
+    # every batch.
+    PRINT_CONNECTION_IDLE_TIMEOUT = 10
+    # Jobs and status queries hold a lock file per printer in this
+    # directory, so several server processes (e.g. gunicorn --workers) use
+    # a printer one at a time. Set to an empty string to disable.
+    PRINT_LOCK_DIR = os.path.join(basedir, 'instance', 'printer_locks')
+
+    # Seconds between two status queries of the printer. /api/printer_status
+    # returns the last status seen by a background thread.
+    PRINTER_STATUS_INTERVAL = 5
 
     IMAGE_DEFAULT_MODE = 'grayscale'
     IMAGE_DEFAULT_BW_THRESHOLD = 70
@@ -38,6 +89,19 @@ class Config(object):
 
     FONT_FOLDER = ''
 
+    # Persistent index of the scanned fonts. Only new or changed font files
+    # are parsed on startup. Set to an empty string to disable the index.
+    FONT_INDEX_FILE = os.path.join(basedir, 'instance', 'font_index.json')
+
+    # Number of processes used to parse fonts that are missing from the font
+    # index. 0 uses all available CPU cores.
+    FONT_SCAN_WORKERS = 0
+
+    # Watch the font directories (inotify, polling as fallback) and make new
+    # fonts available without restarting the server
+    FONT_WATCH = False
+    FONT_WATCH_INTERVAL = 10
+
     # Webhook print endpoint password. The webhook is disabled when empty.
     # Generate a secure password with:
     #   python3 -c "import secrets; print(secrets.token_urlsafe(32))"
@@ -3,7 +3,8 @@
 
 from app import create_app
 
-app = create_app()
-
 if __name__ == "__main__":
+    # Not created on import, as worker processes started with the spawn
+    # method import this module again
+    app = create_app()
     app.run(host = app.config['SERVER_HOST'], port = app.config['SERVER_PORT'])
\ No newline at end of file
@@ -0,0 +1,88 @@
+import threading
+import unittest
+from app.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = LRUCache(2)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+        self.assertEqual(cache.stats(), {'size': 1, 'capacity': 2, 'hits': 1, 'misses': 2, 'evictions': 0,
+                                         'hit_rate': 1 / 3})
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_resize(self):
+        cache = LRUCache(3)
+        for i in range(3):
+            cache.put(i, i)
+        cache.resize(1)
+        self.assertEqual(len(cache), 1)
+        self.assertIn(2, cache)
+        self.assertEqual(cache.evictions, 2)
+        cache.resize(0)
+        cache.put('a', 1)
+        self.assertEqual(len(cache), 0)
+        with self.assertRaises(ValueError):
+            cache.resize(-1)
+
+    def test_max_weight(self):
+        cache = LRUCache(10, max_weight=10, weigher=len)
+        cache.put('a', 'x' * 4)
+        cache.put('b', 'x' * 4)
+        cache.put('c', 'x' * 4)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.stats()['weight'], 8)
+        # Replacing an entry updates its weight
+        cache.put('b', 'x')
+        self.assertEqual(cache.stats()['weight'], 5)
+        # Values heavier than the limit are not cached and replace nothing
+        cache.put('c', 'x' * 11)
+        self.assertNotIn('c', cache)
+        self.assertEqual(cache.stats()['weight'], 1)
+        cache.resize(10, max_weight=0)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['weight'], 0)
+        with self.assertRaises(ValueError):
+            LRUCache(10, max_weight=10)
+
+    def test_get_or_create(self):
+        cache = LRUCache(2)
+        calls = []
+        for _ in range(3):
+            self.assertEqual(cache.get_or_create('a', lambda: calls.append(1) or 'value'), 'value')
+        self.assertEqual(len(calls), 1)
+
+    def test_concurrent_access(self):
+        cache = LRUCache(16)
+
+        def worker(offset):
+            for i in range(2000):
+                key = (offset + i) % 40
+                if cache.get(key) is None:
+                    cache.put(key, key)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = cache.stats()
+        self.assertLessEqual(stats['size'], 16)
+        self.assertEqual(stats['hits'] + stats['misses'], 8000)
+
+
+if __name__ == '__main__':
+    unittest.main()
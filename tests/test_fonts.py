@@ -1,7 +1,19 @@
+import os
+import sys
+import shutil
+import tempfile
 import unittest
-from app.fonts import Fonts
+from unittest import mock
+from app import fonts as fonts_module
+from app.fonts import Fonts, consolidate_families
+from collections import defaultdict
 import json
+import time
+import random
 import logging
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+from app.fontwatcher import FontWatcher
 
 
 def read_testfile(file_path, data):
@@ -42,5 +54,278 @@ class TestFonts(unittest.TestCase):
         self.assertEqual(font_styles, expected_font_styles)
 
 
+def make_font(path, family, style='Regular', chars='A'):
+    glyphs = ['.notdef'] + [f'uni{ord(char):04X}' for char in chars]
+    fb = FontBuilder(1000, isTTF=True)
+    fb.setupGlyphOrder(glyphs)
+    fb.setupCharacterMap({ord(char): f'uni{ord(char):04X}' for char in chars})
+    fb.setupGlyf({name: TTGlyphPen(None).glyph() for name in glyphs})
+    fb.setupHorizontalMetrics({name: (500, 0) for name in glyphs})
+    fb.setupHorizontalHeader(ascent=800, descent=-200)
+    fb.setupNameTable({'familyName': family, 'styleName': style})
+    fb.setupOS2()
+    fb.setupPost()
+    fb.save(path)
+
+
+def legacy_consolidate_families(fonts):
+    # Pairwise consolidation as it was done before the family index
+    for family, styles in list(fonts.items()):
+        for other_family in list(fonts.keys()):
+            if family != other_family and family in other_family:
+                extra_style = other_family.replace(family + ' ', '')
+                for style in fonts[other_family].keys():
+                    new_style = extra_style + ((' / ' + style) if style != 'Regular' else '')
+                    fonts[family][new_style] = fonts[other_family][style]
+                del fonts[other_family]
+
+
+class TestConsolidateFamilies(unittest.TestCase):
+    FAMILIES = [
+        'DejaVu Sans', 'DejaVu Sans Condensed', 'DejaVu Sans Mono', 'DejaVu Serif',
+        'DejaVu Serif Condensed', 'Noto Sans', 'Noto Sans Mono', 'Noto Sans Mono CJK',
+        'Sans', 'Go', 'Gothic', 'Mono', 'Liberation Mono', 'Droid Sans Mono Slashed',
+    ]
+
+    def make_fonts(self, families):
+        fonts = defaultdict(dict)
+        for family in sorted(families, key=str.lower):
+            for style in ('Regular', 'Bold'):
+                fonts[family][style] = f'/fonts/{family}-{style}.ttf'
+        return fonts
+
+    def assert_same_as_legacy(self, families):
+        expected = self.make_fonts(families)
+        legacy_consolidate_families(expected)
+        actual = self.make_fonts(families)
+        consolidate_families(actual)
+        self.assertEqual(list(actual.items()), list(expected.items()))
+        for family in expected:
+            self.assertEqual(list(actual[family].items()), list(expected[family].items()))
+
+    def test_parent_and_children(self):
+        fonts = self.make_fonts(['DejaVu Sans', 'DejaVu Sans Condensed'])
+        consolidate_families(fonts)
+        self.assertEqual(list(fonts.keys()), ['DejaVu Sans'])
+        self.assertEqual(fonts['DejaVu Sans']['Condensed / Bold'], '/fonts/DejaVu Sans Condensed-Bold.ttf')
+        self.assertEqual(fonts['DejaVu Sans']['Condensed'], '/fonts/DejaVu Sans Condensed-Regular.ttf')
+
+    def test_same_as_legacy(self):
+        self.assert_same_as_legacy(self.FAMILIES)
+
+    def test_same_as_legacy_random(self):
+        rng = random.Random(3)
+        words = ['Sans', 'Serif', 'Mono', 'Noto', 'Go', 'Condensed', 'Bold', 'UI', 'Gothic', 'Math']
+        for _ in range(50):
+            families = {' '.join(rng.choices(words, k=rng.randint(1, 4))) for _ in range(30)}
+            self.assert_same_as_legacy(families)
+
+
+class TestFontIndex(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('TestFontIndex')
+        self.tmpdir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.tmpdir, 'index', 'font_index.json')
+        self.font_folder = os.path.join(self.tmpdir, 'fonts')
+        os.makedirs(self.font_folder)
+        # Use one of the system fonts as an additional font
+        reference = Fonts(self.logger)
+        self.font_path = shutil.copy(reference.get_path(','.join(reference.get_default_font())),
+                                     os.path.join(self.font_folder, 'extra.ttf'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_index_is_written(self):
+        fonts = Fonts(self.logger, additional_path=self.font_folder, index_file=self.index_file)
+        with open(self.index_file, 'r') as f:
+            index = json.load(f)
+        self.assertEqual(index['version'], fonts_module.FONT_INDEX_VERSION)
+        self.assertIn(self.font_path, index['fonts'])
+        self.assertEqual(len(index['fonts']), len(fonts._entries))
+
+    def test_unchanged_fonts_are_not_parsed(self):
+        fonts = Fonts(self.logger, additional_path=self.font_folder, index_file=self.index_file)
+        with mock.patch.object(fonts_module, 'read_font_info', side_effect=AssertionError('font parsed')):
+            cached = Fonts(self.logger, additional_path=self.font_folder, index_file=self.index_file)
+        self.assertEqual(cached.fontlist(), fonts.fontlist())
+        self.assertEqual(cached.fonts, fonts.fonts)
+
+    def test_changed_fonts_are_parsed(self):
+        Fonts(self.logger, additional_path=self.font_folder, index_file=self.index_file)
+        stat = os.stat(self.font_path)
+        os.utime(self.font_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        with mock.patch.object(fonts_module, 'read_font_info', wraps=fonts_module.read_font_info) as parser:
+            Fonts(self.logger, additional_path=self.font_folder, index_file=self.index_file)
+        parser.assert_called_once_with(self.font_path)
+
+    def test_parallel_scan_matches_serial_scan(self):
+        serial = Fonts(self.logger, additional_path=self.font_folder, workers=1)
+        with mock.patch.object(fonts_module, 'ProcessPoolExecutor', wraps=fonts_module.ProcessPoolExecutor) as pool:
+            parallel = Fonts(self.logger, additional_path=self.font_folder, workers=4, parallel_min_files=1)
+        pool.assert_called_once()
+        self.assertEqual(list(parallel.fonts.items()), list(serial.fonts.items()))
+        self.assertEqual(parallel._entries, serial._entries)
+
+    def test_broken_pool_falls_back_to_serial_scan(self):
+        serial = Fonts(self.logger, additional_path=self.font_folder, workers=1)
+        with mock.patch.object(fonts_module, 'ProcessPoolExecutor') as pool:
+            pool.return_value.__enter__.return_value.map.side_effect = fonts_module.BrokenProcessPool()
+            fonts = Fonts(self.logger, additional_path=self.font_folder, workers=4, parallel_min_files=1)
+        pool.assert_called_once()
+        self.assertEqual(fonts._entries, serial._entries)
+
+    def test_few_fonts_are_parsed_in_process(self):
+        fonts = Fonts(self.logger, additional_path=self.font_folder, workers=4)
+        with mock.patch.object(fonts_module, 'ProcessPoolExecutor') as pool:
+            infos = fonts._read_infos([self.font_path] * 3)
+        pool.assert_not_called()
+        self.assertEqual(infos, [fonts_module.read_font_info(self.font_path)] * 3)
+
+    def test_corrupt_index_is_rebuilt(self):
+        os.makedirs(os.path.dirname(self.index_file))
+        with open(self.index_file, 'w') as f:
+            f.write('{not json')
+        fonts = Fonts(self.logger, additional_path=self.font_folder, index_file=self.index_file)
+        self.assertTrue(fonts.fonts_available())
+        with open(self.index_file, 'r') as f:
+            self.assertIn(self.font_path, json.load(f)['fonts'])
+
+
+class TestGlyphCoverage(unittest.TestCase):
+    # Private use codepoints are not covered by any system font
+    PUA = '\ue000\ue001\ue002'
+
+    def setUp(self):
+        self.logger = logging.getLogger('TestGlyphCoverage')
+        self.font_folder = tempfile.mkdtemp()
+        self.primary = os.path.join(self.font_folder, 'primary.ttf')
+        self.symbols = os.path.join(self.font_folder, 'symbols.ttf')
+        make_font(self.primary, 'Coverage Primary', chars='ABC')
+        make_font(self.symbols, 'Coverage Symbols', chars='A' + self.PUA[:2])
+        self.fonts = Fonts(self.logger, default_family='Coverage Primary', default_style='Regular',
+                           additional_path=self.font_folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.font_folder)
+
+    def test_codepoint_ranges(self):
+        self.assertEqual(fonts_module.codepoint_ranges([]), [])
+        self.assertEqual(fonts_module.codepoint_ranges([5, 1, 2, 3, 7, 8]), [1, 3, 5, 5, 7, 8])
+
+    def test_read_font_info(self):
+        family, style, coverage = fonts_module.read_font_info(self.symbols)
+        self.assertEqual((family, style), ('Coverage Symbols', 'Regular'))
+        self.assertEqual(coverage, [0x41, 0x41, 0xe000, 0xe001])
+        self.assertEqual(fonts_module.read_font_info(os.path.join(self.font_folder, 'missing.ttf')),
+                         (None, None, []))
+
+    def test_covers(self):
+        self.assertTrue(self.fonts.covers(self.primary, ord('B')))
+        self.assertFalse(self.fonts.covers(self.primary, ord('D')))
+        self.assertFalse(self.fonts.covers(self.primary, 0xe000))
+        self.assertTrue(self.fonts.covers(self.symbols, 0xe001))
+        self.assertFalse(self.fonts.covers('/does/not/exist.ttf', ord('A')))
+
+    def test_split_runs(self):
+        self.assertEqual(self.fonts.split_runs('AB', self.primary), [('AB', self.primary)])
+        # The default font is preferred as fallback for 'A'
+        self.assertEqual(self.fonts.split_runs(self.PUA[:2] + 'A', self.symbols),
+                         [(self.PUA[:2] + 'A', self.symbols)])
+        self.assertEqual(self.fonts.split_runs('AB' + self.PUA + ' C', self.primary),
+                         [('AB', self.primary), (self.PUA[:2], self.symbols),
+                          (self.PUA[2] + ' C', self.primary)])
+        # Fonts without coverage information are used as they are
+        self.assertEqual(self.fonts.split_runs('A' + self.PUA, '/unknown.ttf'),
+                         [('A' + self.PUA, '/unknown.ttf')])
+
+    def test_fallback_table_matches_linear_search(self):
+        order = self.fonts._fallback_order()
+        self.assertEqual(order[0], self.primary)
+        rng = random.Random(3)
+        codepoints = {0x20, 0x41, 0x44, 0xe000, 0xe001, 0xe002, 0x10ffff}
+        codepoints.update(rng.randrange(0x3000) for _ in range(2000))
+        for codepoint in sorted(codepoints):
+            expected = next((path for path in order if self.fonts.covers(path, codepoint)), None)
+            self.assertEqual(self.fonts.fallback_font(codepoint), expected, hex(codepoint))
+
+
+class TestFontRefresh(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('TestFontRefresh')
+        self.font_folder = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.font_folder, 'font_index.json')
+        self.fonts = Fonts(self.logger, additional_path=self.font_folder, index_file=self.index_file)
+        self.font_path = os.path.join(self.font_folder, 'new', 'watcher.ttf')
+
+    def tearDown(self):
+        shutil.rmtree(self.font_folder)
+
+    def add_font(self):
+        os.makedirs(os.path.dirname(self.font_path), exist_ok=True)
+        make_font(self.font_path, 'Watcher Test')
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if condition():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_refresh_adds_and_removes_fonts(self):
+        self.add_font()
+        with mock.patch.object(fonts_module, 'read_font_info', wraps=fonts_module.read_font_info) as parser:
+            self.assertTrue(self.fonts.refresh([os.path.dirname(self.font_path)]))
+        parser.assert_called_once_with(self.font_path)
+        self.assertEqual(self.fonts.get_path('Watcher Test,Regular'), self.font_path)
+        self.assertEqual(self.fonts.generation, 1)
+        with open(self.index_file, 'r') as f:
+            self.assertIn(self.font_path, json.load(f)['fonts'])
+
+        # Nothing changed
+        self.assertFalse(self.fonts.refresh())
+        self.assertEqual(self.fonts.generation, 1)
+
+        os.remove(self.font_path)
+        self.assertTrue(self.fonts.refresh([self.font_path]))
+        self.assertNotIn('Watcher Test', self.fonts.fontfamilies())
+
+    def test_refresh_parses_in_process(self):
+        self.add_font()
+        self.fonts.workers = 4
+        with mock.patch.object(fonts_module, 'PARALLEL_SCAN_MIN_FILES', 1), \
+                mock.patch.object(fonts_module, 'ProcessPoolExecutor') as pool:
+            self.assertTrue(self.fonts.refresh())
+        pool.assert_not_called()
+
+    def test_refresh_all_search_paths(self):
+        self.add_font()
+        self.assertTrue(self.fonts.refresh())
+        self.assertIn('Watcher Test', self.fonts.fontfamilies())
+
+    def run_watcher(self, use_inotify):
+        watcher = FontWatcher(self.fonts, poll_interval=0.2, settle_time=0.1, use_inotify=use_inotify)
+        watcher.start()
+        try:
+            # Wait for the watcher to be set up before adding fonts
+            self.assertTrue(self.wait_for(lambda: watcher._inotify is not None or not use_inotify))
+            time.sleep(0.3)
+            self.add_font()
+            self.assertTrue(self.wait_for(lambda: 'Watcher Test' in self.fonts.fonts))
+            shutil.rmtree(os.path.dirname(self.font_path))
+            self.assertTrue(self.wait_for(lambda: 'Watcher Test' not in self.fonts.fonts))
+        finally:
+            watcher.stop()
+            watcher.join()
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is only available on Linux')
+    def test_watcher_inotify(self):
+        self.run_watcher(use_inotify=True)
+
+    def test_watcher_polling(self):
+        self.run_watcher(use_inotify=False)
+
+
 if __name__ == '__main__':
     unittest.main()
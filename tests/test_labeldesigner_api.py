@@ -11,6 +11,7 @@ from flask.testing import FlaskClient
 from werkzeug.datastructures import FileStorage
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app import create_app
+from config import Config
 
 UPDATE_IMAGES = False
 EXAMPLE_FORMDATA = {
@@ -39,8 +40,16 @@ def verify_image(response_data: bytes, expected_image_path: str):
         f.write(response_data)
 
 
+class TestConfig(Config):
+    # Test runs must neither resume nor leave behind print jobs
+    PRINT_JOURNAL_FILE = ''
+    PRINT_LOCK_DIR = ''
+
+
 def make_client(tmp_path, empty_repo: bool = False, model: Union[str, None] = None) -> FlaskClient:
-    app = create_app()
+    app = create_app(TestConfig)
+    # Do not render concurrently with the tests
+    app.extensions['warmup'].wait()
     # Bind app context
     app.app_context().push()
     app.config['TESTING'] = True
@@ -118,6 +127,32 @@ class TestLabelDesignerAPI:
         assert b'labeldesigner' in response.data
         assert response.content_type == 'text/html; charset=utf-8'
 
+    def test_font_catalog(self, client: FlaskClient):
+        response = client.get('/labeldesigner/api/fonts')
+        assert response.status_code == 200
+        assert response.is_json
+        catalog = response.get_json()
+        families = [font['family'] for font in catalog['fonts']]
+        assert 'DejaVu Sans' in families
+        assert catalog['default'] == ','.join(client.application.config[key] for key in
+                                              ('LABEL_DEFAULT_FONT_FAMILY', 'LABEL_DEFAULT_FONT_STYLE'))
+        etag = response.headers['ETag'].strip('"')
+        assert 'no-cache' in response.headers['Cache-Control']
+
+        # Unchanged catalog is not sent again
+        response = client.get('/labeldesigner/api/fonts', headers={'If-None-Match': f'"{etag}"'})
+        assert response.status_code == 304
+        assert response.data == b''
+
+        # The page references the versioned catalog which can be cached
+        page = client.get('/labeldesigner/')
+        assert f'api/fonts?v={etag}'.encode() in page.data
+        assert b'<option value="DejaVu Sans,Book">' not in page.data
+        response = client.get(f'/labeldesigner/api/fonts?v={etag}')
+        assert response.status_code == 200
+        assert 'max-age=' in response.headers['Cache-Control']
+        assert 'immutable' in response.headers['Cache-Control']
+
     def test_get_barcodes(self, client: FlaskClient):
         response = client.get('/labeldesigner/api/barcodes')
         assert response.status_code == 200
@@ -1097,6 +1132,310 @@ class TestLabelDesignerAPI:
         assert 'success' in json_response
         assert json_response['success'] is False
 
+    def test_print_label_async(self, client: FlaskClient):
+        data = EXAMPLE_FORMDATA.copy()
+        data['text'] = json.dumps([{'font': 'DejaVu Sans,Book', 'text': 'Job {{counter}}', 'size': '40', 'align': 'center'}])
+        data['print_count'] = '7'
+        data['async'] = '1'
+        response = client.post('/labeldesigner/api/print', data=data)
+        assert response.status_code == 202
+        job_id = response.get_json()['job_id']
+        assert response.get_json()['status_url'] == f'/labeldesigner/api/jobs/{job_id}'
+
+        client.application.extensions['print_jobs'].get(job_id).wait(10)
+        job = client.get(f'/labeldesigner/api/jobs/{job_id}').get_json()
+        assert (job['state'], job['success'], job['message']) == ('done', True, '')
+        assert (job['labels'], job['labels_sent'], job['batches_sent']) == (7, 7, 2)
+        assert [batch['labels'] for batch in job['batches']] == [5, 2]
+        assert job_id in [job['id'] for job in client.get('/labeldesigner/api/jobs').get_json()['jobs']]
+
+        # Errors while sending are reported by the job
+        data['printer'] = '/dev/nonexistentprinter'
+        response = client.post('/labeldesigner/api/print', data=data)
+        assert response.status_code == 202
+        job_id = response.get_json()['job_id']
+        client.application.extensions['print_jobs'].get(job_id).wait(10)
+        job = client.get(f'/labeldesigner/api/jobs/{job_id}').get_json()
+        assert (job['state'], job['success'], job['labels_sent']) == ('failed', False, 0)
+        assert "Exception during sending to printer (batch 1)" in job['message']
+        assert job['batches'][0]['message'] == job['message']
+
+        # Invalid labels are still rejected right away
+        data['text'] = 'no json'
+        assert client.post('/labeldesigner/api/print', data=data).status_code == 400
+        assert client.get('/labeldesigner/api/jobs/unknown').status_code == 404
+
+    def test_printer_workers(self, client: FlaskClient):
+        """Jobs of one device are serialized, different devices print in parallel."""
+        import time
+        import threading
+        from app.labeldesigner.jobs import JobManager
+
+        active = {}
+        peaks = {'total': 0}
+        lock = threading.Lock()
+
+        class SlowPrinterQueue:
+            def __init__(self, device_specifier):
+                self.device_specifier = device_specifier
+
+            def __len__(self):
+                return 2
+
+            def process_queue(self, progress=None, **kwargs):
+                with lock:
+                    active[self.device_specifier] = active.get(self.device_specifier, 0) + 1
+                    peaks[self.device_specifier] = max(peaks.get(self.device_specifier, 0), active[self.device_specifier])
+                    peaks['total'] = max(peaks['total'], sum(active.values()))
+                time.sleep(0.05)
+                with lock:
+                    active[self.device_specifier] -= 1
+                progress(1, 2, "")
+                return ""
+
+        manager = JobManager()
+        devices = ['file:///dev/usb/lp0', '/dev/usb/lp0', 'tcp://192.168.0.23']
+        jobs = [manager.submit(SlowPrinterQueue(device)) for _ in range(2) for device in devices]
+        for job in jobs:
+            assert job.wait(10)
+            assert job.state == 'done'
+        # Both specifiers of lp0 share a worker
+        assert peaks['file:///dev/usb/lp0'] == peaks['/dev/usb/lp0'] == 1
+        assert peaks['total'] == 2
+        stats = {stats['device']: stats for stats in manager.printer_stats()}
+        assert set(stats) == {'/dev/usb/lp0', 'tcp://192.168.0.23'}
+        assert stats['/dev/usb/lp0']['jobs_done'] == 4
+        assert stats['/dev/usb/lp0']['labels_printed'] == 8
+        assert stats['/dev/usb/lp0']['queued_jobs'] == stats['/dev/usb/lp0']['queued_labels'] == 0
+        assert stats['tcp://192.168.0.23']['labels_per_second'] > 0
+
+        response = client.get('/labeldesigner/api/print_queues')
+        assert response.status_code == 200
+        assert 'printers' in response.get_json()
+
+    def test_printer_lock_across_processes(self, client: FlaskClient, tmp_path):
+        """Managers sharing a lock directory, like the processes of a WSGI
+        server, print on a device one at a time and do not query it while
+        another one prints."""
+        import time
+        import threading
+        from app.labeldesigner.jobs import JobManager
+
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        class SlowPrinterQueue:
+            device_specifier = '/dev/usb/lp0'
+
+            def __len__(self):
+                return 1
+
+            def process_queue(self, progress=None, **kwargs):
+                with lock:
+                    active.append(self)
+                    peak.append(len(active))
+                time.sleep(0.1)
+                with lock:
+                    active.remove(self)
+                progress(1, 1, "")
+                return ""
+
+        managers = [JobManager(lock_dir=str(tmp_path)) for _ in range(2)]
+        jobs = [manager.submit(SlowPrinterQueue()) for _ in range(2) for manager in managers]
+        time.sleep(0.05)
+        with managers[1].querying('/dev/usb/lp0') as idle:
+            assert not idle
+        for job in jobs:
+            assert job.wait(10)
+            assert job.state == 'done'
+        assert max(peak) == 1
+        with managers[1].querying('/dev/usb/lp0') as idle:
+            assert idle
+
+    def test_print_job_journal(self, client: FlaskClient, tmp_path):
+        """Jobs interrupted by a restart are resumed with the labels not sent yet."""
+        from app.labeldesigner.label import SimpleLabel
+        from app.labeldesigner.printer import PrinterQueue
+        from app.labeldesigner.jobs import JobManager
+        from app.labeldesigner.journal import PrintJournal
+        from app import FONTS
+        path = FONTS.get_path('DejaVu Sans,Book')
+        journal_file = str(tmp_path / 'journal.sqlite')
+
+        printer = PrinterQueue('QL-800', 'simulation', '62')
+        label = SimpleLabel(width=696, text=[{'text': 'No. {{counter}}', 'path': path, 'size': 40}])
+        for i in range(7):
+            printer.add_label_to_queue(label.clone(counter=i))
+
+        journals = []
+
+        def open_journal():
+            journals.append(PrintJournal(journal_file, FONTS))
+            return journals[-1]
+
+        try:
+            # The first batch was sent when the server stopped
+            journal = open_journal()
+            journal.add('interrupted', printer, 7, 1.0)
+            journal.started('interrupted', 2.0)
+            journal.batch_done('interrupted', 5, '')
+            # Jobs of running servers are left alone
+            assert JobManager(journal=open_journal()).resume() == []
+            assert os.path.exists(f'{journal_file}.{journal.owner}.lock')
+            assert not list(tmp_path.glob('*.new'))
+            journal.close()
+
+            manager = JobManager(journal=open_journal())
+            jobs = manager.resume()
+            assert [(job.id, job.labels, len(job.printer)) for job in jobs] == [('interrupted', 7, 2)]
+            assert jobs[0].wait(10)
+            state = manager.job_state('interrupted')
+            assert (state['state'], state['labels_sent'], state['created']) == ('done', 7, 1.0)
+            assert [(batch['index'], batch['labels']) for batch in state['batches']] == [(1, 5), (2, 2)]
+            assert JobManager(journal=open_journal()).resume() == []
+
+            # Finished jobs are still known after a restart
+            state = JobManager(journal=open_journal()).job_state('interrupted')
+            assert (state['state'], state['success'], state['labels_sent']) == ('done', True, 7)
+            assert [batch['labels'] for batch in state['batches']] == [5, 2]
+
+            # Messages are stored as they are
+            journal = open_journal()
+            journal.add('failed', printer, 1, 3.0)
+            journal.batch_done('failed', 1, "Printer error; 'cover open'")
+            journal.finished('failed', 'failed', "Printer error; 'cover open'", 4.0)
+            state = journal.job_state('failed')
+            assert state['message'] == state['batches'][0]['message'] == "Printer error; 'cover open'"
+
+            # Jobs the caller waits for are not resumed
+            job = JobManager(journal=open_journal()).submit(printer, journal=False)
+            assert job.wait(10)
+            assert journal.job_state(job.id) is None
+        finally:
+            for journal in journals:
+                journal.close()
+        assert not list(tmp_path.glob('*.lock'))
+
+    def test_pool_worker_app_does_not_resume_jobs(self, client: FlaskClient, tmp_path, monkeypatch):
+        """An app created in a spawned pool worker leaves the journal alone."""
+        import multiprocessing
+
+        class JournalConfig(TestConfig):
+            PRINT_JOURNAL_FILE = str(tmp_path / 'journal.sqlite')
+
+        monkeypatch.setattr(multiprocessing, 'parent_process', lambda: object())
+        app = create_app(JournalConfig)
+        app.extensions['warmup'].wait()
+        assert app.extensions['print_jobs'].journal is None
+        assert not list(tmp_path.iterdir())
+
+    def test_print_journal_unsupported_platform(self, client: FlaskClient, tmp_path, monkeypatch):
+        """Without file locks the app starts without a print journal."""
+        from app.labeldesigner import journal
+
+        class JournalConfig(TestConfig):
+            PRINT_JOURNAL_FILE = str(tmp_path / 'journal.sqlite')
+
+        monkeypatch.setattr(journal, 'JOURNAL_SUPPORTED', False)
+        app = create_app(JournalConfig)
+        app.extensions['warmup'].wait()
+        assert app.extensions['print_jobs'].journal is None
+        assert not list(tmp_path.iterdir())
+
+    def test_printer_status_monitor(self, client: FlaskClient):
+        """Concurrent requests share one status query, later ones return the
+        last status of their device right away while a background thread
+        updates it. Stale statuses are queried again, never while the
+        printer prints."""
+        import time
+        import threading
+        from app.labeldesigner.status import PrinterStatusMonitor
+        from app.labeldesigner.jobs import JobManager
+
+        calls = []
+        printing = threading.Event()
+        overlaps = []
+
+        def probe(config):
+            calls.append(config['PRINTER_PRINTER'])
+            # Jobs only print on lp0
+            same_printer = config['PRINTER_PRINTER'] == '/dev/usb/lp0'
+            overlaps.append(same_printer and printing.is_set())
+            time.sleep(0.2)
+            overlaps.append(same_printer and printing.is_set())
+            return {'path': config['PRINTER_PRINTER'], 'probe': len(calls)}
+
+        class SlowPrinterQueue:
+            device_specifier = 'file:///dev/usb/lp0'
+
+            def __len__(self):
+                return 1
+
+            def process_queue(self, progress=None, **kwargs):
+                printing.set()
+                time.sleep(0.3)
+                printing.clear()
+                progress(1, 1, "")
+                return ""
+
+        manager = JobManager()
+        monitor = PrinterStatusMonitor({'PRINTER_PRINTER': '/dev/usb/lp0'}, interval=0.05, idle_timeout=1,
+                                       querying=manager.querying, probe=probe)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(monitor.snapshot())) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [{'path': '/dev/usb/lp0', 'probe': 1}] * 5
+        assert len(calls) == 1
+
+        start = time.perf_counter()
+        monitor.snapshot()
+        assert time.perf_counter() - start < 0.1
+        deadline = time.time() + 5
+        while monitor.snapshot()['probe'] < 3 and time.time() < deadline:
+            time.sleep(0.05)
+        assert monitor.snapshot()['probe'] >= 3
+        # Background queries never hold up requests
+        for _ in range(20):
+            start = time.perf_counter()
+            monitor.snapshot()
+            assert time.perf_counter() - start < 0.1
+            time.sleep(0.02)
+
+        # Each device has its own status
+        assert monitor.snapshot('/dev/usb/lp1')['path'] == '/dev/usb/lp1'
+        assert monitor.snapshot()['path'] == '/dev/usb/lp0'
+        probes = calls.count('/dev/usb/lp1')
+        while calls.count('/dev/usb/lp1') == probes and time.time() < deadline + 5:
+            time.sleep(0.05)
+        assert calls.count('/dev/usb/lp1') > probes
+
+        # Jobs wait for a running query, queries are skipped while printing
+        jobs = []
+        deadline = time.time() + 1
+        while time.time() < deadline:
+            if len(jobs) < 3:
+                jobs.append(manager.submit(SlowPrinterQueue()))
+            assert 'probe' in monitor.snapshot()
+            time.sleep(0.01)
+        for job in jobs:
+            assert job.wait(10)
+            assert job.state == 'done'
+        assert not any(overlaps)
+
+        # A status older than the interval is queried again once the
+        # background thread exited
+        idle_monitor = PrinterStatusMonitor({'PRINTER_PRINTER': '/dev/usb/lp0'}, interval=0.05, idle_timeout=0.1,
+                                            probe=probe)
+        first = idle_monitor.snapshot()['probe']
+        while idle_monitor._thread is not None and time.time() < deadline + 5:
+            time.sleep(0.05)
+        assert idle_monitor._thread is None
+        assert idle_monitor.snapshot()['probe'] > first
+
     def test_printer_status_returns_simulator(self, client: FlaskClient):
         """Check /api/printer_status includes simulator."""
         response = client.get('/labeldesigner/api/printer_status')
@@ -1113,6 +1452,521 @@ class TestLabelDesignerAPI:
         # Simulator should use the configured PRINTER_MODEL
         assert sim.get('model') == client.application.config['PRINTER_MODEL']
 
+    def test_compiled_templates(self, client: FlaskClient):
+        from app.labeldesigner.label import SimpleLabel, compile_template
+        assert compile_template('No placeholders {{unknownvar}}').is_static
+        template = compile_template('#{{counter}} of {{counter:0}} {{random:3:s}}{{datetime:%Y}}')
+        assert not template.is_static
+        assert [token[0] for token in template.tokens if not isinstance(token, str)] == \
+            ['counter', 'counter', 'random', 'datetime']
+        assert compile_template('#{{counter}} of {{counter:0}} {{random:3:s}}{{datetime:%Y}}') is template
+
+        # All {{datetime}} placeholders of a label use the same time
+        text = [{'text': '{{datetime:%H:%M:%S.%f}}'}, {'text': 'at {{datetime:%H:%M:%S.%f}}'}]
+        label = SimpleLabel(text=text, counter=4)
+        label.process_templates()
+        assert 'at ' + label.text[0]['text'] == label.text[1]['text']
+        assert label.input_text[0]['text'] == '{{datetime:%H:%M:%S.%f}}'
+
+        label = SimpleLabel(text=[{'text': '{{counter}}/{{counter:0}} {{random:3:s}}'}], counter=4)
+        label.process_templates()
+        assert label.text[0]['text'].startswith('5/4 ')
+        assert len(label.text[0]['text']) == len('5/4 ') + 3
+        assert label.text[0]['shift'] is True
+        assert 'shift' not in label.input_text[0]
+
+    @pytest.mark.parametrize('case', ['text', 'qr', 'qr_from_text', 'barcode_from_text', 'image', 'widest',
+                                      'inverted', 'overlap'])
+    def test_cloned_labels_match_full_rendering(self, client: FlaskClient, case):
+        """Copies painted on a shared static layer equal fully rendered labels."""
+        from PIL import Image
+        from app.labeldesigner.label import SimpleLabel, LabelContent, LabelOrientation
+        from app import FONTS
+        path = FONTS.get_path('DejaVu Sans,Book')
+        kwargs = {'width': 696, 'label_margin': (35, 35, 24, 24), 'border_thickness': 3}
+        lines = [
+            {'text': 'Serial run', 'path': path, 'size': 40, 'align': 'center', 'checkbox': True},
+            {'text': 'No. {{counter:8}}', 'path': path, 'size': 50, 'align': 'right'},
+            {'text': 'Static footer line', 'path': path, 'size': 30, 'align': 'left', 'inverted': True},
+        ]
+        if case == 'qr':
+            kwargs.update(label_content=LabelContent.TEXT_QRCODE, code_text='https://example.com')
+        elif case == 'qr_from_text':
+            kwargs['label_content'] = LabelContent.TEXT_QRCODE
+        elif case == 'barcode_from_text':
+            kwargs.update(label_content=LabelContent.TEXT_QRCODE, barcode_type='code128')
+        elif case == 'image':
+            kwargs.update(label_content=LabelContent.IMAGE_GRAYSCALE, label_orientation=LabelOrientation.ROTATED,
+                          image=Image.linear_gradient('L').convert('RGB'), height=696)
+        elif case == 'widest':
+            lines[1]['text'] = 'Counter {{counter:8}} is the widest line'
+            lines[1]['align'] = 'center'
+        elif case == 'inverted':
+            lines[1]['inverted'] = True
+        elif case == 'overlap':
+            lines[0]['line_spacing'] = 10
+        label = SimpleLabel(text=lines, **kwargs)
+        for counter in range(4):
+            copy = label.clone(counter=counter)
+            expected = SimpleLabel(text=lines, counter=counter, **kwargs).generate()
+            assert copy.generate().tobytes() == expected.tobytes(), counter
+        uses_layer = case not in ('qr_from_text', 'inverted', 'overlap')
+        assert (label._layers.base is not None) == uses_layer
+
+    @pytest.mark.parametrize('case, label_size, mode', [
+        ('text', '62', 'L'), ('text', '62red', 'L'), ('red_text', '62', 'RGB'), ('red_text', '62red', 'RGB'),
+        ('qr', '62', '1'), ('bw_image', '62', '1'), ('bw_image_text', '62', 'L'), ('gray_image', '62', 'L'),
+        ('colored_image', '62', 'RGB'), ('red_black_image', '62red', 'RGB')])
+    @pytest.mark.parametrize('high_res', [False, True])
+    def test_native_canvas_rasterizes_identically(self, client: FlaskClient, case, label_size, mode, high_res):
+        """Labels rendered on a 1-bit or grayscale canvas print like RGB ones."""
+        from PIL import Image
+        from brother_ql import BrotherQLRaster, create_label
+        from app.labeldesigner.label import SimpleLabel, LabelContent, NATIVE_CANVAS_MODES
+        from app import FONTS
+        path = FONTS.get_path('DejaVu Sans,Book')
+        text = [{'text': 'Native canvas', 'path': path, 'size': 40, 'align': 'center', 'inverted': True},
+                {'text': 'Ag', 'path': path, 'size': 70, 'align': 'left', 'checkbox': True}]
+        gradient = Image.linear_gradient('L').resize((300, 120))
+        kwargs = {'width': 696, 'label_margin': (35, 35, 24, 24), 'border_thickness': 2, 'text': text}
+        if case == 'red_text':
+            text[1]['color'] = 'red'
+        elif case == 'qr':
+            kwargs.update(label_content=LabelContent.QRCODE_ONLY, code_text='https://example.com')
+        elif case.startswith('bw_image'):
+            kwargs.update(label_content=LabelContent.IMAGE_BW, image=gradient.point(lambda x: 255 if x > 128 else 0, mode='1'))
+            if case == 'bw_image':
+                kwargs['text'] = []
+        elif case == 'gray_image':
+            kwargs.update(label_content=LabelContent.IMAGE_GRAYSCALE, image=gradient)
+        elif case == 'colored_image':
+            kwargs.update(label_content=LabelContent.IMAGE_COLORED, image=Image.merge('RGB', (gradient, gradient, gradient.rotate(90))))
+        elif case == 'red_black_image':
+            # Red and black uploads may be sent as black and white images
+            red = gradient.point(lambda x: 255 if x > 128 else 0)
+            kwargs.update(label_content=LabelContent.IMAGE_BW, image=Image.merge('RGB', (red, Image.new('L', red.size), Image.new('L', red.size))))
+        native_modes = NATIVE_CANVAS_MODES[1:] if high_res else NATIVE_CANVAS_MODES
+        if high_res and mode == '1':
+            mode = 'L'
+
+        rasters = []
+        for canvas_modes, expected_mode in ((('RGB',), 'RGB'), (native_modes, mode)):
+            img = SimpleLabel(**kwargs).generate(canvas_modes=canvas_modes)
+            assert img.mode == expected_mode
+            qlr = BrotherQLRaster('QL-800')
+            create_label(qlr, img, label_size, red='red' in label_size, cut=True, rotate=0, dpi_600=high_res,
+                         dither=kwargs.get('label_content') != LabelContent.IMAGE_BW)
+            rasters.append(qlr.data)
+        assert rasters[0] == rasters[1]
+
+    def test_parallel_rasterization(self, client: FlaskClient):
+        """Worker processes produce the same raster data as the request thread."""
+        from PIL import Image
+        from app.labeldesigner.label import SimpleLabel, LabelContent
+        from app.labeldesigner.printer import PrinterQueue
+        from app import FONTS
+        path = FONTS.get_path('DejaVu Sans,Book')
+        gradient = Image.linear_gradient('L').resize((300, 120))
+        labels = [
+            SimpleLabel(width=696, label_margin=(35, 35, 24, 24),
+                        text=[{'text': 'Copy {{counter}}', 'path': path, 'size': 40, 'align': 'center'}]),
+            SimpleLabel(width=696, label_content=LabelContent.TEXT_QRCODE, label_margin=(35, 35, 24, 24),
+                        text=[{'text': '{{random:8}}', 'path': path, 'size': 30, 'align': 'left'}]),
+            SimpleLabel(width=696, label_content=LabelContent.IMAGE_GRAYSCALE, image=gradient, border_thickness=2, text=[]),
+        ]
+        assert [label.is_portable() for label in labels] == [True, False, True]
+        rasters = []
+        for workers in (1, 2):
+            random.seed(42)
+            printer = PrinterQueue('QL-800', 'simulation', '62', workers=workers)
+            for i in range(7):
+                label = labels[i % 3]
+                printer.add_label_to_queue(label if i < 3 else label.clone(counter=i), cut=i % 2 == 0, high_res=i == 6)
+            entries = list(printer._print_queue)
+            qlr, images = printer._rasterize_entries(entries)
+            rasters.append((qlr.data, [img.tobytes() for img in images]))
+        assert rasters[0] == rasters[1]
+
+    def test_replaced_font_is_not_served_from_cache(self, client: FlaskClient, tmp_path):
+        """Labels are rendered again after a font file was replaced at the same path."""
+        import shutil
+        from app.labeldesigner.label import SimpleLabel, RENDER_CACHE
+        from app import FONTS
+        font_path = shutil.copy(FONTS.get_path('DejaVu Sans,Book'), tmp_path / 'font.ttf')
+
+        def render():
+            return SimpleLabel(width=696, text=[{'text': 'Replaced', 'path': str(font_path), 'size': 40}]).generate()
+
+        sans = render()
+        assert len(RENDER_CACHE) > 0
+        shutil.copy(FONTS.get_path('DejaVu Serif,Book'), font_path)
+        assert FONTS.refresh([str(tmp_path)])
+        try:
+            assert len(RENDER_CACHE) == 0
+            assert render().tobytes() != sans.tobytes()
+        finally:
+            os.remove(font_path)
+            FONTS.refresh([str(tmp_path)])
+
+    def test_raster_reuse_for_copies(self, client: FlaskClient, monkeypatch):
+        """Copies of a static label are rasterized once per cut setting."""
+        from brother_ql.raster import BrotherQLRaster
+        from app.labeldesigner import printer as printer_module
+        from app.labeldesigner.label import SimpleLabel
+        from app import FONTS
+        path = FONTS.get_path('DejaVu Sans,Book')
+        label = SimpleLabel(width=696, text=[{'text': 'Static', 'path': path, 'size': 40}])
+        expected = []
+        for cut in (False, True):
+            qlr = BrotherQLRaster('QL-800')
+            printer_module.rasterize_entry(qlr, '62', {'label': label, 'cut': cut, 'high_res': False})
+            expected.append(qlr.data)
+
+        rasterized = []
+        rasterize_entry = printer_module.rasterize_entry
+
+        def counting_rasterize_entry(qlr, label_size, entry):
+            rasterized.append(entry['cut'])
+            return rasterize_entry(qlr, label_size, entry)
+
+        monkeypatch.setattr(printer_module, 'rasterize_entry', counting_rasterize_entry)
+        for workers in (1, 2):
+            rasterized.clear()
+            printer = printer_module.PrinterQueue('QL-800', 'simulation', '62', workers=workers)
+            for i in range(12):
+                printer.add_label_to_queue(label if i == 0 else label.clone(counter=i), cut=i == 11)
+            data = [printer._rasterize_entries(batch)[0].data for batch in
+                    (printer._print_queue[:5], printer._print_queue[5:10], printer._print_queue[10:])]
+            assert data == [expected[0] * 5, expected[0] * 5, expected[0] + expected[1]]
+            if workers == 1:
+                assert rasterized == [False, True]
+
+        # The image of an image label is hashed once for all copies
+        from PIL import Image
+        from app.labeldesigner.label import LabelContent
+        image = Image.linear_gradient('L').resize((300, 120))
+        hashed = []
+        tobytes = image.tobytes
+        monkeypatch.setattr(image, 'tobytes', lambda *args: hashed.append(1) or tobytes(*args))
+        label = SimpleLabel(width=696, label_content=LabelContent.IMAGE_GRAYSCALE, image=image, text=[])
+        copies = [label] + [label.clone(counter=i) for i in range(1, 5)]
+        keys = {printer_module.PrinterQueue.raster_key({'label': copy, 'cut': True, 'high_res': False})
+                for copy in copies}
+        assert len(keys) == 1 and None not in keys
+        assert len(hashed) == 1
+
+        # Labels with templates are rasterized for every copy
+        rasterized.clear()
+        printer = printer_module.PrinterQueue('QL-800', 'simulation', '62')
+        label = SimpleLabel(width=696, text=[{'text': 'No. {{counter}}', 'path': path, 'size': 40}])
+        for i in range(3):
+            printer.add_label_to_queue(label.clone(counter=i))
+        printer._rasterize_entries(printer._print_queue)
+        assert len(rasterized) == 3
+
+    def test_adaptive_batch_size(self, client: FlaskClient, monkeypatch):
+        """Batches grow for fast printers and shrink for slow ones and big labels."""
+        from app.labeldesigner.label import SimpleLabel
+        from app.labeldesigner.printer import PrinterQueue, BatchSizer, DEFAULT_BATCH_SIZE, MAX_BATCH_SIZE
+        from app import FONTS
+        path = FONTS.get_path('DejaVu Sans,Book')
+
+        sizer = BatchSizer(target_seconds=4)
+        assert sizer.next_size() == DEFAULT_BATCH_SIZE
+        sizer.rasterized(5, 50000)
+        sizer.sent(50000, 1.0)
+        assert sizer.next_size() == 20
+        # Bigger labels
+        sizer.rasterized(5, 150000)
+        assert sizer.next_size() == 10
+        # A slower printer
+        sizer.sent(1000, 10.0)
+        assert sizer.next_size() == 5
+        sizer.sent(1000, 10.0)
+        sizer.sent(1000, 10.0)
+        assert sizer.next_size() == 1
+        sizer.sent(10 ** 9, 0.1)
+        sizer.sent(10 ** 9, 0.1)
+        assert sizer.next_size() == MAX_BATCH_SIZE
+        assert BatchSizer(3, 3).next_size() == 3
+
+        class FastPrinterQueue(PrinterQueue):
+            def __init__(self):
+                super().__init__('QL-800', 'simulation', '62')
+                self.sent = []
+
+            def _send_raster(self, qlr, generated_images, batch_index=0):
+                self.sent.append(len(generated_images))
+                return ""
+
+        monkeypatch.delenv('PRINT_BATCH_SIZE', raising=False)
+        printer = FastPrinterQueue()
+        label = SimpleLabel(width=696, text=[{'text': 'Static', 'path': path, 'size': 40}])
+        for i in range(120):
+            printer.add_label_to_queue(label if i == 0 else label.clone(counter=i))
+        assert printer.process_queue() == ""
+        assert sum(printer.sent) == 120
+        assert printer.sent[0] == DEFAULT_BATCH_SIZE
+        assert max(printer.sent) == MAX_BATCH_SIZE
+
+    def test_batch_size_is_kept_per_printer(self, client: FlaskClient, monkeypatch):
+        """The next job of a printer starts with the batch size learned by
+        the previous one, network printers keep the default size."""
+        import time
+        from app.labeldesigner import printer as printer_module
+        from app.labeldesigner.label import SimpleLabel
+        from app.labeldesigner.printer import PrinterQueue, BatchSizer, DEFAULT_BATCH_SIZE
+        from app.labeldesigner.jobs import JobManager
+        from app import FONTS
+        path = FONTS.get_path('DejaVu Sans,Book')
+
+        class TimedPrinterQueue(PrinterQueue):
+            def __init__(self, device_specifier='simulation'):
+                super().__init__('QL-800', device_specifier, '62')
+                self.sent = []
+
+            def _send_raster(self, qlr, generated_images, batch_index=0):
+                self.sent.append(len(generated_images))
+                time.sleep(0.005 * len(generated_images))
+                return ""
+
+        def make_printer(device_specifier='simulation'):
+            printer = TimedPrinterQueue(device_specifier)
+            label = SimpleLabel(width=696, text=[{'text': 'Static', 'path': path, 'size': 40}])
+            for i in range(60):
+                printer.add_label_to_queue(label if i == 0 else label.clone(counter=i))
+            return printer
+
+        monkeypatch.delenv('PRINT_BATCH_SIZE', raising=False)
+        monkeypatch.setattr(printer_module, 'TARGET_BATCH_SECONDS', 0.2)
+        manager = JobManager()
+        printers = [make_printer(), make_printer()]
+        for printer in printers:
+            job = manager.submit(printer)
+            assert job.wait(10)
+            assert job.state == 'done'
+        assert printers[0].sent[0] == DEFAULT_BATCH_SIZE
+        assert printers[1].sent[0] > DEFAULT_BATCH_SIZE
+
+        sizer = BatchSizer()
+        printer = make_printer('tcp://192.168.0.23')
+        assert printer.process_queue(sizer=sizer) == ""
+        assert sizer.throughput is None
+        assert sizer.next_size() == DEFAULT_BATCH_SIZE
+
+    def test_network_printer_connection(self, client: FlaskClient, monkeypatch):
+        """Batches and jobs for a network printer share one connection,
+        which is reopened once the printer closed it."""
+        import socket
+        import threading
+        import time
+        from app.labeldesigner.label import SimpleLabel
+        from app.labeldesigner.printer import PrinterQueue
+        from app.labeldesigner.connections import CONNECTIONS
+        from app import FONTS
+        path = FONTS.get_path('DejaVu Sans,Book')
+
+        server = socket.create_server(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+        connections = []
+
+        def receive(conn, received):
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                received += data
+            conn.close()
+
+        def accept():
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except OSError:
+                    return
+                received = bytearray()
+                connections.append((conn, received))
+                threading.Thread(target=receive, args=(conn, received), daemon=True).start()
+
+        threading.Thread(target=accept, daemon=True).start()
+        monkeypatch.setattr(CONNECTIONS, 'idle_timeout', 0.5)
+        device = f'tcp://127.0.0.1:{port}'
+
+        def print_job(count, streaming=False):
+            printer = PrinterQueue('QL-800', device, '62', streaming=streaming)
+            label = SimpleLabel(width=696, text=[{'text': 'No. {{counter}}', 'path': path, 'size': 40}])
+            for i in range(count):
+                printer.add_label_to_queue(label.clone(counter=i))
+            qlr, _ = printer._rasterize_entries(list(printer._print_queue))
+            assert printer.process_queue(batch_size=3) == ""
+            return qlr.data
+
+        def wait_for(condition):
+            deadline = time.time() + 5
+            while not condition() and time.time() < deadline:
+                time.sleep(0.01)
+            assert condition()
+
+        try:
+            expected = print_job(7) + print_job(4, streaming=True)
+            assert len(connections) == 1
+            wait_for(lambda: bytes(connections[0][1]) == expected)
+
+            # The printer closed the connection
+            connections[0][0].shutdown(socket.SHUT_RDWR)
+            expected = print_job(2)
+            assert len(connections) == 2
+            wait_for(lambda: bytes(connections[1][1]) == expected)
+
+            # Idle connections are closed
+            wait_for(lambda: connections[1][0].fileno() == -1)
+        finally:
+            server.close()
+            CONNECTIONS.close()
+
+    def test_pipelined_printing(self, client: FlaskClient):
+        """Batches are sent in order and a failing batch stops the pipeline."""
+        from app.labeldesigner.label import SimpleLabel
+        from app.labeldesigner.printer import PrinterQueue
+        from app import FONTS
+        path = FONTS.get_path('DejaVu Sans,Book')
+
+        class RecordingPrinterQueue(PrinterQueue):
+            def __init__(self, fail_batch=None):
+                super().__init__('QL-800', 'simulation', '62')
+                self.fail_batch = fail_batch
+                self.rasterized = []
+                self.sent = []
+
+            def _rasterize_entries(self, entries):
+                self.rasterized.append(len(entries))
+                return super()._rasterize_entries(entries)
+
+            def _send_raster(self, qlr, generated_images, batch_index=0):
+                self.sent.append((batch_index, len(generated_images)))
+                return f"Failed to print label (batch {batch_index})" if batch_index == self.fail_batch else ""
+
+        def fill(printer, count=7):
+            label = SimpleLabel(width=696, text=[{'text': 'No. {{counter}}', 'path': path, 'size': 40}])
+            for i in range(count):
+                printer.add_label_to_queue(label.clone(counter=i))
+            return printer
+
+        printer = fill(RecordingPrinterQueue())
+        assert printer.process_queue(batch_size=3) == ""
+        assert printer.sent == [(1, 3), (2, 3), (3, 1)]
+
+        printer = fill(RecordingPrinterQueue(fail_batch=1), count=30)
+        assert printer.process_queue(batch_size=3) == "Failed to print label (batch 1)"
+        assert printer.sent == [(1, 3)]
+        # The rasterizer stops at most a few batches ahead
+        assert len(printer.rasterized) <= 3
+
+        printer = fill(RecordingPrinterQueue(), count=4)
+        printer.add_label_to_queue(SimpleLabel(width=696, text=[{'text': 'Bad', 'path': path, 'size': 40}],
+                                               border_thickness=1, border_distance=(500, 0)))
+        with pytest.raises(ValueError, match="Invalid border rectangle"):
+            printer.process_queue(batch_size=2)
+        assert printer.sent == [(1, 2), (2, 2)]
+
+    def test_streaming_printing(self, client: FlaskClient, tmp_path, monkeypatch):
+        """Streamed labels are written with the same data as whole batches."""
+        from app.labeldesigner.label import SimpleLabel
+        from app.labeldesigner import printer as printer_module
+        from app import FONTS
+        path = FONTS.get_path('DejaVu Sans,Book')
+        label = SimpleLabel(width=696, text=[{'text': 'No. {{counter}}', 'path': path, 'size': 40}])
+        device = tmp_path / 'lp0'
+        device.touch()
+        # A regular file never answers with a status
+        monkeypatch.setattr(printer_module, 'STREAM_STATUS_TIMEOUT', 0.05)
+
+        printer = printer_module.PrinterQueue('QL-800', f'file://{device}', '62', streaming=True)
+        for i in range(4):
+            printer.add_label_to_queue(label.clone(counter=i), cut=i == 3)
+        assert printer.process_queue(batch_size=10) == "Failed to print label (batch 1)"
+
+        expected = printer_module.PrinterQueue('QL-800', 'simulation', '62')
+        qlr, _ = expected._rasterize_entries([{'label': label.clone(counter=i), 'cut': i == 3, 'high_res': False}
+                                              for i in range(4)])
+        assert device.read_bytes() == qlr.data
+
+    def test_render_cache(self, client: FlaskClient):
+        data = EXAMPLE_FORMDATA.copy()
+        data['text'] = json.dumps([{'text': 'Rendered once', 'size': '43', 'font': 'DejaVu Sans,Book', 'align': 'center'}])
+        first = client.post('/labeldesigner/api/preview', data=data)
+        stats = client.get('/labeldesigner/api/cache_stats').get_json()['render_cache']
+        second = client.post('/labeldesigner/api/preview', data=data)
+        assert second.data == first.data
+        new_stats = client.get('/labeldesigner/api/cache_stats').get_json()['render_cache']
+        assert new_stats['hits'] == stats['hits'] + 1
+        assert 0 < new_stats['weight'] <= new_stats['max_weight']
+        assert 0 < new_stats['hit_rate'] <= 1
+
+        # Changing any input renders a new label
+        data['margin_top'] = '50'
+        third = client.post('/labeldesigner/api/preview', data=data)
+        assert third.data != first.data
+        assert client.get('/labeldesigner/api/cache_stats').get_json()['render_cache']['misses'] == stats['misses'] + 1
+
+        # Dynamic templates are never cached
+        data['text'] = json.dumps([{'text': '{{datetime:%S.%f}}', 'size': '43', 'font': 'DejaVu Sans,Book', 'align': 'center'}])
+        stats = client.get('/labeldesigner/api/cache_stats').get_json()['render_cache']
+        client.post('/labeldesigner/api/preview', data=data)
+        client.post('/labeldesigner/api/preview', data=data)
+        new_stats = client.get('/labeldesigner/api/cache_stats').get_json()['render_cache']
+        assert (new_stats['hits'], new_stats['misses'], new_stats['size']) == \
+            (stats['hits'], stats['misses'], stats['size'])
+
+    def test_ready(self, client: FlaskClient):
+        response = client.get('/ready')
+        assert response.status_code == 200
+        status = response.get_json()
+        assert status['ready'] is True
+        assert status['error'] is None
+        warmup = client.application.extensions['warmup']
+        warmup.ready.clear()
+        assert client.get('/ready').status_code == 503
+        warmup.run()
+        assert client.get('/ready').status_code == 200
+        assert warmup.error is None
+
+    def test_cache_stats(self, client: FlaskClient):
+        """Fonts are cached once per size, no matter if it is sent as string or int."""
+        data = EXAMPLE_FORMDATA.copy()
+        data['text'] = json.dumps([{'text': 'Cache', 'size': '37', 'font': 'DejaVu Sans,Book', 'align': 'center'}])
+        response = client.post('/labeldesigner/api/preview', data=data)
+        assert response.status_code == 200
+        stats = client.get('/labeldesigner/api/cache_stats').get_json()['font_cache']
+        assert stats['capacity'] == client.application.config['FONT_CACHE_SIZE']
+        assert 0 < stats['size'] <= stats['capacity']
+        hits = stats['hits']
+        data['text'] = json.dumps([{'text': 'Cache 2', 'size': 37, 'font': 'DejaVu Sans,Book', 'align': 'center'}])
+        response = client.post('/labeldesigner/api/preview', data=data)
+        assert response.status_code == 200
+        stats = client.get('/labeldesigner/api/cache_stats').get_json()['font_cache']
+        assert stats['hits'] > hits
+
+    def test_text_bbox_cache(self, client: FlaskClient):
+        """Unchanged lines are measured once, rendering stays the same."""
+        data = EXAMPLE_FORMDATA.copy()
+        data['text'] = json.dumps([
+            {'text': 'Measured once', 'size': '41', 'font': 'DejaVu Sans,Book', 'align': 'left'},
+            {'text': 'Second line', 'size': '41', 'font': 'DejaVu Sans,Book', 'align': 'left'},
+        ])
+        first = client.post('/labeldesigner/api/preview', data=data)
+        assert first.status_code == 200
+        stats = client.get('/labeldesigner/api/cache_stats').get_json()
+        # Measure again instead of reusing the rendered label
+        from app.labeldesigner.label import RENDER_CACHE
+        RENDER_CACHE.clear()
+        second = client.post('/labeldesigner/api/preview', data=data)
+        assert second.data == first.data
+        new_stats = client.get('/labeldesigner/api/cache_stats').get_json()
+        for cache in ('text_bbox_cache', 'line_extents_cache'):
+            assert new_stats[cache]['misses'] == stats[cache]['misses']
+            assert new_stats[cache]['hits'] > stats[cache]['hits']
+
     @pytest.mark.parametrize('fit', ['fit', 'no_fit'])
     @pytest.mark.parametrize('orientation', ['standard', 'rotated'])
     @pytest.mark.parametrize('label_size', ["12", "62", "62x29", "62x100", "d12"])
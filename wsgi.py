@@ -3,7 +3,10 @@
 
 from app import create_app
 
-app = create_app()
+# Worker processes started with the spawn method import the main module
+# again as __mp_main__, they must not create another app
+if __name__ != '__mp_main__':
+    app = create_app()
 
 if __name__ == "__main__":
     app.run()